@@ -26,9 +26,11 @@ http://atomenabled.org/developers/syndication/
 
 __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
+import hashlib
 import json
 import logging
 import urllib
+import zlib
 
 from google.appengine.ext import ndb
 from oauth_dropins.webutil import handlers
@@ -36,14 +38,7 @@ from oauth_dropins.webutil import util
 from webob import exc
 
 from granary import appengine_config
-from granary import atom
-from granary import facebook
-from granary import flickr
-from granary import googleplus
-from granary import instagram
-from granary import microformats2
 from granary import source
-from granary import twitter
 
 import webapp2
 
@@ -58,6 +53,27 @@ ITEMS_PER_PAGE = 100
 PATH_DEFAULTS = ((source.ME,), (source.ALL, source.FRIENDS), (source.APP,), ())
 MAX_PATH_LEN = len(PATH_DEFAULTS) + 1
 
+# Rendered responses are cached per request path and query params, along with
+# the silo's ETag for the activities they were rendered from. If the silo says
+# the activities haven't changed, we serve the cached response instead of
+# rendering it again. Only silos that support ETags are cached. @self responses
+# aren't cached, since some silos merge in other data, e.g. Facebook photos and
+# events, that the ETag doesn't cover.
+RESPONSE_CACHE_TIME = 60 * 60  # 1h
+RESPONSE_CACHE_MAX_BYTES = 20 * 1000 * 1000  # total size of cached bodies
+response_cache = source.LRUCache(max_bytes=RESPONSE_CACHE_MAX_BYTES,
+                                 sizeof=lambda cached: len(cached['body']))
+
+# Responses are compressed in chunks of this many bytes.
+COMPRESS_CHUNK_SIZE = 64 * 1024
+
+# maps Content-Encoding to zlib wbits for compressobj(). gzip adds a header and
+# trailer; deflate is the zlib format, as HTTP specifies.
+COMPRESS_WBITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+# Stands in for the streamed list while iter_json() encodes the rest of a dict.
+ITER_JSON_PLACEHOLDER = '__iter_json_placeholder__'
+
 
 class Handler(webapp2.RequestHandler):
   """Base class for ActivityStreams API handlers.
@@ -80,48 +96,125 @@ class Handler(webapp2.RequestHandler):
       raise exc.HTTPNotFound('Expected 1-%d path elements; found %d' %
                              (MAX_PATH_LEN, len(args)))
 
-    # make source instance
+    # make source instance. only imports the silo module that's requested.
     site = args.pop(0)
-    if site == 'twitter':
-      src = twitter.Twitter(
-        access_token_key=util.get_required_param(self, 'access_token_key'),
-        access_token_secret=util.get_required_param(self, 'access_token_secret'))
-    elif site == 'facebook':
-      src = facebook.Facebook(
-        access_token=util.get_required_param(self, 'access_token'))
-    elif site == 'flickr':
-      src = flickr.Flickr(
+    src_cls = source.sources.get(site)
+    if not src_cls:
+      raise exc.HTTPNotFound('Unknown site %r' % site)
+
+    if site in ('twitter', 'flickr'):
+      src = src_cls(
         access_token_key=util.get_required_param(self, 'access_token_key'),
         access_token_secret=util.get_required_param(self, 'access_token_secret'))
-    elif site == 'instagram':
-      src = instagram.Instagram(
-        access_token=util.get_required_param(self, 'access_token'))
+    elif site in ('facebook', 'instagram'):
+      src = src_cls(access_token=util.get_required_param(self, 'access_token'))
     elif site == 'google+':
       auth_entity = util.get_required_param(self, 'auth_entity')
-      src = googleplus.GooglePlus(auth_entity=ndb.Key(urlsafe=auth_entity).get())
+      src = src_cls(auth_entity=ndb.Key(urlsafe=auth_entity).get())
     else:
-      src_cls = source.sources.get(site)
-      if not src_cls:
-        raise exc.HTTPNotFound('Unknown site %r' % site)
       src = src_cls(**self.request.params)
 
     # handle default path elements
     args = [None if a in defaults else a
             for a, defaults in zip(args, PATH_DEFAULTS)]
     user_id = args[0] if args else None
+    group_id = args[1] if len(args) > 1 else None
+
+    # get activities. if we have a cached response, pass along its ETag so the
+    # silo can tell us whether anything changed.
+    kwargs = self.get_kwargs()
+    cache_key = None
+    cached = None
+    if group_id != source.SELF:
+      cache_key = self.response_cache_key()
+      cached = response_cache.get(cache_key)
+    if cached:
+      kwargs['etag'] = cached['silo_etag']
+    response = src.get_activities_response(*args, **kwargs)
+
+    silo_etag = response.get('etag')
+    if cached and silo_etag == cached['silo_etag']:
+      logging.info('Silo ETag %s unchanged, serving cached response', silo_etag)
+      self.response.headers.update(cached['headers'])
+      self.response.body = cached['body']
+    else:
+      # fetch actor if necessary
+      actor = None
+      if self.request.get('format') == 'atom':
+        # atom needs actor
+        actor = src.get_actor(user_id) if src else {}
+
+      self.write_response(response, actor=actor)
+      if silo_etag and cache_key:
+        response_cache.set(cache_key, {
+          'silo_etag': silo_etag,
+          'body': self.response.body,
+          'headers': dict(self.response.headers),
+        }, time=RESPONSE_CACHE_TIME)
+
+    self.finish_response()
+
+  def finish_response(self):
+    """Sets the ETag, answers conditional requests, and compresses the body.
+
+    The body is compressed with gzip or deflate if the client's Accept-Encoding
+    allows it. It's compressed chunk by chunk as the WSGI server reads it, so
+    it isn't held in memory twice.
+    """
+    encoding = None
+    # (webob treats a missing Accept-Encoding header as accepting anything)
+    if self.request.headers.get('Accept-Encoding'):
+      encoding = self.request.accept_encoding.best_match(('gzip', 'deflate'))
+    chunks = self.response.app_iter
+
+    # the compressed and uncompressed bodies are different entities, so give
+    # them different ETags
+    md5 = hashlib.md5()
+    for chunk in chunks:
+      md5.update(chunk)
+    self.response.etag = md5.hexdigest() + ('-' + encoding if encoding else '')
+    # JSON is pretty printed for browsers, based on Accept
+    self.response.vary = ('Accept', 'Accept-Encoding')
+
+    if self.response.etag in self.request.if_none_match:
+      self.response.status = 304
+      self.response.body = ''
+    elif encoding:
+      self.response.content_encoding = encoding
+      self.response.app_iter = compress(chunks, encoding)
+
+  def response_cache_key(self):
+    """Returns the response_cache key for the current request.
+
+    The query params include access tokens, so they're hashed instead of
+    included directly.
+    """
+    params = sorted(self.request.params.items())
+    return 'AS %s' % hashlib.sha256(
+      repr((self.request.path, params, self.pretty_json()))).hexdigest()
+
+  def pretty_json(self):
+    """Returns True if JSON output should be indented for humans to read.
 
-    # fetch actor if necessary
-    actor = None
-    if self.request.get('format') == 'atom':
-      # atom needs actor
-      args = [None if a in defaults else a  # handle default path elements
-              for a, defaults in zip(args, PATH_DEFAULTS)]
-      user_id = args[0] if args else None
-      actor = src.get_actor(user_id) if src else {}
+    That's for browsers and the plaintext query param. Everything else gets
+    compact JSON, which is smaller and faster to encode.
+    """
+    return ('plaintext' in self.request.params or
+            'text/html' in self.request.headers.get('Accept', ''))
+
+  def write_json(self, obj, items):
+    """Writes obj as JSON with items as its 'items' value, one at a time.
+
+    Pretty printed if pretty_json() says so.
 
-    # get activities and write response
-    response = src.get_activities_response(*args, **self.get_kwargs())
-    self.write_response(response, actor=actor)
+    Args:
+      obj: dict
+      items: iterable of JSON-serializable values. May be a generator.
+    """
+    kwargs = ({'indent': 2} if self.pretty_json()
+              else {'separators': (',', ':')})
+    for chunk in iter_json(obj, 'items', items, **kwargs):
+      self.response.out.write(chunk)
 
   def write_response(self, response, actor=None):
     """Converts ActivityStreams activities and writes them out.
@@ -143,22 +236,26 @@ class Handler(webapp2.RequestHandler):
     self.response.headers['Access-Control-Allow-Origin'] = '*'
     if format in ('json', 'activitystreams'):
       self.response.headers['Content-Type'] = 'application/json'
-      self.response.out.write(json.dumps(response, indent=2))
+      self.write_json(response, activities)
     elif format == 'atom':
+      from granary import atom
       self.response.headers['Content-Type'] = 'text/xml'
-      self.response.out.write(atom.activities_to_atom(
+      # write the feed out as it's generated instead of building it all first
+      for chunk in atom.activities_to_atom_iter(
           activities, actor, host_url=self.request.host_url + '/',
-          request_url=self.request.path_url))
+          request_url=self.request.path_url):
+        self.response.out.write(chunk)
     elif format == 'xml':
       self.response.headers['Content-Type'] = 'text/xml'
       self.response.out.write(XML_TEMPLATE % util.to_xml(response))
     elif format == 'html':
+      from granary import microformats2
       self.response.headers['Content-Type'] = 'text/html'
       self.response.out.write(microformats2.activities_to_html(activities))
     elif format == 'json-mf2':
+      from granary import microformats2
       self.response.headers['Content-Type'] = 'application/json'
-      items = [microformats2.object_to_json(a) for a in activities]
-      self.response.out.write(json.dumps({'items': items}, indent=2))
+      self.write_json({}, (microformats2.object_to_json(a) for a in activities))
 
     if 'plaintext' in self.request.params:
       # override response content type
@@ -198,5 +295,59 @@ class Handler(webapp2.RequestHandler):
                                (param, val))
 
 
+def iter_json(obj, key, values, **kwargs):
+  """JSON encodes a dict incrementally, one element of a list value at a time.
+
+  Yields the same JSON as json.dumps(dict(obj, **{key: list(values)}),
+  **kwargs), in chunks, so that only one element of values needs to be encoded,
+  or even exist, at a time.
+
+  Args:
+    obj: dict
+    key: string, key in the output for values
+    values: iterable of JSON-serializable values
+    kwargs: passed through to json.JSONEncoder
+  """
+  encoder = json.JSONEncoder(**kwargs)
+
+  # encode everything else around a placeholder, then splice the values in
+  envelope = dict(obj)
+  envelope[key] = ITER_JSON_PLACEHOLDER
+  head, tail = encoder.encode(envelope).split(
+    encoder.encode(ITER_JSON_PLACEHOLDER), 1)
+
+  # match json.dumps's indentation for list elements and the closing bracket
+  newline = close = ''
+  if encoder.indent is not None:
+    last_line = head.rsplit('\n', 1)[-1]
+    line_indent = len(last_line) - len(last_line.lstrip(' '))
+    newline = '\n' + ' ' * (line_indent + encoder.indent)
+    close = '\n' + ' ' * line_indent
+
+  yield head + '['
+  sep = newline
+  for value in values:
+    yield sep + encoder.encode(value).replace('\n', newline)
+    sep = encoder.item_separator + newline
+  yield (close if sep != newline else '') + ']' + tail
+
+
+def compress(chunks, encoding):
+  """Compresses a sequence of strings. Yields the compressed data in chunks.
+
+  Args:
+    chunks: sequence of strings
+    encoding: string, a key in COMPRESS_WBITS
+  """
+  compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                COMPRESS_WBITS[encoding])
+  for chunk in chunks:
+    for i in xrange(0, len(chunk), COMPRESS_CHUNK_SIZE):
+      compressed = compressor.compress(chunk[i:i + COMPRESS_CHUNK_SIZE])
+      if compressed:
+        yield compressed
+  yield compressor.flush()
+
+
 application = webapp2.WSGIApplication([('.*', Handler)],
                                       debug=appengine_config.DEBUG)
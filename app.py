@@ -21,7 +21,6 @@ from oauth_dropins.webutil import util
 import webapp2
 
 import activitystreams
-from granary import atom
 from granary import microformats2
 from granary import source
 
@@ -98,6 +97,7 @@ class UrlHandler(activitystreams.Handler):
                     for item in json.loads(body).get('items', [])]
 
     self.write_response(source.Source.make_activities_base_response(activities))
+    self.finish_response()
 
 
 application = webapp2.WSGIApplication([
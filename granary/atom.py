@@ -4,12 +4,14 @@ Atom spec: http://atomenabled.org/developers/syndication/
 """
 
 import collections
+import HTMLParser
+import htmlentitydefs
+import logging
 import os
 import re
 import urlparse
 import xml.sax.saxutils
 
-from bs4 import BeautifulSoup
 import jinja2
 from oauth_dropins.webutil import util
 
@@ -21,10 +23,170 @@ ATOM_TEMPLATE_FILE = 'user_feed.atom'
 UNENCODED_AMPERSANDS_RE = re.compile(r'&(?!(\w+|#\d+);)')
 
 
+# Process-wide template environment. Jinja caches each compiled template
+# inside its environment, so sharing one means each template is only parsed and
+# compiled once per process instead of once per feed. Templates ship with the
+# package and don't change at runtime, so don't stat them on every lookup.
+jinja_env = jinja2.Environment(
+  loader=jinja2.PackageLoader(__package__, 'templates'), autoescape=True,
+  auto_reload=False)
+
+
+def enable_bytecode_cache(directory):
+  """Stores compiled template bytecode on disk so that new processes start warm.
+
+  Args:
+    directory: string, path to a writable directory
+  """
+  jinja_env.bytecode_cache = jinja2.FileSystemBytecodeCache(directory)
+
+
+# Emulate Django template behavior that returns a special default value that
+# can continue to be referenced when an attribute or item lookup fails. Helps
+# avoid conditionals in the template itself.
+# https://docs.djangoproject.com/en/1.8/ref/templates/language/#variables
+class Defaulter(collections.defaultdict):
+  def __init__(self, **kwargs):
+    super(Defaulter, self).__init__(Defaulter, **{
+      k: (Defaulter(**v) if isinstance(v, dict) else v)
+      for k, v in kwargs.items()})
+
+  def __unicode__(self):
+    return super(Defaulter, self).__unicode__() if self else u''
+
+
 def _encode_ampersands(text):
   return UNENCODED_AMPERSANDS_RE.sub('&amp;', text)
 
 
+class _HTMLTextExtractor(HTMLParser.HTMLParser):
+  """Collects the text in an HTML snippet, decoding entities and dropping tags.
+
+  A much cheaper equivalent of BeautifulSoup(html, 'html.parser').get_text('').
+  Like BeautifulSoup, it omits comments, declarations, processing instructions,
+  and the contents of <script> and <style> elements, and collapses runs of
+  whitespace between tags outside <pre> and <textarea> to a single character.
+  """
+  ENTITIES = dict(htmlentitydefs.name2codepoint, apos=ord("'"))
+  PRESERVE_WHITESPACE_TAGS = frozenset(('pre', 'textarea'))
+  ASCII_SPACES = '\x20\x0a\x09\x0c\x0d'
+
+  def __init__(self):
+    HTMLParser.HTMLParser.__init__(self)
+    self.text = []
+    self.pending = []  # data since the last tag
+    self.skip_tag = None
+    self.preserve_whitespace = 0
+
+  def flush(self):
+    """Moves pending text into self.text. Called at each markup boundary."""
+    data = u''.join(self.pending)
+    self.pending = []
+    if data and not self.preserve_whitespace and not data.strip(self.ASCII_SPACES):
+      data = '\n' if '\n' in data else ' '
+    if data:
+      self.text.append(data)
+
+  def handle_starttag(self, tag, attrs):
+    self.flush()
+    if tag in self.CDATA_CONTENT_ELEMENTS:
+      self.skip_tag = tag
+    elif tag in self.PRESERVE_WHITESPACE_TAGS:
+      self.preserve_whitespace += 1
+
+  def handle_startendtag(self, tag, attrs):
+    self.flush()
+
+  def handle_endtag(self, tag):
+    self.flush()
+    if tag == self.skip_tag:
+      self.skip_tag = None
+    elif tag in self.PRESERVE_WHITESPACE_TAGS and self.preserve_whitespace:
+      self.preserve_whitespace -= 1
+
+  def handle_data(self, data):
+    if not self.skip_tag:
+      self.pending.append(data)
+
+  def handle_entityref(self, name):
+    codepoint = self.ENTITIES.get(name)
+    # unknown entities are left as is, minus the semicolon, like BeautifulSoup
+    self.handle_data(unichr(codepoint) if codepoint else '&' + name)
+
+  def handle_charref(self, name):
+    codepoint = int(name[1:], 16) if name[0] in 'xX' else int(name)
+    data = None
+    if codepoint < 256:
+      # numeric references below 256 are often really windows-1252 bytes, e.g.
+      # &#147; for a left double quote.
+      try:
+        data = chr(codepoint).decode('windows-1252')
+      except UnicodeDecodeError:
+        pass
+    if not data:
+      try:
+        data = unichr(codepoint)
+      except (ValueError, OverflowError):
+        data = u'\ufffd'
+    self.handle_data(data)
+
+  def handle_comment(self, data):
+    self.flush()
+
+  def handle_decl(self, decl):
+    self.flush()
+
+  def handle_pi(self, data):
+    self.flush()
+
+  def unknown_decl(self, data):
+    self.flush()
+    if data.upper().startswith('CDATA['):
+      self.text.append(data[len('CDATA['):])
+
+  def close(self):
+    """Flushes the rest of the input.
+
+    HTMLParser raises HTMLParseError on an unterminated entity reference at the
+    end, e.g. the &T in u'AT&T'. BeautifulSoup keeps it as text, so we do too.
+    """
+    try:
+      HTMLParser.HTMLParser.close(self)
+    except HTMLParser.HTMLParseError:
+      self.handle_data(self.rawdata)
+      self.rawdata = ''
+    self.flush()
+
+
+def _strip_html_tags(html):
+  """Returns the plain text in an HTML snippet, with entities decoded.
+
+  Args:
+    html: string
+
+  Returns: unicode string
+  """
+  if not html:
+    return html
+  if isinstance(html, str):
+    html = html.decode('utf-8')
+  if ('<' not in html and '&' not in html and
+      html.strip(_HTMLTextExtractor.ASCII_SPACES)):
+    return html
+
+  extractor = _HTMLTextExtractor()
+  try:
+    extractor.feed(html)
+    extractor.close()
+  except HTMLParser.HTMLParseError:
+    logging.info("Couldn't parse %r, falling back to BeautifulSoup", html,
+                 exc_info=True)
+    import bs4
+    return bs4.BeautifulSoup(html, 'html.parser').get_text('')
+
+  return u''.join(extractor.text)
+
+
 def activities_to_atom(activities, actor, title=None, request_url=None,
                        host_url=None):
   """Converts ActivityStreams activites to an Atom feed.
@@ -39,67 +201,90 @@ def activities_to_atom(activities, actor, title=None, request_url=None,
 
   Returns: unicode string with Atom XML
   """
+  return jinja_env.get_template(ATOM_TEMPLATE_FILE).render(
+    **_template_vars(activities, actor, title=title, request_url=request_url,
+                     host_url=host_url))
+
+
+def activities_to_atom_iter(activities, actor, **kwargs):
+  """Converts ActivityStreams activites to an Atom feed, incrementally.
+
+  Same as activities_to_atom(), except it generates the feed in chunks as it
+  goes instead of building it all up front, and each activity is only prepared
+  when the feed reaches it. Useful for writing big feeds out directly.
+
+  Args: see activities_to_atom()
+
+  Returns: generator of unicode strings with Atom XML
+  """
+  return jinja_env.get_template(ATOM_TEMPLATE_FILE).generate(
+    **_template_vars(activities, actor, **kwargs))
+
+
+def _template_vars(activities, actor, title=None, request_url=None,
+                   host_url=None):
+  """Returns the template variables for activities_to_atom*().
+
+  Args: see activities_to_atom()
+
+  Returns: dict
+  """
   # Strip query params from URLs so that we don't include access tokens, etc
   host_url = (_remove_query_params(host_url) if host_url
               else 'https://github.com/snarfed/granary')
   request_url = _remove_query_params(request_url) if request_url else host_url
 
-  for a in activities:
-    act_type = source.object_type(a)
-    if not act_type or act_type == 'post':
-      primary = a.get('object', {})
-    else:
-      primary = a
-    obj = a.setdefault('object', {})
-    # Render content as HTML; escape &s
-    rendered = []
-
-    rendered.append(microformats2.render_content(primary))
-    obj['rendered_content'] = _encode_ampersands('\n'.join(rendered))
-
-    # Make sure every activity has the title field, since Atom <entry> requires
-    # the title element.
-    if not a.get('title'):
-      a['title'] = util.ellipsize(_encode_ampersands(
-        a.get('displayName') or a.get('content') or obj.get('title') or
-        obj.get('displayName') or obj.get('content') or 'Untitled'))
-
-    # strip HTML tags. the Atom spec says title is plain text:
-    # http://atomenabled.org/developers/syndication/#requiredEntryElements
-    a['title'] = xml.sax.saxutils.escape(
-      BeautifulSoup(a['title'], 'html.parser').get_text(''))
-
-    # Normalize attachments.image to always be a list.
-    for att in primary.get('attachments', []):
-      image = att.get('image')
-      if image and not isinstance(image, list):
-        att['image'] = [image]
-
-  # Emulate Django template behavior that returns a special default value that
-  # can continue to be referenced when an attribute or item lookup fails. Helps
-  # avoid conditionals in the template itself.
-  # https://docs.djangoproject.com/en/1.8/ref/templates/language/#variables
-  class Defaulter(collections.defaultdict):
-    def __init__(self, **kwargs):
-      super(Defaulter, self).__init__(Defaulter, **{
-        k: (Defaulter(**v) if isinstance(v, dict) else v)
-        for k, v in kwargs.items()})
-
-    def __unicode__(self):
-      return super(Defaulter, self).__unicode__() if self else u''
-
-  env = jinja2.Environment(loader=jinja2.PackageLoader(__package__, 'templates'),
-                           autoescape=True)
   if actor is None:
     actor = {}
-  return env.get_template(ATOM_TEMPLATE_FILE).render(
-    items=[Defaulter(**a) for a in activities],
-    host_url=host_url,
-    request_url=request_url,
-    title=title or 'User feed for ' + source.Source.actor_name(actor),
-    updated=activities[0]['object'].get('published', '') if activities else '',
-    actor=Defaulter(**actor),
-    )
+  return {
+    'items': (Defaulter(**_prepare_activity(a)) for a in activities),
+    'host_url': host_url,
+    'request_url': request_url,
+    'title': title or 'User feed for ' + source.Source.actor_name(actor),
+    'updated': (activities[0].get('object', {}).get('published', '')
+                if activities else ''),
+    'actor': Defaulter(**actor),
+  }
+
+
+def _prepare_activity(a):
+  """Populates the fields the Atom template needs in an activity, in place.
+
+  Args:
+    a: ActivityStreams activity dict
+
+  Returns: the same activity dict
+  """
+  act_type = source.object_type(a)
+  if not act_type or act_type == 'post':
+    primary = a.get('object', {})
+  else:
+    primary = a
+  obj = a.setdefault('object', {})
+  # Render content as HTML; escape &s
+  rendered = []
+
+  rendered.append(microformats2.render_content(primary))
+  obj['rendered_content'] = _encode_ampersands('\n'.join(rendered))
+
+  # Make sure every activity has the title field, since Atom <entry> requires
+  # the title element.
+  if not a.get('title'):
+    a['title'] = util.ellipsize(_encode_ampersands(
+      a.get('displayName') or a.get('content') or obj.get('title') or
+      obj.get('displayName') or obj.get('content') or 'Untitled'))
+
+  # strip HTML tags. the Atom spec says title is plain text:
+  # http://atomenabled.org/developers/syndication/#requiredEntryElements
+  a['title'] = xml.sax.saxutils.escape(_strip_html_tags(a['title']))
+
+  # Normalize attachments.image to always be a list.
+  for att in primary.get('attachments', []):
+    image = att.get('image')
+    if image and not isinstance(image, list):
+      att['image'] = [image]
+
+  return a
 
 
 def _remove_query_params(url):
@@ -72,6 +72,7 @@ API_COMMENTS_ALL = 'comments?filter=stream&ids=%s'
 # there's no way to ask for that. :/
 # https://developers.facebook.com/docs/graph-api/using-graph-api/v2.1#fields
 API_EVENT = '%s?fields=comments,description,end_time,id,likes,name,owner,picture,privacy,start_time,timezone,updated_time,venue'
+API_EVENTS = '?ids=%s&fields=comments,description,end_time,id,likes,name,owner,picture,privacy,start_time,timezone,updated_time,venue'
 # WARNING: this edge is deprecated in API v2.4 and will stop working in 2017.
 # https://developers.facebook.com/docs/apps/changelog#v2_4_deprecations
 API_EVENT_RSVPS = '%s/invited'
@@ -94,6 +95,16 @@ API_COMMENT_FIELDS = ('id', 'message', 'from', 'created_time', 'message_tags',
                       'parent')
 
 MAX_IDS = 50  # for the ids query param
+MAX_BATCH_REQUESTS = 50  # per batch API call
+
+# When a caller asks for more than the first page of an event's RSVPs, e.g.
+# get_event(), stop after this many. Big events can have tens of thousands.
+# https://github.com/snarfed/bridgy/issues/77
+MAX_EVENT_RSVPS = 1000
+
+# How long to cache which post id formats work in Facebook.post_id_cache, in
+# seconds.
+POST_ID_CACHE_TIME = 24 * 60 * 60
 
 # Maps Facebook Graph API type, status_type, or Open Graph data type to
 # ActivityStreams objectType.
@@ -148,6 +159,7 @@ class Facebook(source.Source):
 
   DOMAIN = 'facebook.com'
   NAME = 'Facebook'
+  RESPONSE_COUNTS_PREFIX = 'AF'
   FRONT_PAGE_TEMPLATE = 'templates/facebook_index.html'
 
   # HTML snippet for embedding a post.
@@ -162,6 +174,11 @@ class Facebook(source.Source):
   </div>
   """
 
+  # caches which id formats work when fetching a single post, keyed by user id
+  # and activity id. shared across instances. can be replaced with any object
+  # that implements the memcache get() and set() methods.
+  post_id_cache = source.LRUCache()
+
   def __init__(self, access_token=None):
     """Constructor.
 
@@ -195,7 +212,8 @@ class Facebook(source.Source):
                               etag=None, min_id=None, cache=None,
                               fetch_replies=False, fetch_likes=False,
                               fetch_shares=False, fetch_events=False,
-                              search_query=None, event_owner_id=None):
+                              search_query=None, event_owner_id=None,
+                              page_params=None):
     """Fetches posts and converts them to ActivityStreams activities.
 
     See method docstring in source.py for details.
@@ -206,6 +224,9 @@ class Facebook(source.Source):
 
     Threaded comments, ie comments in reply to other top-level comments, require
     an additional API call, so they're only included if fetch_replies is True.
+    If cache is provided, they're only fetched for posts whose updated_time has
+    changed since the last fetch. Likewise, shares are only fetched for posts
+    whose share count has changed.
 
     Additional args:
       event_owner_id: string. if provided, only events owned by this user id
@@ -213,11 +234,22 @@ class Facebook(source.Source):
         non-indieweb events with tons of attendees that put us over app engine's
         instance memory limit. details:
         https://github.com/snarfed/bridgy/issues/77
+      page_params: dict of query params for the next page of the feed, from the
+        'next_page_params' field of the previous page's response. Used by
+        iter_activities(). Overrides start_index. Only the first page of @self
+        includes uploaded photos and events.
+
+    If the feed has another page, the response includes its query params in
+    'next_page_params', from the Graph API's paging.next URL.
+    https://developers.facebook.com/docs/graph-api/using-graph-api#paging
     """
     if search_query:
       raise NotImplementedError()
 
     activities = []
+    events = []
+    paging = {}
+    fetched_posts = False  # whether the feed had posts, before filtering
     if activity_id:
       # Sometimes Facebook requires post ids in USERID_POSTID format; sometimes
       # it doesn't accept that format. I can't tell which is which yet, so try
@@ -239,57 +271,90 @@ class Facebook(source.Source):
       else:
         ids_to_try = ['_'.join((user_id, activity_id)), activity_id]
 
-      post = {}
-      for id in ids_to_try:
+      # Fetch them all at once, then merge them in order of priority. Remember
+      # which ones Facebook rejected so that later fetches of the same post skip
+      # them. Transient failures, e.g. timeouts and 5xxes, don't count.
+      cache_key = 'FBID %s %s' % (user_id, activity_id)
+      ids_to_try = self.post_id_cache.get(cache_key) or ids_to_try
+
+      def fetch(id):
+        """Returns (response or None, whether Facebook rejected this id)."""
         try:
           resp = self.urlopen(id)
           if resp.get('error'):
             logging.warning("Couldn't fetch object %s: %s", id, resp)
-          else:
-            post.update(resp)
+            return None, True
+          return resp, False
+        except urllib2.HTTPError, e:
+          logging.warning("Couldn't fetch object %s: %s", id, e)
+          return None, e.code / 100 == 4
         except urllib2.URLError, e:
           logging.warning("Couldn't fetch object %s: %s", id, e)
+          return None, False
 
+      post = {}
+      keep = []
+      for id, (resp, rejected) in zip(ids_to_try,
+                                      source.parallel_map(fetch, ids_to_try)):
+        if resp:
+          post.update(resp)
+        if not rejected:
+          keep.append(id)
+
+      if post and keep:
+        self.post_id_cache.set(cache_key, keep, time=POST_ID_CACHE_TIME)
       posts = [post] if post else []
 
     else:
       url = API_SELF_POSTS if group_id == source.SELF else API_HOME
-      url = url % (user_id if user_id else 'me', start_index)
+      if page_params:
+        url = '%s?%s' % (url.split('?')[0] % (user_id if user_id else 'me'),
+                         urllib.urlencode(sorted(page_params.items())))
+      else:
+        url = url % (user_id if user_id else 'me', start_index)
       if count:
         url = util.add_query_params(url, {'limit': count})
       headers = {'If-None-Match': etag} if etag else {}
-      try:
-        resp = self.urlopen(url, headers=headers, parse_response=False)
-        etag = resp.info().get('ETag')
-        posts = json.loads(resp.read()).get('data', [])
-      except urllib2.HTTPError, e:
-        if e.code == 304:  # Not Modified, from a matching ETag
-          posts = []
-        else:
-          raise
-
-      if group_id == source.SELF:
-        # TODO: save and use ETag for all of these extra calls
-        # TODO: use batch API to get photos, events, etc in one request
-        # https://developers.facebook.com/docs/graph-api/making-multiple-requests
-        self._merge_photos(posts)
-        if fetch_events:
-          activities.extend(self._get_events(owner_id=event_owner_id))
+
+      if group_id == source.SELF and not page_params:
+        # fetch the feed, photos, and events together in one batch request.
+        # later pages only need the feed.
+        posts, etag, events, paging = self._get_self_batch(
+          url, headers, fetch_events, event_owner_id)
+        fetched_posts = bool(posts)
       else:
+        try:
+          resp = self.urlopen(url, headers=headers, parse_response=False)
+          etag = resp.info().get('ETag')
+          feed = json.loads(resp.read())
+          posts = feed.get('data', [])
+          paging = feed.get('paging', {})
+        except urllib2.HTTPError, e:
+          if e.code == 304:  # Not Modified, from a matching ETag
+            posts = []
+          else:
+            raise
+
+        fetched_posts = bool(posts)
+
         # for group feeds, filter out some shared_story posts because they tend
         # to be very tangential - friends' likes, related posts, etc.
         #
         # don't do it for individual people's feeds, e.g. the current user's,
         # because posts with attached links are also status_type == shared_story
-        posts = [p for p in posts if not p.get('status_type') == 'shared_story']
+        if group_id != source.SELF:
+          posts = [p for p in posts
+                   if not p.get('status_type') == 'shared_story']
 
-    activities.extend(self.post_to_activity(p) for p in posts)
+    post_activities = [self.post_to_activity(p) for p in posts]
 
-    id_to_activity = {}
-    for post, activity in zip(posts, activities):
+    id_to_activity = collections.OrderedDict()  # so ids are in a stable order
+    id_to_post = {}
+    for post, activity in zip(posts, post_activities):
       id = post.get('id', '').split('_', 1)[-1]  # strip any USERID_ prefix
       if id:
         id_to_activity[id] = activity
+        id_to_post[id] = post
 
     # don't fetch extras for Facebook notes. if you pass /comments a note id, it
     # 400s with "notes API is deprecated for versions ..."
@@ -300,35 +365,80 @@ class Facebook(source.Source):
     non_note_ids = [id for id, activity in id_to_activity.items()
                     if activity.get('object', {}).get('objectType') != 'article']
 
-    if non_note_ids and fetch_shares:
-      # some sharedposts requests 400, not sure why.
+    # skip shares and comments for posts whose share count and updated_time
+    # haven't changed since we last fetched them. updated_time is the time of
+    # the post's last comment.
+    counts = self.response_counts(cache, non_note_ids)
+    share_counts = {id: id_to_post[id].get('shares', {}).get('count')
+                    for id in non_note_ids}
+    comment_counts = {id: id_to_post[id].get('updated_time')
+                      for id in non_note_ids}
+    share_ids = [id for id in non_note_ids if fetch_shares and
+                 counts.changed(counts.SHARES, id, share_counts[id])]
+    comment_ids = [id for id in non_note_ids if fetch_replies and
+                   counts.changed(counts.REPLIES, id, comment_counts[id])]
+
+    shares = {}
+    comments = {}
+    if group_id == source.SELF and not activity_id:
+      # fetch the extras for posts and events together in one batch request
+      event_rsvps, shares, comments = self._get_extras_batch(
+        [event['id'] for event in events], share_ids, comment_ids)
+      activities.extend(
+        self.event_to_activity(event, rsvps=None if page is None else
+                               self._fetch_rsvps(event['id'], first_page=page))
+        for event, page in zip(events, event_rsvps))
+    else:
+      # some sharedposts and comments requests 400, not sure why.
       # https://github.com/snarfed/bridgy/issues/348
-      with util.ignore_http_4xx_error():
-        for id, shares in self._split_id_requests(API_SHARES, non_note_ids).items():
-          activity = id_to_activity.get(id)
-          if activity:
-            activity['object'].setdefault('tags', []).extend(
-              [self.share_to_object(share) for share in shares])
-
-    if non_note_ids and fetch_replies:
-      # some comments requests 400, not sure why.
-      with util.ignore_http_4xx_error():
-        for id, comments in self._split_id_requests(API_COMMENTS_ALL, non_note_ids).items():
-          activity = id_to_activity.get(id)
-          if activity:
-            replies = activity['object'].setdefault('replies', {}
-                                       ).setdefault('items', [])
-            existing_ids = {reply['fb_id'] for reply in replies}
-            for comment in comments:
-              if comment['id'] not in existing_ids:
-                replies.append(self.comment_to_object(comment))
-
+      # _split_id_requests() ignores them.
+      if share_ids:
+        shares = self._split_id_requests(API_SHARES, share_ids)
+      if comment_ids:
+        comments = self._split_id_requests(API_COMMENTS_ALL, comment_ids)
+
+    for id, objs in shares.items():
+      counts.update(counts.SHARES, id, share_counts.get(id))
+      activity = id_to_activity.get(id)
+      if activity:
+        activity['object'].setdefault('tags', []).extend(
+          [self.share_to_object(share) for share in objs])
+
+    for id, objs in comments.items():
+      counts.update(counts.REPLIES, id, comment_counts.get(id))
+      activity = id_to_activity.get(id)
+      if activity:
+        replies = activity['object'].setdefault('replies', {}
+                                   ).setdefault('items', [])
+        existing_ids = {reply['fb_id'] for reply in replies}
+        for comment in objs:
+          if comment['id'] not in existing_ids:
+            replies.append(self.comment_to_object(comment))
+
+    activities.extend(post_activities)
     response = self.make_activities_base_response(util.trim_nulls(activities))
     response['etag'] = etag
+    # keep paging even if everything on this page was filtered out
+    if fetched_posts and paging.get('next'):
+      response['next_page_params'] = {
+        name: val for name, val in urlparse.parse_qsl(
+          urlparse.urlparse(paging['next']).query)
+        if name not in ('access_token', 'limit', 'offset')}
+    counts.save()
     return response
 
-  def _merge_photos(self, posts):
-    """Fetches the current user's photos and merges them into existing posts.
+  def _get_activities_page(self, cursor, count, **kwargs):
+    """Pages through a feed with the Graph API's paging.next cursors.
+
+    See Source._get_activities_page() for details. The cursor is the
+    next_page_params field of the previous page's response.
+    """
+    resp = self.get_activities_response(count=count, page_params=cursor,
+                                        **kwargs)
+    return resp['items'], resp.get('next_page_params')
+
+  def _merge_photos(self, posts, photos):
+    """Merges the current user's photos into existing posts.
 
     Have to uploaded photos manually since facebook sometimes collapses multiple
     photos into albums, and the album post object won't have the post content,
@@ -338,9 +448,8 @@ class Facebook(source.Source):
 
     Args:
       posts: list of Facebook post object dicts
+      photos: list of Facebook photo object dicts
     """
-    photos = self.urlopen(API_PHOTOS_UPLOADED).get('data', [])
-
     # photos and photo posts stories are distinct and have separate ids. the
     # post's object_id field points to the photo's id. de-dupe by switching the
     # post to use object_id when it's provided.
@@ -366,20 +475,138 @@ class Facebook(source.Source):
       else:
         posts.append(photo)
 
+  def _get_self_batch(self, feed_url, headers, fetch_events, event_owner_id):
+    """Fetches the current user's posts, photos, and events in one batch request.
+
+    Merges photos into the posts with _merge_photos(). Uses a batch dependency
+    to fetch the events that the user has RSVPed to, since their ids come from
+    an earlier request in the same batch.
+
+    https://developers.facebook.com/docs/graph-api/making-multiple-requests#operations
+
+    Args:
+      feed_url: string relative API URL for the user's feed
+      headers: dict of HTTP headers to send with the feed request
+      fetch_events: boolean, whether to fetch events
+      event_owner_id: string. if provided, only events owned by this user id
+        will be returned.
+
+    Returns: (list of post dicts, string ETag, list of event dicts, feed paging
+      dict) tuple. The ETag is the new one from the feed, or the one in headers
+      if the feed hasn't changed.
+    """
+    requests = [{'relative_url': feed_url, 'headers': headers},
+                {'relative_url': API_PHOTOS_UPLOADED}]
+    if fetch_events:
+      requests += [{'relative_url': API_USER_RSVPS, 'name': 'rsvps',
+                    'omit_response_on_success': False},
+                   {'relative_url': API_EVENTS % '{result=rsvps:$.data.*.id}',
+                    'depends_on': 'rsvps'}]
+    resps = self.urlopen_batch_full(requests)
+
+    etag = headers.get('If-None-Match')
+    feed_resp = resps[0] or {}
+    if int(feed_resp.get('code', 0)) == 304:  # Not Modified, from a matching ETag
+      feed = {}
+    else:
+      feed = _batch_body(feed_url, feed_resp) or {}
+      etag = feed_resp.get('headers', {}).get('ETag')
+    posts = feed.get('data', [])
+
+    photos = (_batch_body(API_PHOTOS_UPLOADED, resps[1]) or {}).get('data', [])
+    self._merge_photos(posts, photos)
+
+    events = []
+    if fetch_events:
+      rsvps = (_batch_body(API_USER_RSVPS, resps[2]) or {}).get('data', [])
+      events_by_id = {}
+      if rsvps:
+        with util.ignore_http_4xx_error():
+          events_by_id = _batch_body(API_EVENTS, resps[3]) or {}
+      # have to fetch the individual event objects because the user rsvps
+      # response doesn't include the event description.
+      for rsvp in rsvps:
+        id = rsvp.get('id')
+        event = events_by_id.get(id) if id else None
+        if not event or event.get('error'):
+          logging.warning("Couldn't fetch event %s: %s", id, event)
+        elif self._is_event_owner(event, event_owner_id):
+          events.append(event)
+
+    return posts, etag, events, feed.get('paging', {})
+
+  def _get_extras_batch(self, event_ids, share_ids, comment_ids):
+    """Fetches event RSVPs, shares, and comments in one batch request.
+
+    4xx errors are ignored; the corresponding RSVPs, shares, or comments are
+    just omitted.
+
+    Args:
+      event_ids: sequence of string event ids to fetch RSVPs for
+      share_ids: sequence of string post ids to fetch shares for
+      comment_ids: sequence of string post ids to fetch comments for
+
+    Returns: (list of first pages of RSVPs, one for each event id, or None if
+              unknown;
+              dict mapping post id to list of shares;
+              dict mapping post id to list of comments) tuple
+    """
+    rsvp_urls = [API_EVENT_RSVPS % id for id in event_ids]
+    share_urls = self._split_id_urls(API_SHARES, share_ids)
+    comment_urls = self._split_id_urls(API_COMMENTS_ALL, comment_ids)
+
+    urls = rsvp_urls + share_urls + comment_urls
+    if not urls:
+      return [], {}, {}
+
+    bodies = []
+    for url, resp in zip(urls, self.urlopen_batch_full(
+        [{'relative_url': url} for url in urls])):
+      body = None
+      with util.ignore_http_4xx_error():
+        body = _batch_body(url, resp)
+      bodies.append(body)
+
+    rsvp_bodies = bodies[:len(rsvp_urls)]
+    share_bodies = bodies[len(rsvp_urls):len(rsvp_urls) + len(share_urls)]
+    comment_bodies = bodies[len(rsvp_urls) + len(share_urls):]
+    return ([body if body and 'data' in body else None for body in rsvp_bodies],
+            self._merge_id_responses(share_bodies),
+            self._merge_id_responses(comment_bodies))
+
   def _split_id_requests(self, api_call, ids):
     """Splits an API call into multiple to stay under the MAX_IDS limit per call.
 
+    Makes the calls concurrently. If any of them return HTTP 4xx, ignores them
+    and omits their results.
+
     https://developers.facebook.com/docs/graph-api/using-graph-api#multiidlookup
 
     Args:
       api_call: string with %s placeholder for ids query param
       ids: sequence of string ids
 
-    Returns: merged list of objects from the responses' 'data' fields
+    Returns: dict mapping id to merged list of objects from the responses'
+      'data' fields. Objects from multiple calls are merged in call order.
     """
+    def fetch(url):
+      with util.ignore_http_4xx_error():
+        return self.urlopen(url)
+
+    return self._merge_id_responses(
+      source.parallel_map(fetch, self._split_id_urls(api_call, ids)))
+
+  @staticmethod
+  def _split_id_urls(api_call, ids):
+    """Returns relative API URLs for ids, with at most MAX_IDS in each."""
+    return [api_call % ','.join(ids[i:i + MAX_IDS])
+            for i in range(0, len(ids), MAX_IDS)]
+
+  @staticmethod
+  def _merge_id_responses(resps):
+    """Merges multiple id lookup responses into a dict of id to objects."""
     results = {}
-    for i in range(0, len(ids), MAX_IDS):
-      resp = self.urlopen(api_call % ','.join(ids[i:i + MAX_IDS]))
+    for resp in resps:
       # usually the response is a dict, but when it's empty, it's a list. :(
       if resp:
         for id, objs in resp.items():
@@ -387,33 +614,14 @@ class Facebook(source.Source):
 
     return results
 
-  def _get_events(self, owner_id=None):
-    """Fetches the current user's events.
-
-    https://developers.facebook.com/docs/graph-api/reference/user/events/
-    https://developers.facebook.com/docs/graph-api/reference/event#edges
-
-    TODO: also fetch and use API_USER_RSVPS_DECLINED
-
-    Args:
-      owner_id: string. if provided, only returns events owned by this user
-
-    Returns:
-      posts: list of Facebook post object dicts
-    """
-    rsvps = self.urlopen(API_USER_RSVPS).get('data', [])
-
-    # have to re-fetch the individual event objects because the user rsvps
-    # response doesn't include the event description.
-    return util.trim_nulls([self.get_event(rsvp['id'], owner_id=owner_id)
-                            for rsvp in rsvps if rsvp.get('id')])
-
-  def get_event(self, event_id, owner_id=None):
+  def get_event(self, event_id, owner_id=None, max_rsvps=MAX_EVENT_RSVPS):
     """Returns a Facebook event post.
 
     Args:
       id: string, site-specific event id
       owner_id: string
+      max_rsvps: integer, maximum number of RSVPs to include. None means only
+        the first page.
 
     Returns: dict, decoded ActivityStreams activity, or None if the event is not
       found or is owned by a different user than owner_id (if provided)
@@ -426,17 +634,78 @@ class Facebook(source.Source):
       logging.warning("Couldn't fetch event %s: %s", event_id, event)
       return None
 
+    if not self._is_event_owner(event, owner_id):
+      return None
+
+    return self.event_to_activity(
+      event, rsvps=self._fetch_rsvps(event_id, max_rsvps=max_rsvps))
+
+  def iter_rsvps(self, event, max_rsvps=MAX_EVENT_RSVPS):
+    """Generator that fetches an event's RSVPs and yields them one at a time.
+
+    Fetches one page at a time, following the Graph API's paging cursors, so
+    only one page is held in memory at once.
+
+    Args:
+      event: Facebook event object. May contain only a single 'id' element.
+      max_rsvps: integer, stop after yielding this many. None means only the
+        first page.
+
+    Yields: ActivityStreams RSVP activity objects
+    """
+    for rsvp in self._fetch_rsvps(event['id'], max_rsvps=max_rsvps):
+      yield self.rsvp_to_object(rsvp, event=event)
+
+  def _fetch_rsvps(self, event_id, max_rsvps=None, first_page=None):
+    """Returns an iterator that fetches an event's RSVPs lazily, page by page.
+
+    Only fetches the first page by default, which is what get_activities()
+    needs. Pages deeper only when max_rsvps is set.
+
+    4xx errors are ignored; they just end the RSVPs early.
+
+    Args:
+      event_id: string
+      max_rsvps: integer, return at most this many. None means only the first
+        page.
+      first_page: dict, optional already fetched first page of RSVPs
+
+    Returns: iterator of decoded JSON Facebook RSVP dicts
+    """
+    def pages():
+      page = first_page
+      url = API_EVENT_RSVPS % event_id
+      while True:
+        if page is None:
+          with util.ignore_http_4xx_error():
+            page = self.urlopen(url)
+          if page is None:
+            return
+        yield page
+
+        if max_rsvps is None:
+          return
+        paging = page.get('paging', {})
+        after = paging.get('cursors', {}).get('after')
+        if not after or 'next' not in paging:
+          return
+        url = util.add_query_params(API_EVENT_RSVPS % event_id, {'after': after})
+        page = None
+
+    # islice stops as soon as it has max_rsvps, before fetching another page
+    rsvps = itertools.chain.from_iterable(p.get('data', []) for p in pages())
+    return itertools.islice(rsvps, max_rsvps)
+
+  @staticmethod
+  def _is_event_owner(event, owner_id):
+    """Returns True if owner_id is None or owns the given Facebook event dict.
+    """
     event_owner_id = event.get('owner', {}).get('id')
     if owner_id and event_owner_id != owner_id:
       logging.info('Ignoring event %s owned by user id %s instead of %s',
                    event.get('name') or event.get('id'), event_owner_id, owner_id)
-      return None
-
-    rsvps = None
-    with util.ignore_http_4xx_error():
-      rsvps = self.urlopen(API_EVENT_RSVPS % event_id).get('data')
-
-    return self.event_to_activity(event, rsvps=rsvps)
+      return False
+    return True
 
   def get_comment(self, comment_id, activity_id=None, activity_author_id=None):
     """Returns an ActivityStreams comment object.
@@ -733,8 +1002,7 @@ class Facebook(source.Source):
                                  appengine_config.FACEBOOK_APP_SECRET),
       }
     url = API_BASE + API_NOTIFICATION % user_id
-    resp = urllib2.urlopen(urllib2.Request(url, data=urllib.urlencode(params)),
-                           timeout=appengine_config.HTTP_TIMEOUT)
+    resp = source.urlopen(urllib2.Request(url, data=urllib.urlencode(params)))
     logging.debug('Response: %s %s', resp.getcode(), resp.read())
 
   def post_url(self, post):
@@ -1222,7 +1490,8 @@ class Facebook(source.Source):
 
     Args:
       event: dict, a decoded JSON Facebook event
-      rsvps: sequence, optional Facebook RSVPs
+      rsvps: iterable, optional Facebook RSVPs. May be a generator, e.g. from
+        _fetch_rsvps(); each RSVP is converted as it's consumed.
 
     Returns:
       an ActivityStreams object dict
@@ -1237,8 +1506,8 @@ class Facebook(source.Source):
       })
 
     if rsvps is not None:
-      rsvps = [self.rsvp_to_object(r, event=event) for r in rsvps]
-      self.add_rsvps_to_event(obj, rsvps)
+      self.add_rsvps_to_event(
+        obj, (self.rsvp_to_object(r, event=event) for r in rsvps))
 
     return self.postprocess_object(obj)
 
@@ -1478,7 +1747,7 @@ SELECT id, name, username, url, pic FROM profile WHERE id IN
         return str(resolved)
 
   def urlopen(self, relative_url, parse_response=True, **kwargs):
-    """Wraps urllib2.urlopen() and passes through the access token.
+    """Wraps source.urlopen() and passes through the access token.
 
     Returns: decoded JSON dict if parse_response is True, otherwise urlopen
       response object
@@ -1490,8 +1759,7 @@ SELECT id, name, username, url, pic FROM profile WHERE id IN
                                              self.access_token[:4] + '...')])
       url = util.add_query_params(url, [('access_token', self.access_token)])
     logging.info('Fetching %s, kwargs %s', log_url, kwargs)
-    resp = urllib2.urlopen(urllib2.Request(url, **kwargs),
-                           timeout=appengine_config.HTTP_TIMEOUT)
+    resp = source.urlopen(urllib2.Request(url, **kwargs))
     return json.loads(resp.read()) if parse_response else resp
 
   def urlopen_batch(self, urls):
@@ -1510,16 +1778,7 @@ SELECT id, name, username, url, pic FROM profile WHERE id IN
 
     """
     resps = self.urlopen_batch_full([{'relative_url': url} for url in urls])
-
-    bodies = []
-    for url, resp in zip(urls, resps):
-      code = int(resp.get('code', 0))
-      body = resp.get('body')
-      if code / 100 in (4, 5):
-        raise urllib2.HTTPError(url, code, body, resp.get('headers'), None)
-      bodies.append(body)
-
-    return bodies
+    return [_batch_body(url, resp) for url, resp in zip(urls, resps)]
 
   def urlopen_batch_full(self, requests):
     """Sends a batch of multiple API calls using Facebook's batch API.
@@ -1540,9 +1799,14 @@ SELECT id, name, username, url, pic FROM profile WHERE id IN
          ...
         ]
 
+    Facebook allows at most MAX_BATCH_REQUESTS requests per batch, so larger
+    batches are split up and sent separately. Requests with dependencies must be
+    in the same MAX_BATCH_REQUESTS sized chunk.
+
     Returns: sequence of dict responses in Facebook's batch format, except that
       body is JSON-decoded if possible, and headers is a single dict, not a list
-      of dicts.
+      of dicts. Responses that Facebook omits, e.g. for named requests, are
+      None.
 
       [{'code': 200,
         'headers': {'ETag': 'xyz', ...},
@@ -1559,11 +1823,15 @@ SELECT id, name, username, url, pic FROM profile WHERE id IN
         req['headers'] = [{'name': n, 'value': v}
                           for n, v in req['headers'].items()]
 
-    data = 'batch=' + json.dumps(util.trim_nulls(requests),
-                                 separators=(',', ':'))  # no whitespace
-    resps = self.urlopen('', data=data)
+    resps = []
+    for i in range(0, len(requests), MAX_BATCH_REQUESTS):
+      batch = util.trim_nulls(requests[i:i + MAX_BATCH_REQUESTS])
+      data = 'batch=' + json.dumps(batch, separators=(',', ':'))  # no whitespace
+      resps.extend(self.urlopen('', data=data))
 
     for resp in resps:
+      if resp is None:
+        continue
       if 'headers' in resp:
         resp['headers'] = {h['name']: h['value'] for h in resp['headers']}
 
@@ -1575,3 +1843,20 @@ SELECT id, name, username, url, pic FROM profile WHERE id IN
           pass
 
     return resps
+
+
+def _batch_body(url, resp):
+  """Returns the body of a batch API response.
+
+  Raises the appropriate urllib2.HTTPError if it has HTTP status code 4xx or 5xx.
+
+  Args:
+    url: string relative API URL of the request
+    resp: dict response in the format returned by urlopen_batch_full()
+  """
+  resp = resp or {}
+  code = int(resp.get('code', 0))
+  body = resp.get('body')
+  if code / 100 in (4, 5):
+    raise urllib2.HTTPError(url, code, body, resp.get('headers'), None)
+  return body
@@ -3,12 +3,9 @@
 
 Uses Flickr's REST API https://www.flickr.com/services/api/
 
-TODO: Fetching feeds with comments and/or favorites is very request
-intensive right now. It would be ideal to find a way to batch
-requests, make requests asynchronously, or make better calls to the
-API itself. Maybe use flickr.activity.userPhotos
-(https://www.flickr.com/services/api/flickr.activity.userPhotos.html)
-when group_id=SELF.
+Comments and favorites for the current user's own photos come from a single
+flickr.activity.userPhotos call. For other photos, they take one call per
+photo each, which are made concurrently.
 """
 
 __author__ = ['Kyle Mahan <kyle@kylewm.com>']
@@ -19,30 +16,66 @@ import functools
 import itertools
 import json
 import logging
+import re
 import requests
 import source
 import sys
-import mf2py
 import mf2util
 import urllib2
 import urlparse
+import xml.sax.saxutils
 
 import appengine_config
 from oauth_dropins.webutil import util
 from oauth_dropins import flickr_auth
 
-from apiclient.errors import HttpError
-from apiclient.http import BatchHttpRequest
+# matches <a> and <link> tags and their attributes, for rel_me_urls()
+LINK_TAG_RE = re.compile(r'<(?:a|link)\s([^>]*)>', re.I)
+ATTR_RE = re.compile(r"""([\w:-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+
+
+def rel_me_urls(html, base_url):
+  """Returns the rel=me URLs in an HTML document, in order, without duplicates.
+
+  Much cheaper than a full mf2py.parse() when all we need is rels.me, e.g. for
+  profile pages. Relative URLs are resolved against base_url.
+  """
+  urls = []
+  for tag in LINK_TAG_RE.finditer(html):
+    attrs = {match.group(1).lower(): ''.join(match.groups('')[1:])
+             for match in ATTR_RE.finditer(tag.group(1))}
+    if 'me' in attrs.get('rel', '').lower().split() and 'href' in attrs:
+      url = urlparse.urljoin(base_url, xml.sax.saxutils.unescape(
+        attrs['href'].strip(), {'&quot;': '"', '&#39;': "'"}))
+      if url not in urls:
+        urls.append(url)
+  return urls
 
 
 class Flickr(source.Source):
 
   DOMAIN = 'flickr.com'
   NAME = 'Flickr'
+  RESPONSE_COUNTS_PREFIX = 'AK'
 
   API_EXTRAS = ','.join(('date_upload', 'date_taken', 'views', 'media',
                          'description', 'tags', 'machine_tags', 'geo',
-                         'path_alias'))
+                         'path_alias', 'count_comments', 'count_faves'))
+
+  # How long to cache the rel=me URLs from users' profile pages, in seconds.
+  PROFILE_URLS_CACHE_TIME = 24 * 60 * 60
+
+  # caches user_to_actor()'s rel=me URLs from profile pages, keyed by nsid.
+  # shared across instances. can be replaced with any object that implements
+  # the memcache get() and set() methods.
+  profile_urls_cache = source.LRUCache()
+
+  # How far back flickr.activity.userPhotos looks for comments and faves on the
+  # current user's photos, how many photos to ask for per page, and the most
+  # pages to fetch. Photos whose responses aren't all found there fall back to
+  # per-photo calls.
+  USER_PHOTOS_TIMEFRAME = '7d'
+  USER_PHOTOS_PER_PAGE = 50
 
   def __init__(self, access_token_key, access_token_secret,
                user_id=None, path_alias=None):
@@ -269,8 +302,13 @@ class Flickr(source.Source):
                               etag=None, min_id=None, cache=None,
                               fetch_replies=False, fetch_likes=False,
                               fetch_shares=False, fetch_events=False,
-                              search_query=None):
+                              search_query=None, page=None):
     """Get Flickr actvities
+
+    Additional args:
+      page: int, 1-based page number, with count photos per page. Used by
+        iter_activities(). Ignored for @friends, since
+        flickr.photos.getContactsPhotos doesn't support paging.
     """
     if user_id is None:
       user_id = 'me'
@@ -285,7 +323,7 @@ class Flickr(source.Source):
       method = 'flickr.photos.getInfo'
     else:
       params['extras'] = self.API_EXTRAS
-      params['per_page'] = 50
+      params['per_page'] = count or 50
       if group_id == source.SELF:
         params['user_id'] = user_id
         method = 'flickr.people.getPhotos'
@@ -293,47 +331,154 @@ class Flickr(source.Source):
         method = 'flickr.photos.getContactsPhotos'
       if group_id == source.ALL:
         method = 'flickr.photos.getRecent'
+      if page is not None and group_id != source.FRIENDS:
+        params['page'] = page
 
     if not method:
       raise NotImplementedError()
 
     photos_resp = self.call_api_method(method, params)
 
-    result = {'items': []}
     if activity_id:
       photos = [photos_resp.get('photo', {})]
     else:
       photos = photos_resp.get('photos', {}).get('photo', [])
 
+    # skip comments and favorites for photos whose counts haven't changed.
+    # photo lists include counts via the count_* extras, getInfo only includes
+    # the number of comments.
+    counts = self.response_counts(cache, [p.get('id') for p in photos])
+    activities = [self.photo_to_activity(p) for p in photos]
+
+    to_fetch = []  # (photo id, response count type) tuples
     for photo in photos:
-      activity = self.photo_to_activity(photo)
-
-      # TODO consider using 'flickr.activity.userPhotos' when group_id=@self,
-      # gives all recent comments and faves, instead of hitting the API for
-      # each photo
-      if fetch_replies:
-        replies = []
-        comments_resp = self.call_api_method('flickr.photos.comments.getList', {
-          'photo_id': photo.get('id'),
-        })
-        for comment in comments_resp.get('comments', {}).get('comment', []):
-          replies.append(self.comment_to_object(comment, photo.get('id')))
+      id = photo.get('id')
+      if fetch_replies and counts.changed(counts.REPLIES, id,
+                                          self._num_comments(photo)):
+        to_fetch.append((id, counts.REPLIES))
+      if fetch_likes and counts.changed(counts.LIKES, id,
+                                        photo.get('count_faves')):
+        to_fetch.append((id, counts.LIKES))
+
+    id_to_photo = {p.get('id'): (p, a) for p, a in zip(photos, activities)}
+    resps = [None] * len(to_fetch)
+
+    if (len(to_fetch) > 1 and group_id == source.SELF and not activity_id and
+        user_id in ('me', self._user_id)):
+      # one call for recent comments and faves on all of the user's photos.
+      # only use them for photos where that's all of them. not worth it if
+      # there's only one photo response list to fetch anyway.
+      comments, faves = self._get_user_photos_responses()
+      for i, (id, type) in enumerate(to_fetch):
+        photo = id_to_photo[id][0]
+        if type == counts.REPLIES:
+          found, expected = comments.get(id, []), self._num_comments(photo)
+          resp = {'comments': {'comment': found}}
+        else:
+          found, expected = faves.get(id, []), photo.get('count_faves')
+          resp = {'photo': {'person': found}}
+        if expected is not None and len(found) >= int(expected):
+          resps[i] = resp
+
+    def fetch(id_and_type):
+      id, type = id_and_type
+      method = ('flickr.photos.comments.getList' if type == counts.REPLIES
+                else 'flickr.photos.getFavorites')
+      return self.call_api_method(method, {'photo_id': id})
+
+    missing = [i for i, resp in enumerate(resps) if resp is None]
+    for i, resp in zip(missing, source.parallel_map(
+        fetch, [to_fetch[i] for i in missing])):
+      resps[i] = resp
+
+    for (id, type), resp in zip(to_fetch, resps):
+      photo, activity = id_to_photo[id]
+      if type == counts.REPLIES:
+        replies = [self.comment_to_object(comment, id) for comment in
+                   resp.get('comments', {}).get('comment', [])]
         activity['object']['replies'] = {
           'items': replies,
           'totalItems': len(replies),
         }
-
-      if fetch_likes:
-        faves_resp = self.call_api_method('flickr.photos.getFavorites', {
-          'photo_id': photo.get('id'),
-        })
-        for person in faves_resp.get('photo', {}).get('person', []):
+        counts.update(counts.REPLIES, id, self._num_comments(photo))
+      else:
+        for person in resp.get('photo', {}).get('person', []):
           activity['object'].setdefault('tags', []).append(
             self.like_to_object(person, activity))
+        counts.update(counts.LIKES, id, photo.get('count_faves'))
+
+    counts.save()
+    # don't let trim_nulls() remove items entirely if there are no photos
+    return {'items': util.trim_nulls(activities)}
+
+  @staticmethod
+  def _num_comments(photo):
+    """Returns a photo's number of comments, or None if unknown."""
+    return photo.get('count_comments', photo.get('comments', {}).get('_content'))
+
+  def _get_user_photos_responses(self):
+    """Fetches recent comments and faves on the current user's photos.
 
-      result['items'].append(activity)
+    Makes a single flickr.activity.userPhotos call instead of one call per
+    photo per response type. Only includes the first page of responses from
+    the last USER_PHOTOS_TIMEFRAME, so callers should check that they found all
+    of a photo's responses before using them.
 
-    return util.trim_nulls(result)
+    https://www.flickr.com/services/api/flickr.activity.userPhotos.html
+
+    Returns: (comments, faves) tuple of dicts that map photo id to a list of
+      comments in flickr.photos.comments.getList format and a list of people in
+      flickr.photos.getFavorites format, respectively
+    """
+    resp = self.call_api_method('flickr.activity.userPhotos', {
+      'timeframe': self.USER_PHOTOS_TIMEFRAME,
+      'per_page': self.USER_PHOTOS_PER_PAGE,
+    })
+    items = resp.get('items', {}).get('item', [])
+
+    comments = {}
+    faves = {}
+    for item in items:
+      id = item.get('id')
+      for event in item.get('activity', {}).get('event', []):
+        if event.get('type') == 'comment':
+          comments.setdefault(id, []).append({
+            'id': event.get('commentid'),
+            'author': event.get('user'),
+            'authorname': event.get('username'),
+            'realname': event.get('realname'),
+            'datecreate': event.get('dateadded'),
+            'iconserver': event.get('iconserver'),
+            'iconfarm': event.get('iconfarm'),
+            'permalink': '%s#comment%s' % (
+              self.photo_url(item.get('owner'), id), event.get('commentid')),
+            '_content': event.get('_content'),
+          })
+        elif event.get('type') == 'fave':
+          faves.setdefault(id, []).append({
+            'nsid': event.get('user'),
+            'username': event.get('username'),
+            'realname': event.get('realname'),
+            'iconserver': event.get('iconserver'),
+            'iconfarm': event.get('iconfarm'),
+            'favedate': event.get('dateadded'),
+          })
+
+    return comments, faves
+
+  def _get_activities_page(self, cursor, count, **kwargs):
+    """Pages through photos with Flickr's page parameter.
+
+    See Source._get_activities_page() for details. The cursor is the page
+    number.
+    """
+    if kwargs.get('group_id') in (None, source.FRIENDS):
+      # flickr.photos.getContactsPhotos doesn't page
+      return self.get_activities(count=count, **kwargs), None
+
+    page = cursor or 1
+    activities = self.get_activities(count=count, page=page, **kwargs)
+    return activities, page + 1 if len(activities) >= count else None
 
   def get_actor(self, user_id=None):
     """Get an ActivityStreams object of type 'person' given a Flickr user's nsid.
@@ -378,22 +523,47 @@ class Flickr(source.Source):
     # fetch profile page to get url(s)
     profile_url = person.get('profileurl', {}).get('_content')
     if profile_url:
-      try:
-        logging.debug('fetching flickr profile page %s', profile_url)
-        resp = urllib2.urlopen(
-          profile_url, timeout=appengine_config.HTTP_TIMEOUT)
-        profile_json = mf2py.parse(doc=resp, url=profile_url)
-        # personal site is likely the first non-flickr url
-        urls = profile_json.get('rels', {}).get('me', [])
+      urls = self._get_profile_urls(person.get('nsid') or profile_url,
+                                    profile_url)
+      if urls is not None:
         obj['urls'] = [{'value': u} for u in urls]
+        # personal site is likely the first non-flickr url
         obj['url'] = next(
           (u for u in urls if not u.startswith('https://www.flickr.com/')),
           None)
-      except urllib2.URLError, e:
-        logging.warning('could not fetch user homepage %s', profile_url)
 
     return self.postprocess_object(obj)
 
+  def _get_profile_urls(self, key, profile_url):
+    """Returns the rel=me URLs on a user's Flickr profile page.
+
+    Uses profile_urls_cache when possible. Failed fetches aren't cached.
+
+    Args:
+      key: string cache key, usually the user's nsid
+      profile_url: string
+
+    Returns: list of string URLs, or None if the profile page couldn't be
+      fetched
+    """
+    cache_key = 'FPU ' + key
+    urls = self.profile_urls_cache.get(cache_key)
+    if urls is not None:
+      return urls
+
+    try:
+      logging.debug('fetching flickr profile page %s', profile_url)
+      resp = source.http_request('GET', profile_url)
+      resp.raise_for_status()
+    except requests.RequestException, e:
+      logging.warning('could not fetch user homepage %s', profile_url)
+      return None
+
+    urls = rel_me_urls(resp.text, profile_url)
+    self.profile_urls_cache.set(cache_key, urls,
+                                time=self.PROFILE_URLS_CACHE_TIME)
+    return urls
+
   def get_comment(self, comment_id, activity_id, activity_author_id=None):
     """Returns an ActivityStreams comment object.
 
@@ -584,7 +754,8 @@ class Flickr(source.Source):
 
   def user_id(self):
     """Get the nsid of the currently authorized user. The first time this
-    is called, it will invoke the flickr.people.getLimits api method.
+    is called, it will invoke the flickr.people.getLimits api method, unless
+    it's in source.identity_cache.
 
     https://www.flickr.com/services/api/flickr.people.getLimits.html
 
@@ -592,13 +763,16 @@ class Flickr(source.Source):
       a string
     """
     if not self._user_id:
-      resp = self.call_api_method('flickr.people.getLimits')
-      self._user_id = resp.get('person', {}).get('nsid')
+      self._user_id = self.cached_identity(
+        'user_id', (self.access_token_key, self.access_token_secret),
+        lambda: self.call_api_method('flickr.people.getLimits'
+                                     ).get('person', {}).get('nsid'))
     return self._user_id
 
   def path_alias(self):
     """Get the path_alias of the currently authorized user. The first time this
-    is called, it will invoke the flickr.people.getInfo api method.
+    is called, it will invoke the flickr.people.getInfo api method, unless
+    it's in source.identity_cache.
 
     https://www.flickr.com/services/api/flickr.people.getInfo.html
 
@@ -606,10 +780,11 @@ class Flickr(source.Source):
       a string
     """
     if not self._path_alias:
-      resp = self.call_api_method('flickr.people.getInfo', {
-        'user_id': self.user_id(),
-      })
-      self._path_alias = resp.get('person', {}).get('path_alias')
+      self._path_alias = self.cached_identity(
+        'path_alias', (self.access_token_key, self.access_token_secret),
+        lambda: self.call_api_method('flickr.people.getInfo', {
+          'user_id': self.user_id(),
+        }).get('person', {}).get('path_alias'))
     return self._path_alias
 
   def user_url(self, user_id):
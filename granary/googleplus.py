@@ -9,7 +9,6 @@ __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
 import datetime
 import functools
-import itertools
 import json
 import re
 
@@ -32,6 +31,7 @@ class GooglePlus(source.Source):
 
   DOMAIN = 'plus.google.com'
   NAME = 'Google+'
+  RESPONSE_COUNTS_PREFIX = 'AG'
 
   # HTML snippet for embedding a post.
   # https://developers.google.com/+/web/embedded-post/
@@ -129,13 +129,8 @@ class GooglePlus(source.Source):
       else:
         raise
 
-    # batch get memcached counts of comments, likes, reshares for all activities
-    cached = {}
-    if cache is not None:
-      keys = itertools.product(('AGC', 'AGL', 'AGS'), [a['id'] for a in activities])
-      cached = cache.get_multi('%s %s' % (prefix, id) for prefix, id in keys)
-    # only update the cache at the end, in case we hit an error before then
-    cache_updates = {}
+    # batch get cached counts of comments, likes, reshares for all activities
+    counts = self.response_counts(cache, [a['id'] for a in activities])
 
     # prepare batch API requests for comments, likes and reshares
     # https://developers.google.com/api-client-library/python/guide/batch
@@ -144,7 +139,8 @@ class GooglePlus(source.Source):
       # comments
       id = activity['id']
       num_replies = activity.get('object', {}).get('replies', {}).get('totalItems')
-      if fetch_replies and num_replies and num_replies != cached.get('AGC ' + id):
+      if (fetch_replies and num_replies and
+          counts.changed(counts.REPLIES, id, num_replies)):
         call = self.auth_entity.api().comments().list(activityId=id, maxResults=500)
 
         def set_comments(req_id, resp, exc, activity=None):
@@ -152,7 +148,8 @@ class GooglePlus(source.Source):
           if exc is None:
             obj['replies']['items'] = [
               self.postprocess_comment(c) for c in resp['items']]
-            cache_updates['AGC ' + activity['id']] = obj['replies']['totalItems']
+            counts.update(counts.REPLIES, activity['id'],
+                          obj['replies']['totalItems'])
           else:
             obj.pop('replies', None)
             code, body = util.interpret_http_exception(exc)
@@ -163,13 +160,11 @@ class GooglePlus(source.Source):
 
       # likes
       if fetch_likes:
-        self.maybe_add_tags(batch, activity, cached, cache_updates,
-                            'plusoners', 'like')
+        self.maybe_add_tags(batch, activity, counts, 'plusoners', 'like')
 
       # reshares
       if fetch_shares:
-        self.maybe_add_tags(batch, activity, cached, cache_updates,
-                            'resharers', 'share')
+        self.maybe_add_tags(batch, activity, counts, 'resharers', 'share')
 
     if batch._requests:
       batch.execute(http)
@@ -179,8 +174,7 @@ class GooglePlus(source.Source):
 
     response = self.make_activities_base_response(activities)
     response['etag'] = etag
-    if cache_updates and cache is not None:
-      cache.set_multi(cache_updates)
+    counts.save()
     return response
 
   def get_comment(self, comment_id, activity_id=None, activity_author_id=None):
@@ -243,7 +237,7 @@ class GooglePlus(source.Source):
 
   user_to_actor = postprocess_actor
 
-  def maybe_add_tags(self, batch, activity, cached, cache_updates, collection, verb):
+  def maybe_add_tags(self, batch, activity, counts, collection, verb):
     """Fetches and adds 'like' or 'share' tags to an activity.
 
     Just adds a request and callback to the batch. Does not execute the batch.
@@ -255,20 +249,19 @@ class GooglePlus(source.Source):
     Args:
       batch: BatchHttpRequest
       activity: dict, G+ activity that was +1ed or reshared
-      cached: dict of cache values. (not cache object above.)
-      cache_updates: dict, values to write back to cache
+      counts: source.ResponseCounts
       collection: string, 'plusoners' or 'resharers'
       verb: string, ActivityStreams verb to populate the tags with
     """
-    # maps collection to cache prefix
-    cache_prefixes = {'plusoners': 'AGL ', 'resharers': 'AGS '}
+    # maps collection to response count type
+    count_types = {'plusoners': counts.LIKES, 'resharers': counts.SHARES}
 
     id = activity['id']
     obj = activity['object']
 
     count = obj.get(collection, {}).get('totalItems')
-    cache_key = cache_prefixes[collection] + id
-    if not count or count == cached.get(cache_key):
+    count_type = count_types[collection]
+    if not count or not counts.changed(count_type, id, count):
       return
 
     call = self.auth_entity.api().people().listByActivity(
@@ -288,7 +281,7 @@ class GooglePlus(source.Source):
             'object': {'url': obj.get('url')},
             'author': person,
             }))
-        cache_updates[cache_key] = count
+        counts.update(count_type, id, count)
       else:
         obj.pop(collection, None)
         code, body = util.interpret_http_exception(exc)
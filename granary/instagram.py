@@ -42,6 +42,7 @@ class Instagram(source.Source):
 
   DOMAIN = 'instagram.com'
   NAME = 'Instagram'
+  RESPONSE_COUNTS_PREFIX = 'AI'
   FRONT_PAGE_TEMPLATE = 'templates/instagram_index.html'
 
   EMBED_POST = """
@@ -67,8 +68,12 @@ class Instagram(source.Source):
     self.access_token = access_token
     self.allow_comment_creation = allow_comment_creation
 
-  def urlopen(self, url, **kwargs):
-    """Wraps urllib2.urlopen() and passes through the access token.
+  def urlopen(self, url, parse_response=True, **kwargs):
+    """Wraps source.urlopen() and passes through the access token.
+
+    Returns: the response's decoded JSON 'data' field if parse_response is
+      True, otherwise the urlopen response object. POSTs always return the
+      response object.
     """
     log_url = url
     if self.access_token:
@@ -77,9 +82,10 @@ class Instagram(source.Source):
       # TODO add access_token to the data parameter for POST requests
       url = util.add_query_params(url, [('access_token', self.access_token)])
     logging.info('Fetching %s, kwargs %s', log_url, kwargs)
-    resp = urllib2.urlopen(urllib2.Request(url, **kwargs),
-                           timeout=appengine_config.HTTP_TIMEOUT)
-    return resp if kwargs.get('data') else json.loads(resp.read()).get('data')
+    resp = source.urlopen(urllib2.Request(url, **kwargs))
+    if kwargs.get('data') or not parse_response:
+      return resp
+    return json.loads(resp.read()).get('data')
 
   def user_url(self, username):
     return 'http://instagram.com/' + username
@@ -95,23 +101,52 @@ class Instagram(source.Source):
     if user_id is None:
       user_id = 'self'
 
-    return self.user_to_actor(util.trim_nulls(
-      self.urlopen(API_USER_URL % user_id) or {}))
+    user = self.urlopen(API_USER_URL % user_id)
+    return self.user_to_actor(util.trim_nulls(user or {}))
+
+  def _get_user(self, user_id):
+    """Fetches a user. Caches the current user, ie 'self', across instances.
+
+    Only for filling in likes. get_actor() always fetches a fresh profile.
+
+    Args:
+      user_id: string id or username, or 'self'
+
+    Returns: decoded JSON Instagram user dict
+    """
+    if user_id != 'self':
+      return self.urlopen(API_USER_URL % user_id)
+    return self.cached_identity('user', (self.access_token,),
+                                lambda: self.urlopen(API_USER_URL % 'self'),
+                                time=source.PROFILE_CACHE_TIME)
 
   def get_activities_response(self, user_id=None, group_id=None, app_id=None,
                               activity_id=None, start_index=0, count=0,
                               etag=None, min_id=None, cache=None,
                               fetch_replies=False, fetch_likes=False,
                               fetch_shares=False, fetch_events=False,
-                              search_query=None):
+                              search_query=None, max_id=None):
     """Fetches posts and converts them to ActivityStreams activities.
 
     See method docstring in source.py for details. app_id is ignored.
     Supports min_id, but not ETag, since Instagram doesn't support it.
 
+    Additional args:
+      max_id: only return media older than this id. Used by iter_activities()
+        to page back through a feed.
+
     http://instagram.com/developer/endpoints/users/#get_users_feed
     http://instagram.com/developer/endpoints/users/#get_users_media_recent
 
+    If count is provided, follows Instagram's pagination cursors until it has
+    start_index + count media. Otherwise, returns the first page. Popular media
+    isn't paged.
+
+    Instagram truncates the comments in each media object. If fetch_replies is
+    True, the full comment lists for truncated media are fetched concurrently.
+    If cache is also provided, that's skipped for media whose comment count
+    hasn't changed.
+
     Likes are always included, regardless of the fetch_likes kwarg. They come
     bundled in the 'likes' field of the API Media object:
     http://instagram.com/developer/endpoints/media/#
@@ -137,11 +172,12 @@ class Instagram(source.Source):
           'Instagram only supports search over hashtags, so search_query must '
           'begin with the # character.')
 
-    # TODO: paging
     media = []
     kwargs = {}
     if min_id is not None:
       kwargs['min_id'] = min_id
+    if max_id is not None:
+      kwargs['max_id'] = max_id
 
     activities = []
     try:
@@ -151,18 +187,26 @@ class Instagram(source.Source):
                    API_MEDIA_SEARCH_URL % search_query if group_id == source.SEARCH else
                    API_USER_FEED_URL if group_id == source.FRIENDS else None)
       assert media_url
-      media = self.urlopen(util.add_query_params(media_url, kwargs))
-      if media:
-        if activity_id:
-          media = [media]
-        activities += [self.media_to_activity(m) for m in util.trim_nulls(media)]
-
-      if group_id == source.SELF and fetch_likes:
-        # add the user's own likes
+      if activity_id:
+        media = [self.urlopen(util.add_query_params(media_url, kwargs))]
+      elif group_id == source.ALL:
+        media = self.urlopen(util.add_query_params(media_url, kwargs))
+      else:
+        media = self._get_media(media_url, kwargs, start_index + count)
+        media = media[start_index:start_index + count if count else None]
+
+      media = util.trim_nulls(media or [])
+      if fetch_replies:
+        self._fetch_comments(media, cache)
+      activities += [self.media_to_activity(m) for m in media]
+
+      # add the user's own likes. they're paged separately, so when paging
+      # with max_id, only include them on the first page.
+      if group_id == source.SELF and fetch_likes and max_id is None:
         liked = self.urlopen(
           util.add_query_params(API_USER_LIKES_URL % user_id, kwargs))
         if liked:
-          user = self.urlopen(API_USER_URL % user_id)
+          user = self._get_user(user_id)
           activities += [self.like_to_object(user, l['id'], l['link'])
                          for l in liked]
 
@@ -184,6 +228,88 @@ class Instagram(source.Source):
     response = self.make_activities_base_response(activities)
     return response
 
+  def _get_media(self, url, params, count):
+    """Fetches media, following pagination cursors until there are count.
+
+    Args:
+      url: string API URL
+      params: dict of query params
+      count: int, number of media to fetch. 0 means just the first page.
+
+    Returns: list of decoded JSON Instagram media dicts
+    """
+    params = dict(params)
+    if count:
+      params['count'] = count
+
+    media = []
+    while True:
+      resp = json.loads(self.urlopen(util.add_query_params(url, params),
+                                     parse_response=False).read())
+      media.extend(resp.get('data') or [])
+      if not count or len(media) >= count:
+        break
+
+      # hashtag searches use max_tag_id, everything else uses max_id
+      pagination = resp.get('pagination', {})
+      if pagination.get('next_max_tag_id'):
+        params['max_tag_id'] = pagination['next_max_tag_id']
+      elif pagination.get('next_max_id'):
+        params['max_id'] = pagination['next_max_id']
+      else:
+        break
+      params['count'] = count - len(media)
+
+    return media
+
+  def _fetch_comments(self, media, cache):
+    """Replaces truncated comment lists with full ones, in place.
+
+    Fetches the comments for each media concurrently. 4xx errors are ignored;
+    those media keep their truncated comments.
+
+    Args:
+      media: sequence of decoded JSON Instagram media dicts
+      cache: the cache kwarg passed to get_activities_response(), or None
+    """
+    counts = self.response_counts(cache, [m.get('id') for m in media])
+    truncated = []
+    for m in media:
+      comments = m.get('comments', {})
+      num = comments.get('count')
+      if (num > len(comments.get('data', [])) and
+          counts.changed(counts.REPLIES, m.get('id'), num)):
+        truncated.append(m)
+
+    def fetch(m):
+      with util.ignore_http_4xx_error():
+        return self.urlopen(API_COMMENT_URL % m['id'])
+
+    for m, comments in zip(truncated, source.parallel_map(fetch, truncated)):
+      if comments is not None:
+        m['comments']['data'] = comments
+        counts.update(counts.REPLIES, m['id'], m['comments']['count'])
+
+    counts.save()
+
+  def _get_activities_page(self, cursor, count, **kwargs):
+    """Pages back through a feed with Instagram's max_id.
+
+    See Source._get_activities_page() for details. The cursor is the id of the
+    oldest media so far. Popular media isn't paged.
+    """
+    activities = self.get_activities(count=count, max_id=cursor, **kwargs)
+    if kwargs.get('group_id') == source.ALL:
+      return activities, None
+
+    next = None
+    for activity in activities:
+      parsed = util.parse_tag_uri(activity.get('id') or '')
+      if parsed and activity.get('verb') != 'like':  # skip the user's own likes
+        next = parsed[1]
+
+    return activities, next
+
   def get_comment(self, comment_id, activity_id=None, activity_author_id=None):
     """Returns an ActivityStreams comment object.
 
@@ -310,9 +436,7 @@ class Instagram(source.Source):
       self.urlopen(API_MEDIA_LIKES_URL % base_id, data=urllib.urlencode({
         'access_token': self.access_token
       }))
-      # TODO use the stored user_json rather than looking it up each time.
-      # oauth-dropins auth_entities should have the user_json.
-      me = self.urlopen(API_USER_URL % 'self')
+      me = self._get_user('self')
       return source.creation_result(
         self.like_to_object(me, base_id, base_url))
 
@@ -11,7 +11,6 @@ import string
 import re
 import xml.sax.saxutils
 
-import mf2py
 import mf2util
 from oauth_dropins.webutil import util
 import source
@@ -322,6 +321,9 @@ def html_to_activities(html, url=None):
 
   Returns: list of ActivityStreams activity dicts
   """
+  # mf2py (and its html5lib and BeautifulSoup dependencies) is slow to import
+  # and only needed here, so don't load it until the first time we parse.
+  import mf2py
   parsed = mf2py.parse(doc=html, url=url)
   hfeed = find_first_entry(parsed, ['h-feed'])
   items = hfeed.get('children', []) if hfeed else parsed.get('items', [])
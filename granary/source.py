@@ -13,10 +13,21 @@ http://activitystrea.ms/specs/json/targeting/1.0/#anchor3
 __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
 import collections
+import cookielib
 import copy
+import hashlib
+import importlib
+import json
 import logging
 import mimetypes
+import os
+import Queue
 import re
+import StringIO
+import sys
+import threading
+import time
+import urllib2
 import urlparse
 
 import requests
@@ -40,12 +51,46 @@ RSVP_TO_EVENT = {
 
 FAILED_RESOLVE_URL_CACHE_TIME = 60 * 60 * 24  # a day
 
-# maps lower case string short name to Source subclass. populated by SourceMeta.
-sources = {}
+# Max number of resolved URLs that follow_redirects() keeps in memory, in
+# redirect_cache, in front of the cache that's passed in.
+REDIRECT_CACHE_SIZE = 5000
+
+# How long to cache the current user's id, username, etc. in identity_cache,
+# in seconds. Whole user profiles change more often, so they're cached for less.
+IDENTITY_CACHE_TIME = 60 * 60  # an hour
+PROFILE_CACHE_TIME = 5 * 60
+
+# Max number of threads that parallel_map() uses to make HTTP requests
+# concurrently. Applies to every call, in addition to any per-call limit. 1
+# disables threading, ie runs every call serially in the calling thread.
+MAX_CONCURRENT_REQUESTS = 10
+
+# Connection pool sizes for http_request(). The shared session keeps a pool of
+# keep-alive connections for each of up to HTTP_POOL_HOSTS hosts, with up to
+# HTTP_POOL_MAXSIZE connections in each pool.
+HTTP_POOL_HOSTS = 20
+HTTP_POOL_MAXSIZE = MAX_CONCURRENT_REQUESTS
+
+# Max number of concurrent follow_redirects_multi() requests to any one domain,
+# across all calls.
+MAX_CONCURRENT_REQUESTS_PER_DOMAIN = 2
+
+# Default number of activities per API call for iter_activities().
+ITER_ACTIVITIES_PAGE_SIZE = 50
+
+# iter_activities() keeps following the silo's cursor past pages with no
+# activities, e.g. when everything on them was filtered out, but gives up after
+# this many in a row.
+ITER_ACTIVITIES_MAX_EMPTY_PAGES = 5
 
 CreationResult = collections.namedtuple('CreationResult', [
   'content', 'description', 'abort', 'error_plain', 'error_html'])
 
+# What follow_redirects() caches for each URL. Much smaller than a whole
+# requests.Response, both pickled and in memory.
+ResolvedURL = collections.namedtuple('ResolvedURL', [
+  'url', 'status_code', 'content_type'])
+
 
 def creation_result(content=None, description=None, abort=False,
                     error_plain=None, error_html=None):
@@ -73,6 +118,351 @@ def creation_result(content=None, description=None, abort=False,
   return CreationResult(content, description, abort, error_plain, error_html)
 
 
+def parallel_map(fn, args, max_workers=None):
+  """Calls a function on each element of a sequence, concurrently.
+
+  Uses a bounded pool of threads. If any calls raise an exception, waits for
+  the calls in progress to finish, then re-raises the exception from the first
+  failed call in args order.
+
+  Args:
+    fn: callable that takes a single argument
+    args: sequence of arguments to call fn with
+    max_workers: int, optional max number of threads to use for this call,
+      e.g. to limit concurrent requests to a single host. Never exceeds
+      MAX_CONCURRENT_REQUESTS.
+
+  Returns: list of fn's return values, in the same order as args
+  """
+  args = list(args)
+  num_threads = min(max_workers or MAX_CONCURRENT_REQUESTS,
+                    MAX_CONCURRENT_REQUESTS, len(args))
+  if num_threads <= 1:
+    return [fn(arg) for arg in args]
+
+  results = [None] * len(args)
+  errors = [None] * len(args)
+  todo = Queue.Queue()
+  for i, arg in enumerate(args):
+    todo.put((i, arg))
+
+  def worker():
+    while not any(errors):
+      try:
+        i, arg = todo.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        results[i] = fn(arg)
+      except BaseException:
+        errors[i] = sys.exc_info()
+
+  threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  for error in errors:
+    if error:
+      raise error[0], error[1], error[2]
+  return results
+
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+
+def http_session():
+  """Returns the requests.Session shared by all sources, creating it if needed.
+
+  The session only pools connections. It doesn't keep cookies.
+  """
+  global _http_session
+  with _http_session_lock:
+    if _http_session is None:
+      session = requests.Session()
+      # don't store cookies. this session is shared across users and hosts.
+      session.cookies.set_policy(
+        cookielib.DefaultCookiePolicy(allowed_domains=[]))
+      adapter = requests.adapters.HTTPAdapter(pool_connections=HTTP_POOL_HOSTS,
+                                              pool_maxsize=HTTP_POOL_MAXSIZE)
+      session.mount('http://', adapter)
+      session.mount('https://', adapter)
+      _http_session = session
+    return _http_session
+
+
+def http_request(method, url, **kwargs):
+  """Makes an HTTP request with the shared, pooled session.
+
+  Reuses keep-alive connections to each host across requests, threads, and
+  sources, so we don't pay for a new TCP connection and TLS handshake every
+  time. Logs each request's status and elapsed time.
+
+  Args:
+    method: string HTTP method, e.g. 'GET'
+    url: string
+    **kwargs: passed to requests.Session.request(). timeout defaults to
+      appengine_config.HTTP_TIMEOUT.
+
+  Returns:
+    requests.Response. Does *not* raise an exception on HTTP errors; call
+    raise_for_status() if you care.
+  """
+  kwargs.setdefault('timeout', appengine_config.HTTP_TIMEOUT)
+  start = time.time()
+  try:
+    resp = getattr(http_session(), method.lower())(url, **kwargs)
+  except BaseException, e:
+    logging.debug('%s %s failed after %.3fs: %s', method, url,
+                  time.time() - start, e)
+    raise
+  logging.debug('%s %s returned %s in %.3fs', method, url, resp.status_code,
+                time.time() - start)
+  return resp
+
+
+def urlopen(req, **kwargs):
+  """Drop in replacement for urllib2.urlopen() that uses http_request().
+
+  Lets code written against urllib2, e.g. code that reads resp.info() or
+  catches urllib2.HTTPError and checks its code, use the shared, pooled session.
+
+  Args:
+    req: string URL or urllib2.Request
+    **kwargs: passed to http_request(), e.g. timeout
+
+  Returns:
+    urllib2.addinfourl
+
+  Raises:
+    urllib2.HTTPError if the response status code isn't 2xx, urllib2.URLError
+    if the request fails, e.g. it can't connect or it times out.
+  """
+  if isinstance(req, basestring):
+    req = urllib2.Request(req)
+  url = req.get_full_url()
+  headers = dict(req.header_items())
+  # requests doesn't set a Content-Type for string bodies. urllib2 does.
+  if req.has_data() and not req.has_header('Content-type'):
+    headers['Content-type'] = 'application/x-www-form-urlencoded'
+
+  try:
+    resp = http_request(req.get_method(), url, data=req.get_data(),
+                        headers=headers, **kwargs)
+  except requests.RequestException, e:
+    raise urllib2.URLError(e)
+
+  body = StringIO.StringIO(resp.content)
+  if resp.status_code / 100 != 2:
+    raise urllib2.HTTPError(resp.url or url, resp.status_code, resp.reason,
+                            resp.headers, body)
+  return urllib2.addinfourl(body, resp.headers, resp.url or url,
+                            resp.status_code)
+
+
+class LRUCache(object):
+  """A bounded, thread safe, in memory cache with optional expiration.
+
+  Implements the parts of App Engine's memcache API that we use, ie get(),
+  get_multi(), set(), set_multi(), and delete(), so it can be used anywhere we
+  accept a memcache-like cache. Evicts the least recently used entries once it
+  holds more than max_size. Values set with a time (in seconds) expire after it.
+
+  If max_bytes is set, also evicts entries once their total size is more than
+  it. sizeof is a function that returns a value's size in bytes.
+  """
+  _now = staticmethod(time.time)  # overridden in tests
+
+  def __init__(self, max_size=1000, max_bytes=None, sizeof=len):
+    self.max_size = max_size
+    self.max_bytes = max_bytes
+    self.sizeof = sizeof
+    self._entries = collections.OrderedDict()  # maps key to (value, expires)
+    self._sizes = {}  # maps key to size in bytes, only if max_bytes is set
+    self._bytes = 0
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key):
+    with self._lock:
+      return self._get(key, self._now())
+
+  def get_multi(self, keys):
+    now = self._now()
+    with self._lock:
+      got = {key: self._get(key, now) for key in keys}
+    return {key: val for key, val in got.items() if val is not None}
+
+  def set(self, key, value, time=0):
+    self.set_multi({key: value}, time=time)
+
+  def set_multi(self, mapping, time=0):
+    expires = self._now() + time if time else None
+    with self._lock:
+      for key, value in mapping.items():
+        self._pop(key)
+        self._entries[key] = (value, expires)
+        if self.max_bytes is not None:
+          self._sizes[key] = self.sizeof(value)
+          self._bytes += self._sizes[key]
+      while (len(self._entries) > self.max_size or
+             (self.max_bytes is not None and self._bytes > self.max_bytes)):
+        self._pop(next(iter(self._entries)))
+
+  def delete(self, key):
+    with self._lock:
+      self._pop(key)
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._sizes.clear()
+      self._bytes = 0
+
+  def _get(self, key, now):
+    """Returns a value and marks it recently used. Caller must hold the lock."""
+    entry = self._entries.get(key)
+    if entry is None:
+      return None
+    value, expires = entry
+    if expires is not None and expires <= now:
+      self._pop(key)
+      return None
+    del self._entries[key]
+    self._entries[key] = entry
+    return value
+
+  def _pop(self, key):
+    """Removes and returns an entry, or None. Caller must hold the lock."""
+    self._bytes -= self._sizes.pop(key, 0)
+    return self._entries.pop(key, None)
+
+
+class FileCache(LRUCache):
+  """An LRUCache that's persisted to a JSON file, so it survives restarts.
+
+  Loads the file, if it exists, when constructed, and rewrites it after every
+  change. Keys and values must be JSON serializable. Useful for e.g. sync state
+  for pollers that don't have memcache; see Source.sync_activities_response().
+  """
+
+  def __init__(self, filename, max_size=1000):
+    super(FileCache, self).__init__(max_size=max_size)
+    self.filename = filename
+    self._save_lock = threading.Lock()
+    if os.path.exists(filename):
+      with open(filename) as f:
+        for key, value, expires in json.load(f):
+          self._entries[key] = (value, expires)
+
+  def set_multi(self, mapping, time=0):
+    super(FileCache, self).set_multi(mapping, time=time)
+    self._save()
+
+  def delete(self, key):
+    super(FileCache, self).delete(key)
+    self._save()
+
+  def clear(self):
+    super(FileCache, self).clear()
+    self._save()
+
+  def _save(self):
+    """Writes all entries to a temp file, then renames it over the real one.
+
+    The rename is atomic, so a crash partway through leaves the old file
+    intact. The temp file is synced to disk first so the rename can't land
+    before its contents do.
+    """
+    with self._save_lock:
+      with self._lock:
+        entries = [[key, value, expires] for key, (value, expires)
+                   in self._entries.items()]
+      temp = self.filename + '.tmp'
+      try:
+        with open(temp, 'w') as f:
+          json.dump(entries, f)
+          f.flush()
+          os.fsync(f.fileno())
+        os.rename(temp, self.filename)
+      except BaseException:
+        if os.path.exists(temp):
+          os.remove(temp)
+        raise
+
+
+class ResponseCounts(object):
+  """Per-post response counts, cached between polls to skip unchanged fetches.
+
+  Sources remember how many replies, likes, and shares each post had the last
+  time they fetched them, and skip fetching them again if that number hasn't
+  changed. The "count" can be any value that changes when there are new
+  responses, e.g. a last updated timestamp.
+
+  Cache keys are '[source prefix][type] [post id]', e.g. 'AIL 123' for the
+  number of likes of Instagram post 123. The source prefix is the Source
+  subclass's RESPONSE_COUNTS_PREFIX. The types are REPLIES, LIKES, and SHARES.
+  Sources can use different letters for the types in their keys with
+  RESPONSE_COUNTS_TYPES, e.g. to keep using keys they cached before.
+
+  Reads all counts with one get_multi() call up front. Updates are only written,
+  with one set_multi() call, by save(), so that nothing is cached if we hit an
+  error partway through.
+  """
+  REPLIES = 'C'
+  LIKES = 'L'
+  SHARES = 'S'
+
+  def __init__(self, cache, prefix, ids, types=None):
+    """Constructor.
+
+    Args:
+      cache: object with the memcache get_multi() and set_multi() methods, or
+        None to disable caching
+      prefix: string, the source's RESPONSE_COUNTS_PREFIX
+      ids: sequence of string post ids whose counts to load
+      types: dict, optional, the source's RESPONSE_COUNTS_TYPES
+    """
+    self.cache = cache
+    self.prefix = prefix
+    self.types = types or {}
+    self.cached = {}
+    self.updates = {}
+    if cache is not None and ids:
+      self.cached = cache.get_multi(
+        self._key(type, id) for type in (self.REPLIES, self.LIKES, self.SHARES)
+        for id in ids)
+
+  def _key(self, type, id):
+    return '%s%s %s' % (self.prefix, self.types.get(type, type), id)
+
+  def changed(self, type, id, count):
+    """Returns True if count is unknown, ie None, or differs from the cache."""
+    return count is None or count != self.cached.get(self._key(type, id))
+
+  def update(self, type, id, count):
+    """Records a new count, to be written by save()."""
+    if count is not None:
+      self.updates[self._key(type, id)] = count
+
+  def save(self):
+    """Writes all updated counts to the cache."""
+    if self.updates and self.cache is not None:
+      self.cache.set_multi(self.updates)
+
+
+# in memory cache of ResolvedURLs for follow_redirects()
+redirect_cache = LRUCache(max_size=REDIRECT_CACHE_SIZE)
+
+# in memory cache of the current user's identity for Source.cached_identity(),
+# keyed by a hash of the access token
+identity_cache = LRUCache()
+
+
 def object_type(obj):
   """Returns the object type, or the verb if it's an activity object.
 
@@ -87,6 +477,42 @@ def object_type(obj):
   return type if type and type != 'activity' else obj.get('verb')
 
 
+class SourceRegistry(dict):
+  """Maps lower case string short name to Source subclass.
+
+  Populated by SourceMeta as source modules are imported. Looking up one of the
+  built in silos that hasn't been imported yet imports its module first, so a
+  process only pays for the silo modules, and their dependencies, that it uses.
+  """
+  # maps short name to (module in this package, class name)
+  SILOS = {
+    'facebook': ('facebook', 'Facebook'),
+    'flickr': ('flickr', 'Flickr'),
+    'google+': ('googleplus', 'GooglePlus'),
+    'instagram': ('instagram', 'Instagram'),
+    'twitter': ('twitter', 'Twitter'),
+  }
+
+  def __missing__(self, name):
+    if name not in self.SILOS:
+      raise KeyError(name)
+    module, cls = self.SILOS[name]
+    package = __name__.rpartition('.')[0]
+    module = importlib.import_module('%s.%s' % (package, module) if package
+                                     else module)
+    cls = self[name] = getattr(module, cls)
+    return cls
+
+  def get(self, name, default=None):
+    try:
+      return self[name]
+    except KeyError:
+      return default
+
+
+sources = SourceRegistry()
+
+
 class SourceMeta(type):
   """Source metaclass. Registers all source classes in the sources global."""
   def __new__(meta, name, bases, class_dict):
@@ -112,8 +538,12 @@ class Source(object):
     EMBED_POST: string, the HTML for embedding a post. Should have a %(url)s
       placeholder for the post URL and (optionally) a %(content)s placeholder
       for the post content.
+    RESPONSE_COUNTS_PREFIX: string, the prefix for ResponseCounts cache keys
+    RESPONSE_COUNTS_TYPES: dict, optional, maps ResponseCounts types to the
+      letters to use for them in cache keys instead
   """
   __metaclass__ = SourceMeta
+  RESPONSE_COUNTS_TYPES = None
 
   def user_url(self, user_id):
     """Returns the URL for a user's profile."""
@@ -133,6 +563,172 @@ class Source(object):
     """
     return self.get_activities_response(*args, **kwargs)['items']
 
+  def cached_identity(self, field, tokens, fetch, time=IDENTITY_CACHE_TIME):
+    """Returns a value about the current user, cached across instances.
+
+    Sources are often constructed per request, so values like the current
+    user's id would otherwise be fetched again for every request. They're cached
+    in identity_cache, keyed by source, field, and a hash of the access token,
+    so the token itself is never stored. Returns a copy of the cached value, so
+    callers can modify it.
+
+    Args:
+      field: string, name of the value, e.g. 'user_id'
+      tokens: sequence of string access token parts that identify the user,
+        e.g. (key, secret). If any are empty, the value isn't cached.
+      fetch: callable that takes no args and fetches the value. None isn't
+        cached.
+      time: integer, how long to cache the value, in seconds
+
+    Returns: the value
+    """
+    if not tokens or not all(tokens):
+      return fetch()
+
+    token_hash = hashlib.sha256('\n'.join(tokens)).hexdigest()
+    key = 'ID %s %s %s' % (self.DOMAIN, field, token_hash)
+    value = identity_cache.get(key)
+    if value is None:
+      value = fetch()
+      if value is not None:
+        identity_cache.set(key, value, time=time)
+    return copy.deepcopy(value)
+
+  def response_counts(self, cache, ids):
+    """Returns a ResponseCounts for this source and the given post ids.
+
+    Args:
+      cache: the cache kwarg passed to get_activities_response(), or None
+      ids: sequence of string post ids
+    """
+    return ResponseCounts(cache, self.RESPONSE_COUNTS_PREFIX, ids,
+                          types=self.RESPONSE_COUNTS_TYPES)
+
+  def sync_activities_response(self, state, user_id=None, group_id=None,
+                               **kwargs):
+    """Fetches activities, picking up where the last call left off.
+
+    Remembers high-water marks for each source, user, and group in state: the
+    latest activity id, which is passed as min_id next time, and the ETag from
+    the last response. state is also passed through as the cache kwarg, so
+    per-post reply, like, and share counts are stored there too, which lets
+    sources skip fetches for responses that haven't changed.
+
+    Explicit min_id, etag, and cache kwargs override the stored values.
+
+    Args:
+      state: object with the memcache get() and set_multi() methods, e.g. an
+        LRUCache to keep state in memory, a FileCache to persist it to a file,
+        or App Engine's memcache module
+      user_id: string, see get_activities_response(). Pass it explicitly when
+        syncing multiple accounts on the same source into one state.
+      group_id: string, see get_activities_response()
+      kwargs: passed through to get_activities_response()
+
+    Returns: response dict from get_activities_response()
+    """
+    key = 'SYNC %s %s %s' % (self.DOMAIN, user_id, group_id)
+    marks = state.get(key) or {}
+    for field in 'min_id', 'etag':
+      if kwargs.get(field) is None:
+        kwargs[field] = marks.get(field)
+    if kwargs.get('cache') is None:
+      kwargs['cache'] = state
+
+    resp = self.get_activities_response(user_id=user_id, group_id=group_id,
+                                        **kwargs)
+
+    new_marks = dict(marks)
+    if resp.get('etag'):
+      new_marks['etag'] = resp['etag']
+    # include the old mark so that it never moves backward
+    latest = self._latest_activity_id(resp.get('items', []) +
+                                      [{'id': marks.get('min_id')}])
+    if latest:
+      new_marks['min_id'] = latest
+
+    if new_marks != marks:
+      state.set_multi({key: new_marks})
+    return resp
+
+  @staticmethod
+  def _latest_activity_id(activities):
+    """Returns the highest numeric silo id in a list of activities, or None.
+
+    Activity ids may be tag URIs or bare silo ids. Compares the ids' leading
+    numbers, e.g. 123 in Instagram's 123_456 ids. Likes are ignored, since their
+    ids are based on the liked post, not the like itself.
+    """
+    latest = None
+    latest_num = -1
+    for activity in activities:
+      id = activity.get('id')
+      if not id or activity.get('verb') == 'like':
+        continue
+      parsed = util.parse_tag_uri(id)
+      if parsed:
+        id = parsed[1]
+      match = re.match(r'\d+', id)
+      if match and int(match.group()) > latest_num:
+        latest = id
+        latest_num = int(match.group())
+
+    return latest
+
+  def iter_activities(self, page_size=ITER_ACTIVITIES_PAGE_SIZE, **kwargs):
+    """Generator that fetches activities lazily, one page at a time.
+
+    Each page is only fetched once the previous page's activities have all been
+    consumed, so callers can stream arbitrarily long histories and stop
+    whenever they want. Subclasses follow their silo's native paging cursor via
+    _get_activities_page().
+
+    Args:
+      page_size: int, number of activities to request per API call
+      kwargs: passed through to get_activities_response(), except for
+        start_index and count, which are managed here
+
+    Yields: ActivityStreams activity dicts
+    """
+    if kwargs.get('activity_id'):
+      for activity in self.get_activities(**kwargs):
+        yield activity
+      return
+
+    cursor = None
+    empty_pages = 0
+    while True:
+      activities, cursor = self._get_activities_page(cursor, page_size, **kwargs)
+      for activity in activities:
+        yield activity
+      if cursor is None:
+        return
+      empty_pages = 0 if activities else empty_pages + 1
+      if empty_pages >= ITER_ACTIVITIES_MAX_EMPTY_PAGES:
+        logging.warning('Giving up after %d empty pages', empty_pages)
+        return
+
+  def _get_activities_page(self, cursor, count, **kwargs):
+    """Fetches one page of activities for iter_activities().
+
+    This default implementation pages with start_index. Subclasses should
+    override it to use their silo's native cursor when they have one.
+
+    Args:
+      cursor: the value this method returned for the previous page, or None
+        for the first page
+      count: int, number of activities to request
+      kwargs: passed through to get_activities_response()
+
+    Returns: (list of activity dicts, cursor for the next page or None if this
+      is the last page) tuple
+    """
+    start_index = cursor or 0
+    activities = self.get_activities(start_index=start_index, count=count,
+                                     **kwargs)
+    next = start_index + len(activities) if len(activities) >= count else None
+    return activities, next
+
   def get_activities_response(self, user_id=None, group_id=None, app_id=None,
                               activity_id=None, start_index=0, count=0,
                               etag=None, min_id=None, cache=None,
@@ -457,10 +1053,70 @@ class Source(object):
         to follow_redirects().
       include_redirect_sources: boolean, whether to include URLs that redirect
         as well as their final destination URLs
-      kwargs: passed to requests.head() when following redirects
+      kwargs: passed to http_request() when following redirects
 
     Returns: ([string original post URLs], [string mention URLs]) tuple
     """
+    return Source.original_post_discovery_multi(
+      [activity], domains=domains, cache=cache,
+      include_redirect_sources=include_redirect_sources, **kwargs)[0]
+
+  @staticmethod
+  def original_post_discovery_multi(activities, domains=None, cache=None,
+                                    include_redirect_sources=True, **kwargs):
+    """Discovers original post links for multiple activities at once.
+
+    Collects the candidate URLs from all of the activities first, then resolves
+    redirects for each distinct URL once, concurrently, with
+    follow_redirects_multi().
+
+    Args:
+      activities: sequence of activity dicts
+      domains, cache, include_redirect_sources, kwargs: see
+        original_post_discovery()
+
+    Returns: list of ([string original post URLs], [string mention URLs])
+      tuples, one for each activity, in the same order
+    """
+    all_candidates = [Source._original_post_candidates(a) for a in activities]
+    resolved = follow_redirects_multi(set().union(*all_candidates), cache=cache,
+                                      **kwargs)
+
+    results = []
+    for candidates in all_candidates:
+      # check for redirect and add their final urls
+      redirects = {}  # maps final URL to original URL for redirects
+      for url in list(candidates):
+        final = resolved[url]
+        if (final.url != url and
+            final.headers.get('content-type', '').startswith('text/html')):
+          redirects[final.url] = url
+          candidates.add(final.url)
+
+      # use domains to determine which URLs are original post links vs mentions
+      originals = set()
+      mentions = set()
+      for url in util.dedupe_urls(candidates):
+        if url in redirects.values():
+          # this is a redirected original URL. postpone and handle it when we
+          # hit its final URL so that we know the final domain.
+          continue
+        which = (originals if not domains or util.domain_from_link(url) in domains
+                 else mentions)
+        which.add(url)
+        redirected_from = redirects.get(url)
+        if redirected_from and include_redirect_sources:
+          which.add(redirected_from)
+
+      logging.info('Original post discovery found original posts %s, mentions %s',
+                   originals, mentions)
+      results.append((originals, mentions))
+
+    return results
+
+  @staticmethod
+  def _original_post_candidates(activity):
+    """Returns the set of candidate original post URLs in an activity."""
     obj = activity.get('object') or activity
     content = obj.get('content', '').strip()
 
@@ -475,39 +1131,11 @@ class Source(object):
     candidates += [match.expand(r'http://\1/\2') for match in
                    Source._PERMASHORTCITATION_RE.finditer(content)]
 
-    candidates = set(filter(None,
+    return set(filter(None,
       (util.clean_url(url) for url in candidates
        # heuristic: ellipsized URLs are probably incomplete, so omit them.
        if url and not url.endswith('...') and not url.endswith(u'…'))))
 
-    # check for redirect and add their final urls
-    redirects = {}  # maps final URL to original URL for redirects
-    for url in list(candidates):
-      resolved = follow_redirects(url, cache=cache, **kwargs)
-      if (resolved.url != url and
-          resolved.headers.get('content-type', '').startswith('text/html')):
-        redirects[resolved.url] = url
-        candidates.add(resolved.url)
-
-    # use domains to determine which URLs are original post links vs mentions
-    originals = set()
-    mentions = set()
-    for url in util.dedupe_urls(candidates):
-      if url in redirects.values():
-        # this is a redirected original URL. postpone and handle it when we hit
-        # its final URL so that we know the final domain.
-        continue
-      which = (originals if not domains or util.domain_from_link(url) in domains
-               else mentions)
-      which.add(url)
-      redirected_from = redirects.get(url)
-      if redirected_from and include_redirect_sources:
-        which.add(redirected_from)
-
-    logging.info('Original post discovery found original posts %s, mentions %s',
-                 originals, mentions)
-    return originals, mentions
-
   @staticmethod
   def actor_name(actor):
     """Returns the given actor's name if available, otherwise Unknown."""
@@ -726,25 +1354,40 @@ class Source(object):
 def follow_redirects(url, cache=None, **kwargs):
   """Fetches a URL with HEAD, repeating if necessary to follow redirects.
 
-  Caches resolved URLs in memcache by default. *Does not* raise an exception if
-  any of the HTTP requests fail, just returns the failed response. If you care,
-  be sure to check the returned response's status code!
+  *Does not* raise an exception if any of the HTTP requests fail, just returns
+  the failed response. If you care, be sure to check the returned response's
+  status code!
+
+  If cache is provided, resolved URLs are cached as ResolvedURL tuples, both in
+  cache and in redirect_cache, an in memory LRU cache that's checked first.
+  Failures are cached for FAILED_RESOLVE_URL_CACHE_TIME, successes forever.
 
   Args:
     url: string
     cache: optional, a cache object to read and write resolved URLs to. Must
-      have get(key) and set(key, value, time=...) methods. Stores
-      'R [original URL]' in key, final URL in value.
-    **kwargs: passed to requests.head()
+      have get(key) and set_multi(mapping, time=...) methods. Stores
+      'R [original URL]' in key, ResolvedURL in value.
+    **kwargs: passed to http_request()
 
   Returns:
     the requests.Response for the final request
   """
   if cache is not None:
     cache_key = 'R ' + url
-    resolved = cache.get(cache_key)
-    if resolved is not None:
-      return resolved
+    resolved = redirect_cache.get(cache_key)
+    if resolved is None:
+      resolved = cache.get(cache_key)
+      if isinstance(resolved, ResolvedURL):
+        redirect_cache.set(cache_key, resolved, time=(
+          FAILED_RESOLVE_URL_CACHE_TIME if resolved.status_code == 499 else 0))
+    if isinstance(resolved, ResolvedURL):
+      resp = requests.Response()
+      resp.url = resolved.url
+      resp.status_code = resolved.status_code
+      resp.headers['content-type'] = resolved.content_type
+      return resp
+    elif resolved is not None:
+      return resolved  # cached before we started caching ResolvedURLs
 
   # can't use urllib2 since it uses GET on redirect requests, even if i specify
   # HEAD for the initial request.
@@ -754,8 +1397,7 @@ def follow_redirects(url, cache=None, **kwargs):
     parsed = urlparse.urlparse(url)
     if not parsed.scheme:
       url = 'http://' + url
-    kwargs.setdefault('timeout', appengine_config.HTTP_TIMEOUT)
-    resolved = requests.head(url, allow_redirects=True, **kwargs)
+    resolved = http_request('HEAD', url, allow_redirects=True, **kwargs)
     resolved.raise_for_status()
     if resolved.url != url:
       logging.debug('Resolved %s to %s', url, resolved.url)
@@ -782,6 +1424,54 @@ def follow_redirects(url, cache=None, **kwargs):
 
   resolved.url = util.clean_url(resolved.url)
   if cache is not None:
-    cache.set_multi({cache_key: resolved, 'R ' + resolved.url: resolved},
-                    time=cache_time)
+    record = ResolvedURL(resolved.url, resolved.status_code,
+                         resolved.headers['content-type'])
+    updates = {cache_key: record, 'R ' + resolved.url: record}
+    redirect_cache.set_multi(updates, time=cache_time)
+    cache.set_multi(updates, time=cache_time)
   return resolved
+
+
+# maps domain to [threading.BoundedSemaphore, number of requests using it]. The
+# semaphore limits concurrent requests to the domain. Domains are removed once
+# no requests are using them, so this only holds domains in flight.
+_domain_semaphores = {}
+_domain_semaphores_lock = threading.Lock()
+
+
+def follow_redirects_multi(urls, cache=None, **kwargs):
+  """Resolves redirects for multiple URLs concurrently.
+
+  Uses follow_redirects() and parallel_map(), and also makes at most
+  MAX_CONCURRENT_REQUESTS_PER_DOMAIN concurrent requests to any one domain.
+
+  Args:
+    urls: sequence of string URLs. Duplicates are only resolved once.
+    cache, kwargs: passed to follow_redirects()
+
+  Returns:
+    dict mapping each URL to the requests.Response for its final request
+  """
+  def resolve(url):
+    try:
+      domain = urlparse.urlparse(url).netloc.lower()
+    except ValueError:
+      domain = None
+    with _domain_semaphores_lock:
+      entry = _domain_semaphores.get(domain)
+      if entry is None:
+        entry = _domain_semaphores[domain] = [threading.BoundedSemaphore(
+          MAX_CONCURRENT_REQUESTS_PER_DOMAIN), 0]
+      entry[1] += 1
+
+    try:
+      with entry[0]:
+        return follow_redirects(url, cache=cache, **kwargs)
+    finally:
+      with _domain_semaphores_lock:
+        entry[1] -= 1
+        if not entry[1]:
+          del _domain_semaphores[domain]
+
+  urls = sorted(set(urls))
+  return dict(zip(urls, parallel_map(resolve, urls)))
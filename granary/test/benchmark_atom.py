@@ -0,0 +1,112 @@
+"""Benchmarks for atom.py.
+
+Compares per-feed Atom rendering latency with a shared, precompiled template
+environment against building a fresh environment for every feed, which is what
+activities_to_atom() used to do.
+
+Also compares _strip_html_tags() against BeautifulSoup's get_text() on every
+string in testdata/.
+
+Usage: python -m granary.test.benchmark_atom [ITERATIONS]
+"""
+
+import copy
+import glob
+import json
+import os
+import sys
+import timeit
+
+from bs4 import BeautifulSoup
+import jinja2
+
+from granary import atom
+
+import test_facebook
+import test_instagram
+import test_twitter
+
+FEED_SIZES = (1, 10, 100)
+
+
+def make_feed(size):
+  """Returns a list of size activities drawn from the test fixtures."""
+  fixtures = [m.ACTIVITY for m in (test_facebook, test_instagram, test_twitter)]
+  return [copy.deepcopy(fixtures[i % len(fixtures)]) for i in range(size)]
+
+
+def render(feed, fresh_env=False):
+  if fresh_env:
+    atom.jinja_env = jinja2.Environment(
+      loader=jinja2.PackageLoader('granary', 'templates'), autoescape=True)
+  atom.activities_to_atom(copy.deepcopy(feed), test_twitter.ACTOR,
+                          request_url='http://request/url',
+                          host_url='http://host/url')
+
+
+def testdata_strings():
+  """Returns all strings in the testdata/ JSON files, plus the HTML files."""
+  strings = []
+
+  def collect(val):
+    if isinstance(val, dict):
+      val = val.values()
+    if isinstance(val, list):
+      for elem in val:
+        collect(elem)
+    elif isinstance(val, basestring):
+      strings.append(val)
+
+  testdata = os.path.join(os.path.dirname(__file__), 'testdata')
+  for filename in glob.glob(os.path.join(testdata, '*.json')):
+    with open(filename) as f:
+      collect(json.load(f))
+  for filename in glob.glob(os.path.join(testdata, '*.html')):
+    with open(filename) as f:
+      strings.append(f.read().decode('utf-8'))
+
+  return strings
+
+
+def strip_with_beautifulsoup(strings):
+  for s in strings:
+    BeautifulSoup(s, 'html.parser').get_text('')
+
+
+def strip_with_extractor(strings):
+  for s in strings:
+    atom._strip_html_tags(s)
+
+
+def benchmark_strip_html_tags(iterations):
+  strings = testdata_strings()
+  print '\nstripping HTML tags from %d testdata strings' % len(strings)
+  for fn in strip_with_beautifulsoup, strip_with_extractor:
+    elapsed = min(timeit.repeat(lambda: fn(strings), number=iterations,
+                                repeat=3)) / iterations
+    print '%-26s %10.3f ms per corpus' % (fn.__name__, elapsed * 1000)
+
+
+def main(iterations=100):
+  shared_env = atom.jinja_env
+  print '%-10s %16s %16s %8s' % ('items', 'fresh env (ms)', 'shared env (ms)',
+                                 'speedup')
+  try:
+    for size in FEED_SIZES:
+      feed = make_feed(size)
+      before = min(timeit.repeat(lambda: render(feed, fresh_env=True),
+                                 number=iterations, repeat=3)) / iterations
+      atom.jinja_env = shared_env
+      render(feed)  # warm up, ie compile the templates
+      after = min(timeit.repeat(lambda: render(feed),
+                                number=iterations, repeat=3)) / iterations
+      print '%-10d %16.3f %16.3f %7.1fx' % (size, before * 1000, after * 1000,
+                                            before / after)
+  finally:
+    atom.jinja_env = shared_env
+
+  benchmark_strip_html_tags(max(iterations / 10, 1))
+
+
+if __name__ == '__main__':
+  main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,115 @@
+"""Benchmarks cold start import time for the API handler and each silo.
+
+Each target is imported in a fresh child process, like a new App Engine
+instance, with an import hook that records how long each module takes to load,
+including the modules it imports. Python 2 doesn't have python -X importtime,
+so this approximates its report: the slowest modules, by cumulative time.
+
+Also reports which heavy dependencies each target ended up loading.
+
+Usage: python -m granary.test.benchmark_startup [--runs N] [--top N]
+"""
+
+import __builtin__
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# name, module to import, silo to look up in source.sources afterward
+TARGETS = (
+  ('activitystreams', 'activitystreams', None),
+  ('+ facebook', 'activitystreams', 'facebook'),
+  ('+ flickr', 'activitystreams', 'flickr'),
+  ('+ google+', 'activitystreams', 'google+'),
+  ('+ instagram', 'activitystreams', 'instagram'),
+  ('+ twitter', 'activitystreams', 'twitter'),
+  ('atom', 'granary.atom', None),
+  ('microformats2', 'granary.microformats2', None),
+  ('app', 'app', None),
+)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(
+  os.path.abspath(__file__))))
+
+# dependencies that are slow to import, which we try to load only when needed
+HEAVY_MODULES = ('apiclient', 'bs4', 'jinja2', 'mf2py')
+
+
+def import_target(module, silo):
+  """Imports module and looks up silo, timing each module that gets loaded.
+
+  Returns: dict with 'total' seconds, 'modules' dict mapping module name to
+    cumulative seconds, and 'heavy' list of HEAVY_MODULES that were loaded
+  """
+  real_import = __builtin__.__import__
+  cumulative = {}
+
+  def timed_import(name, globals=None, locals=None, fromlist=None, level=-1):
+    before = set(sys.modules)
+    start = time.time()
+    try:
+      return real_import(name, globals, locals, fromlist, level)
+    finally:
+      elapsed = time.time() - start
+      # only count imports that actually loaded the module they asked for.
+      # implicit relative imports resolve to a module in the caller's package.
+      loaded = [m for m in sys.modules if m not in before and sys.modules[m]
+                and (m == name or m.endswith('.' + name))]
+      if loaded:
+        cumulative[min(loaded, key=len)] = elapsed
+
+  __builtin__.__import__ = timed_import
+  start = time.time()
+  try:
+    __import__(module)
+    if silo:
+      sys.modules['granary.source'].sources[silo]
+  finally:
+    __builtin__.__import__ = real_import
+
+  return {
+    'total': time.time() - start,
+    'modules': cumulative,
+    'heavy': [m for m in HEAVY_MODULES if m in sys.modules],
+  }
+
+
+def run_in_child(module, silo):
+  """Runs import_target() in a new Python process and returns its result."""
+  env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+  output = subprocess.check_output(
+    [sys.executable, '-m', 'granary.test.benchmark_startup', '--child', module,
+     silo or ''], env=env, cwd=REPO_ROOT)
+  return json.loads(output)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--runs', type=int, default=5,
+                      help='number of cold starts per target; the fastest is reported')
+  parser.add_argument('--top', type=int, default=10,
+                      help='number of slowest modules to list per target')
+  parser.add_argument('--child', nargs=2, help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.child:
+    module, silo = args.child
+    print json.dumps(import_target(module, silo or None))
+    return
+
+  for name, module, silo in TARGETS:
+    result = min((run_in_child(module, silo) for _ in xrange(args.runs)),
+                 key=lambda r: r['total'])
+    print '%-20s %10.1f ms   heavy deps: %s' % (
+      name, result['total'] * 1000, ', '.join(result['heavy']) or 'none')
+    slowest = sorted(result['modules'].items(), key=lambda m: -m[1])
+    for mod, elapsed in slowest[:args.top]:
+      print '  %10.1f ms  %s' % (elapsed * 1000, mod)
+    sys.stdout.flush()
+
+
+if __name__ == '__main__':
+  main()
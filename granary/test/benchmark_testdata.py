@@ -0,0 +1,195 @@
+"""Benchmarks for the format converters, using the fixtures in testdata/.
+
+Replicates each fixture into a feed of ITEMS copies and runs each converter over
+it. Each converter runs in its own forked child process so that peak memory
+usage is measured separately. Reports throughput, p50 and p99 latency per call,
+and peak memory growth.
+
+Usage: python -m granary.test.benchmark_testdata [--items N] [--output FILE]
+         [--compare FILE]
+
+--output saves the results as JSON, and --compare prints the change against
+results saved from an earlier run, e.g. on a different commit.
+"""
+
+import argparse
+import copy
+import glob
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+import traceback
+
+from granary import atom
+from granary import microformats2
+
+TESTDATA = os.path.join(os.path.dirname(__file__), 'testdata')
+
+ACTOR = {'displayName': 'Ms. Benchmark', 'url': 'http://example.com/'}
+
+
+def read_fixtures(ext):
+  """Returns a list of (filename, contents) for each testdata/*.[ext] file.
+
+  JSON files are decoded.
+  """
+  fixtures = []
+  for filename in sorted(glob.glob(os.path.join(TESTDATA, '*.' + ext))):
+    with open(filename) as f:
+      contents = f.read()
+    if ext.endswith('.json'):
+      contents = json.loads(contents)
+    fixtures.append((os.path.basename(filename), contents))
+  return fixtures
+
+
+def activities_to_atom(feed):
+  # wrap bare objects, and activities with multiple objects, in post activities
+  activities = [obj if isinstance(obj.get('object'), dict)
+                else {'verb': 'post', 'object': obj}
+                for obj in feed]
+  return atom.activities_to_atom(activities, ACTOR,
+                                 request_url='http://request/url',
+                                 host_url='http://host/url')
+
+
+# name, fixture extension, function, whether it converts a whole feed per call
+BENCHMARKS = (
+  ('object_to_json', 'as.json', microformats2.object_to_json, False),
+  ('object_to_html', 'as.json', microformats2.object_to_html, False),
+  ('json_to_object', 'mf2.json', microformats2.json_to_object, False),
+  ('json_to_html', 'mf2.json', microformats2.json_to_html, False),
+  ('html_to_activities', 'mf2.html', microformats2.html_to_activities, False),
+  ('activities_to_atom', 'as.json', activities_to_atom, True),
+)
+
+# number of times to render each whole feed for feed level benchmarks
+FEED_REPEATS = 5
+
+
+def percentile(sorted_vals, pct):
+  """Returns the pct'th percentile of a sorted list, nearest rank method."""
+  if not sorted_vals:
+    return None
+  index = int(round(pct / 100.0 * len(sorted_vals) + .5)) - 1
+  return sorted_vals[max(0, min(index, len(sorted_vals) - 1))]
+
+
+def run_benchmark(ext, fn, whole_feed, items):
+  """Runs one converter over every fixture. Returns a dict of results."""
+  # copy up front so that copying isn't included in the timings or the memory
+  # usage. some converters modify their input.
+  feeds = []
+  for _, fixture in read_fixtures(ext):
+    repeats = FEED_REPEATS if whole_feed else 1
+    feeds.extend([copy.deepcopy(fixture) for _ in xrange(items)]
+                 for _ in xrange(repeats))
+
+  latencies = []
+  num_items = 0
+  start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+  for feed in feeds:
+    if whole_feed:
+      start = time.time()
+      fn(feed)
+      latencies.append(time.time() - start)
+    else:
+      for item in feed:
+        start = time.time()
+        fn(item)
+        latencies.append(time.time() - start)
+    num_items += len(feed)
+
+  latencies.sort()
+  peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  total = sum(latencies)
+  return {
+    'calls': len(latencies),
+    'items': num_items,
+    'items_per_sec': num_items / total if total else None,
+    'p50_ms': percentile(latencies, 50) * 1000,
+    'p99_ms': percentile(latencies, 99) * 1000,
+    'peak_mem_kb': peak_rss - start_rss,  # kilobytes on Linux
+  }
+
+
+def run_in_child(*args):
+  """Runs run_benchmark(*args) in a forked child process and returns its result.
+  """
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    status = 1
+    try:
+      output = json.dumps(run_benchmark(*args))
+      with os.fdopen(write_fd, 'w') as f:
+        f.write(output)
+      status = 0
+    except BaseException:
+      traceback.print_exc()
+    finally:
+      os._exit(status)
+
+  os.close(write_fd)
+  with os.fdopen(read_fd) as f:
+    output = f.read()
+  _, status = os.waitpid(pid, 0)
+  if status:
+    raise RuntimeError('Benchmark child process failed: %s' % (args,))
+  return json.loads(output)
+
+
+def git_commit():
+  try:
+    return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                   cwd=os.path.dirname(__file__)).strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument('--items', type=int, default=1000,
+                      help='number of copies of each fixture per feed')
+  parser.add_argument('--output', help='file to write JSON results to')
+  parser.add_argument('--compare', help='JSON results from an earlier run')
+  args = parser.parse_args()
+
+  previous = {}
+  if args.compare:
+    with open(args.compare) as f:
+      previous = json.load(f)['benchmarks']
+
+  print '%-20s %14s %10s %10s %12s %8s' % (
+    'function', 'items/sec', 'p50 (ms)', 'p99 (ms)', 'peak mem (KB)', 'change')
+  results = {}
+  for name, ext, fn, whole_feed in BENCHMARKS:
+    result = results[name] = run_in_child(ext, fn, whole_feed, args.items)
+    change = ''
+    before = previous.get(name, {}).get('items_per_sec')
+    if before and result['items_per_sec']:
+      change = '%+.1f%%' % ((result['items_per_sec'] / before - 1) * 100)
+    print '%-20s %14.1f %10.3f %10.3f %12d %8s' % (
+      name, result['items_per_sec'], result['p50_ms'], result['p99_ms'],
+      result['peak_mem_kb'], change)
+    sys.stdout.flush()
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump({
+        'commit': git_commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'items': args.items,
+        'python': sys.version.split()[0],
+        'benchmarks': results,
+      }, f, indent=2, sort_keys=True)
+    print 'Wrote results to %s' % args.output
+
+
+if __name__ == '__main__':
+  main()
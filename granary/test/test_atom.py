@@ -26,6 +26,25 @@ class AtomTest(testutil.HandlerTest):
           host_url='http://host/url',
           ))
 
+  def test_templates_compiled_once(self):
+    atom.activities_to_atom([copy.deepcopy(test_facebook.ACTIVITY)],
+                            test_facebook.ACTOR)
+    template = atom.jinja_env.get_template(atom.ATOM_TEMPLATE_FILE)
+    atom.activities_to_atom([copy.deepcopy(test_twitter.ACTIVITY)],
+                            test_twitter.ACTOR)
+    self.assertIs(template, atom.jinja_env.get_template(atom.ATOM_TEMPLATE_FILE))
+
+  def test_activities_to_atom_iter(self):
+    for test_module in test_facebook, test_instagram, test_twitter:
+      kwargs = {'request_url': 'http://request/url', 'host_url': 'http://host/url'}
+      chunks = list(atom.activities_to_atom_iter(
+        [copy.deepcopy(test_module.ACTIVITY)], test_module.ACTOR, **kwargs))
+      self.assertGreater(len(chunks), 1)
+      self.assert_multiline_equals(
+        atom.activities_to_atom([copy.deepcopy(test_module.ACTIVITY)],
+                                test_module.ACTOR, **kwargs),
+        ''.join(chunks))
+
   def test_title(self):
     self.assertIn('\n<title>my title</title>',
         atom.activities_to_atom([copy.deepcopy(test_facebook.ACTIVITY)],
@@ -38,6 +57,34 @@ class AtomTest(testutil.HandlerTest):
     self.assertIn('<title>foo &amp; bar</title>\n',
                   atom.activities_to_atom([activity], test_facebook.ACTOR))
 
+  def test_title_with_trailing_bare_ampersand(self):
+    activity = copy.deepcopy(test_facebook.ACTIVITY)
+    activity['title'] = u'Q&A'
+    self.assertIn('<title>Q&amp;A</title>\n',
+                  atom.activities_to_atom([activity], {}))
+
+  def test_strip_html_tags(self):
+    for html, expected in (
+        ('', ''),
+        ('plain', 'plain'),
+        ('<p>foo &amp; <a href="http://bar">bar</a></p>', 'foo & bar'),
+        ('&quot;x&quot; &apos;y&#39; &#8217;&#x2019; &#150;',
+         u'"x" \'y\' \u2019\u2019 \u2013'),
+        ('&unknown; &amp x', '&unknown & x'),
+        ('a<!-- c -->b<script>var x;</script><style>p {}</style>c', 'abc'),
+        ('<![CDATA[x]]>y', 'xy'),
+        ('<div>\n  <p>a</p>  <p>b</p>\n</div>', '\na b\n'),
+        ('<pre>  </pre>', '  '),
+        ('  ', ' '),
+        ('\n ', '\n'),
+        # unterminated entity references at the end are kept as text
+        ('Q&A', 'Q&A'),
+        ('a&b', 'a&b'),
+        ('news from AT&T', 'news from AT&T'),
+        ('<p>AT&T</p>', 'AT&T'),
+        ('x &amp', 'x &amp'),
+      ):
+      self.assertEquals(expected, atom._strip_html_tags(html))
 
   def test_render_content_as_html(self):
     self.assertIn('<a href="https://twitter.com/foo">@twitter</a> meets @seepicturely at <a href="https://twitter.com/search?q=%23tcdisrupt">#tcdisrupt</a> &lt;3 <a href="http://first/link/">first</a> <a href="http://instagr.am/p/MuW67/">instagr.am/p/MuW67</a> ',
@@ -5,6 +5,7 @@ __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
 import copy
 import json
+import mox
 import urllib
 import urllib2
 
@@ -791,38 +792,106 @@ Checking another side project off my list. portablecontacts-unofficial is live!
 """
 
 
-class FacebookTest(testutil.HandlerTest):
+class FacebookTest(testutil.TestCase):
 
   def setUp(self):
     super(FacebookTest, self).setUp()
     self.fb = facebook.Facebook()
+    self.mox.stubs.Set(facebook.Facebook, 'post_id_cache', source.LRUCache())
     self.batch = []
     self.batch_responses = []
 
   def expect_urlopen(self, url, response=None, **kwargs):
-    return super(FacebookTest, self).expect_urlopen(
+    return self.expect_source_urlopen(
       facebook.API_BASE + url, response=json.dumps(response), **kwargs)
 
   def expect_batch_req(self, url, response, status=200, headers={},
-                       response_headers=None):
-    batch.append({
+                       response_headers=None, **kwargs):
+    """Adds a request to the batch that expect_batch() will expect.
+
+    kwargs are added to the request, e.g. name or depends_on.
+    """
+    req = {
       'method': 'GET',
       'relative_url': url,
       'headers': [{'name': n, 'value': v} for n, v in headers.items()],
-    })
-    batch_responses.append(util.trim_nulls({
+    }
+    req.update(kwargs)
+    self.batch.append(req)
+    self.batch_responses.append(util.trim_nulls({
       'code': status,
       'body': json.dumps(response),
       'headers': response_headers,
     }))
 
-  def replay_batch(self):
+  def expect_batch(self):
+    """Expects a batch API call with the requests from expect_batch_req()."""
+    batch = util.trim_nulls(self.batch)
     self.expect_urlopen(
-      facebook.API_BASE,
-      data='batch=' + json.dumps(batch, separators=(',', ':')),
-      response=batch_responses)
+      '', data=mox.Func(lambda data: json.loads(data[len('batch='):]) == batch),
+      response=self.batch_responses)
+    self.batch = []
+    self.batch_responses = []
+
+  def expect_self_batch(self, feed=None, photos=None, events=None,
+                        event_status=200):
+    """Expects the first batch request for group_id=@self.
+
+    Only includes the events requests if events is not None.
+    """
+    self.expect_batch_req('me/feed?offset=0', feed or {})
+    self.expect_batch_req('me/photos/uploaded', photos or {})
+    if events is not None:
+      self.expect_batch_req('me/events', {'data': events}, name='rsvps',
+                            omit_response_on_success=False)
+      self.expect_batch_req(
+        facebook.API_EVENTS % '{result=rsvps:$.data.*.id}',
+        {e['id']: e for e in events}, status=event_status, depends_on='rsvps')
+    self.expect_batch()
+
+  def test_iter_activities_self_follows_paging_next(self):
+    def posts(*ids):
+      return [{'id': '212038_%s' % id, 'message': 'post %s' % id} for id in ids]
+
+    next_url = 'https://graph.facebook.com/v2.2/me/feed?limit=2&access_token=x&until=%s&__paging_token=%s'
+    self.expect_batch_req('me/feed?offset=0&limit=2', {
+      'data': posts(0, 1),
+      'paging': {'next': next_url % (100, 'abc')},
+    })
+    self.expect_batch_req('me/photos/uploaded', {
+      'data': [{'id': '9', 'name': 'photo'}]})
+    self.expect_batch()
+
+    # later pages only fetch the feed, not photos or events
+    self.expect_urlopen('me/feed?__paging_token=abc&until=100&limit=2', {
+      'data': posts(2, 3),
+      'paging': {'next': next_url % (80, 'def')},
+    })
+    self.expect_urlopen('me/feed?__paging_token=def&until=80&limit=2', {
+      'data': posts(4),
+      'paging': {'previous': 'https://graph.facebook.com/v2.2/me/feed?since=1'},
+    })
+    self.mox.ReplayAll()
+
+    self.assert_equals(
+      ['post 0', 'post 1', 'photo', 'post 2', 'post 3', 'post 4'],
+      [a['object']['content'] for a in
+       self.fb.iter_activities(page_size=2, group_id=source.SELF)])
+
+  def test_iter_activities_continues_past_filtered_page(self):
+    next_url = 'https://graph.facebook.com/v2.2/me/home?limit=2&access_token=x&until=%s'
+    self.expect_urlopen('me/home?offset=0&limit=2', {
+      'data': [{'id': '1_2', 'status_type': 'shared_story'}],
+      'paging': {'next': next_url % 100},
+    })
+    self.expect_urlopen('me/home?until=100&limit=2', {
+      'data': [{'id': '212038_3', 'message': 'post 3'}],
+    })
     self.mox.ReplayAll()
 
+    self.assert_equals(['post 3'], [a['object']['content'] for a in
+                                    self.fb.iter_activities(page_size=2)])
+
   def test_get_actor(self):
     self.expect_urlopen('foo', USER)
     self.mox.ReplayAll()
@@ -888,18 +957,34 @@ class FacebookTest(testutil.HandlerTest):
     self.assertNotIn('tags', got[0]['object'])
     self.assertNotIn('tags', got[0])
 
+  def test_get_activities_skips_unchanged_shares_and_comments(self):
+    post = copy.deepcopy(POST)
+    post['shares'] = {'count': 2}
+    post2 = copy.deepcopy(post)
+    post2['id'] = '222'
+    self.expect_urlopen('me/home?offset=0', {'data': [post, post2]})
+    self.expect_urlopen('sharedposts?ids=222', {'222': {'data': []}})
+    self.expect_urlopen('comments?filter=stream&ids=222', {'222': {'data': []}})
+    self.mox.ReplayAll()
+
+    cache = source.LRUCache()
+    cache.set_multi({'AFS 10100176064482163': 2,
+                     'AFC 10100176064482163': POST['updated_time'],
+                     'AFS 222': 1})
+    self.fb.get_activities(fetch_shares=True, fetch_replies=True, cache=cache)
+    self.assert_equals({'AFS 222': 2, 'AFC 222': POST['updated_time']},
+                       cache.get_multi(['AFS 222', 'AFC 222']))
+
   def test_get_activities_self_empty(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', {})
+    self.expect_self_batch()
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(group_id=source.SELF))
 
   def test_get_activities_self_photo_and_event(self):
-    self.expect_urlopen('me/feed?offset=0', {'data': [POST]})
-    self.expect_urlopen('me/photos/uploaded', {'data': [PHOTO]})
-    self.expect_urlopen('me/events', {'data': [EVENT]})
-    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
-    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS})
+    self.expect_self_batch(feed={'data': [POST]}, photos={'data': [PHOTO]},
+                           events=[EVENT])
+    self.expect_batch_req(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS})
+    self.expect_batch()
 
     self.mox.ReplayAll()
     self.assert_equals(
@@ -907,48 +992,66 @@ class FacebookTest(testutil.HandlerTest):
       self.fb.get_activities(group_id=source.SELF, fetch_events=True))
 
   def test_get_activities_self_owned_event_rsvps(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', {})
-    self.expect_urlopen('me/events', {'data': [EVENT]})
-    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
-    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS})
+    self.expect_self_batch(events=[EVENT])
+    self.expect_batch_req(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS})
+    self.expect_batch()
 
     self.mox.ReplayAll()
     self.assert_equals([EVENT_ACTIVITY_WITH_ATTENDEES], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True, event_owner_id=EVENT['owner']['id']))
 
   def test_get_activities_self_unowned_event_no_rsvps(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', {})
-    self.expect_urlopen('me/events', {'data': [EVENT]})
-    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
+    self.expect_self_batch(events=[EVENT])
 
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True, event_owner_id='xyz'))
 
   def test_get_activities_self_event_400s(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', {})
-    self.expect_urlopen('me/events', {'data': [EVENT]})
-    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT, status=400)
+    self.expect_self_batch(events=[EVENT], event_status=400)
 
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True))
 
   def test_get_activities_self_event_rsvps_400s(self):
-    self.expect_urlopen('me/feed?offset=0', {})
-    self.expect_urlopen('me/photos/uploaded', {})
-    self.expect_urlopen('me/events', {'data': [EVENT]})
-    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
-    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS},
-                        status=400)
+    self.expect_self_batch(events=[EVENT])
+    self.expect_batch_req(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS},
+                          status=400)
+    self.expect_batch()
 
     self.mox.ReplayAll()
     self.assert_equals([EVENT_ACTIVITY], self.fb.get_activities(
       group_id=source.SELF, fetch_events=True))
 
+  def test_get_activities_self_extras_in_one_batch(self):
+    self.expect_self_batch(feed={'data': [POST]}, events=[EVENT])
+    self.expect_batch_req(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS})
+    # the photo post's id is replaced by its object_id
+    self.expect_batch_req('sharedposts?ids=222', {}, status=400)
+    self.expect_batch_req('comments?filter=stream&ids=222',
+                          {'222': {'data': [{'id': '777', 'message': 'foo'}]}})
+    self.expect_batch()
+    self.mox.ReplayAll()
+
+    activities = self.fb.get_activities(group_id=source.SELF, fetch_events=True,
+                                        fetch_shares=True, fetch_replies=True)
+    self.assert_equals(EVENT_ACTIVITY_WITH_ATTENDEES, activities[0])
+    self.assertNotIn('share', [t.get('verb') for t in activities[1]['object']['tags']])
+    self.assertEquals('777',
+                      activities[1]['object']['replies']['items'][-1]['fb_id'])
+
+  def test_get_activities_self_304_not_modified(self):
+    self.expect_batch_req('me/feed?offset=0', {}, status=304,
+                          headers={'If-None-Match': '"abc"'})
+    self.expect_batch_req('me/photos/uploaded', {})
+    self.expect_batch()
+    self.mox.ReplayAll()
+
+    resp = self.fb.get_activities_response(group_id=source.SELF, etag='"abc"')
+    self.assert_equals([], resp['items'])
+    self.assertEquals('"abc"', resp['etag'])
+
   def test_get_activities_passes_through_access_token(self):
     self.expect_urlopen('me/home?offset=0&access_token=asdf', {"id": 123})
     self.mox.ReplayAll()
@@ -1016,6 +1119,47 @@ class FacebookTest(testutil.HandlerTest):
     self.mox.ReplayAll()
     self.fb.get_activities(activity_id='12_34', user_id='56')
 
+  def test_get_activities_activity_id_caches_working_ids(self):
+    self.expect_urlopen('12_34', {}, status=400)
+    self.expect_urlopen('56_34', {'id': '123'})
+    self.expect_urlopen('34', {'message': 'x'})
+    # second time, only fetch the ids that worked
+    self.expect_urlopen('56_34', {'id': '123'})
+    self.expect_urlopen('34', {'message': 'x'})
+    self.mox.ReplayAll()
+
+    for _ in range(2):
+      obj = self.fb.get_activities(activity_id='12_34', user_id='56')[0]['object']
+      self.assertEquals('123', obj['fb_id'])
+      self.assertEquals('x', obj['content'])
+
+  def test_get_activities_activity_id_doesnt_cache_transient_failures(self):
+    self.expect_urlopen('12_34', {}, status=500)
+    self.expect_urlopen('56_34').AndRaise(urllib2.URLError('timed out'))
+    self.expect_urlopen('34', {'id': '34', 'message': 'x'})
+    # second time, still try every id
+    self.expect_urlopen('12_34', {'id': '34', 'link': 'http://my/link'})
+    self.expect_urlopen('56_34', {'id': '34', 'message': 'x'})
+    self.expect_urlopen('34', {'id': '34', 'message': 'x'})
+    self.mox.ReplayAll()
+
+    obj = self.fb.get_activities(activity_id='12_34', user_id='56')[0]['object']
+    self.assertEquals('x', obj['content'])
+    self.assertNotIn('attachments', obj)
+
+    obj = self.fb.get_activities(activity_id='12_34', user_id='56')[0]['object']
+    self.assertEquals('x', obj['content'])
+    self.assertEquals('http://my/link', obj['attachments'][0]['url'])
+
+  def test_get_activities_activity_id_doesnt_cache_not_found(self):
+    for _ in range(2):
+      self.expect_urlopen('12_34', {}, status=404)
+      self.expect_urlopen('34', {}, status=404)
+    self.mox.ReplayAll()
+
+    for _ in range(2):
+      self.assert_equals([], self.fb.get_activities(activity_id='12_34'))
+
   def test_get_activities_request_etag(self):
     self.expect_urlopen('me/home?offset=0', {},
                         headers={'If-none-match': '"my etag"'})
@@ -1049,14 +1193,14 @@ class FacebookTest(testutil.HandlerTest):
   def test_get_activities_too_many_ids(self):
     ids = ['1', '2', '3', '4', '5']
     self.expect_urlopen('me/home?offset=0', {'data': [{'id': id} for id in ids]})
-    self.expect_urlopen('sharedposts?ids=1,3', {'1': {'data': [{'id': '222'}]}})
-    self.expect_urlopen('sharedposts?ids=2,5', {'2': {'data': [{'id': '444'}]}})
-    self.expect_urlopen('sharedposts?ids=4', {})
-    self.expect_urlopen('comments?filter=stream&ids=1,3',
+    self.expect_urlopen('sharedposts?ids=1,2', {'1': {'data': [{'id': '222'}]}})
+    self.expect_urlopen('sharedposts?ids=3,4', {'2': {'data': [{'id': '444'}]}})
+    self.expect_urlopen('sharedposts?ids=5', {})
+    self.expect_urlopen('comments?filter=stream&ids=1,2',
                         {'1': {'data': [{'id': '111'}]}})
-    self.expect_urlopen('comments?filter=stream&ids=2,5',
+    self.expect_urlopen('comments?filter=stream&ids=3,4',
                         {'1': {'data': [{'id': '333'}]}})
-    self.expect_urlopen('comments?filter=stream&ids=4', {})
+    self.expect_urlopen('comments?filter=stream&ids=5', {})
     self.mox.ReplayAll()
 
     try:
@@ -1075,6 +1219,18 @@ class FacebookTest(testutil.HandlerTest):
     obj1 = activities[1]['object']
     self.assert_equals(['444'], [t['fb_id'] for t in obj1['tags']])
 
+  def test_get_activities_split_id_requests_4xx_per_chunk(self):
+    ids = ['1', '2', '3']
+    self.expect_urlopen('me/home?offset=0', {'data': [{'id': id} for id in ids]})
+    self.expect_urlopen('sharedposts?ids=1,2', status=400)
+    self.expect_urlopen('sharedposts?ids=3', {'3': {'data': [{'id': '222'}]}})
+    self.mox.ReplayAll()
+
+    self.mox.stubs.Set(facebook, 'MAX_IDS', 2)
+    activities = self.fb.get_activities(fetch_shares=True)
+    self.assertNotIn('tags', activities[0]['object'])
+    self.assert_equals(['222'], [t['fb_id'] for t in activities[2]['object']['tags']])
+
   def test_get_event(self):
     self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
     self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {'data': RSVPS})
@@ -1095,6 +1251,69 @@ class FacebookTest(testutil.HandlerTest):
     got = self.fb.get_event('145304994', owner_id=EVENT['owner']['id'])
     self.assert_equals(EVENT_ACTIVITY, got)
 
+  def test_get_event_rsvps_paging(self):
+    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
+    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {
+      'data': RSVPS[:2],
+      'paging': {'cursors': {'after': 'xyz'}, 'next': 'http://the/next/page'},
+    })
+    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994' + '?after=xyz', {
+      'data': RSVPS[2:],
+      'paging': {'cursors': {'after': 'abc'}},  # no next, so this is the end
+    })
+    self.mox.ReplayAll()
+    self.assert_equals(EVENT_ACTIVITY_WITH_ATTENDEES,
+                       self.fb.get_event('145304994'))
+
+  def test_get_event_max_rsvps(self):
+    self.expect_urlopen(facebook.API_EVENT % '145304994', EVENT)
+    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {
+      'data': RSVPS[:2],
+      'paging': {'cursors': {'after': 'xyz'}, 'next': 'http://the/next/page'},
+    })
+    self.mox.ReplayAll()
+
+    obj = self.fb.get_event('145304994', max_rsvps=2)['object']
+    self.assert_equals([RSVP_OBJS[0]['actor']], obj['attending'])
+    self.assert_equals([RSVP_OBJS[1]['actor']], obj['notAttending'])
+    self.assertNotIn('maybeAttending', obj)
+
+  def test_iter_rsvps(self):
+    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {
+      'data': RSVPS[:3],
+      'paging': {'cursors': {'after': 'xyz'}, 'next': 'http://the/next/page'},
+    })
+    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994' + '?after=xyz',
+                        {}, status=400)
+    self.mox.ReplayAll()
+
+    rsvps = self.fb.iter_rsvps(EVENT)
+    self.assert_equals(RSVP_OBJS_WITH_ID[0], rsvps.next())
+    self.assert_equals(RSVP_OBJS_WITH_ID[1:3], list(rsvps))
+
+  def test_get_activities_self_event_rsvps_first_page_only(self):
+    self.expect_self_batch(events=[EVENT])
+    self.expect_batch_req(facebook.API_EVENT_RSVPS % '145304994', {
+      'data': RSVPS[:1],
+      'paging': {'cursors': {'after': 'xyz'}, 'next': 'http://the/next/page'},
+    })
+    self.expect_batch()
+    self.mox.ReplayAll()
+
+    obj = self.fb.get_activities(group_id=source.SELF, fetch_events=True)[0]['object']
+    self.assert_equals([RSVP_OBJS[0]['actor']], obj['attending'])
+    self.assertNotIn('notAttending', obj)
+    self.assertNotIn('maybeAttending', obj)
+
+  def test_iter_rsvps_first_page_only(self):
+    self.expect_urlopen(facebook.API_EVENT_RSVPS % '145304994', {
+      'data': RSVPS[:1],
+      'paging': {'cursors': {'after': 'xyz'}, 'next': 'http://the/next/page'},
+    })
+    self.mox.ReplayAll()
+    self.assert_equals(RSVP_OBJS_WITH_ID[:1],
+                       list(self.fb.iter_rsvps(EVENT, max_rsvps=None)))
+
   def test_get_activities_group_excludes_shared_story(self):
     self.expect_urlopen(
       'me/home?offset=0',
@@ -1105,8 +1324,7 @@ class FacebookTest(testutil.HandlerTest):
   def test_get_activities_self_includes_shared_story(self):
     post = copy.copy(POST)
     post['status_type'] = 'shared_story'
-    self.expect_urlopen('me/feed?offset=0', {'data': [post]})
-    self.expect_urlopen('me/photos/uploaded', {})
+    self.expect_self_batch(feed={'data': [post]})
     self.mox.ReplayAll()
     self.assert_equals([SELF_ACTIVITY],
                        self.fb.get_activities(group_id=source.SELF))
@@ -1118,7 +1336,7 @@ class FacebookTest(testutil.HandlerTest):
     post3['id'] = '333'
     self.expect_urlopen('me/home?offset=0',
                         {'data': [POST, post2, post3]})
-    self.expect_urlopen('comments?filter=stream&ids=222,333,10100176064482163',
+    self.expect_urlopen('comments?filter=stream&ids=10100176064482163,222,333',
       {'222': {'data': [{'id': '777', 'message': 'foo'},
                         {'id': '888', 'message': 'bar'}]},
        '333': {'data': [{'id': '999', 'message': 'baz'},
@@ -1144,8 +1362,7 @@ class FacebookTest(testutil.HandlerTest):
     self.assert_equals([activity], self.fb.get_activities(fetch_replies=True))
 
   def test_get_activities_skips_extras_if_no_posts(self):
-    self.expect_urlopen('me/feed?offset=0', {'data': []})
-    self.expect_urlopen('me/photos/uploaded', {})
+    self.expect_self_batch(feed={'data': []})
     self.mox.ReplayAll()
     self.assert_equals([], self.fb.get_activities(
       group_id=source.SELF, fetch_shares=True, fetch_replies=True))
@@ -2069,6 +2286,7 @@ cc Sam G, Michael M<br />""", preview.description)
     self.expect_urlopen('',
       data='batch=[{"method":"GET","relative_url":"abc"},'
                   '{"method":"GET","relative_url":"def"}]',
+      headers={'Content-type': 'application/x-www-form-urlencoded'},
       response=[{'code': 200, 'body': '{"abc": 1}'},
                 {'code': 200, 'body': '{"def": 2}'}])
     self.mox.ReplayAll()
@@ -2108,6 +2326,18 @@ cc Sam G, Michael M<br />""", preview.description)
         {'relative_url': 'abc', 'headers': {'X': 'Y', 'U': 'V'}},
         {'relative_url': 'def'})))
 
+  def test_urlopen_batch_full_splits_large_batches(self):
+    self.mox.stubs.Set(facebook, 'MAX_BATCH_REQUESTS', 2)
+    for url in 'a', 'b', 'c':
+      self.expect_batch_req(url, {url: 1})
+      if url != 'a':
+        self.expect_batch()
+    self.mox.ReplayAll()
+
+    self.assert_equals([{'a': 1}, {'b': 1}, {'c': 1}],
+                       [resp['body'] for resp in self.fb.urlopen_batch_full(
+                         [{'relative_url': url} for url in 'a', 'b', 'c'])])
+
   def test_urlopen_batch_full_errors(self):
     resps = [{'code': 501},
              {'code': 499, 'body': 'error body'}]
@@ -648,6 +648,7 @@ class FlickrTest(testutil.TestCase):
     appengine_config.FLICKR_APP_KEY = 'fake'
     appengine_config.FLICKR_APP_SECRET = 'fake'
     self.flickr = flickr.Flickr('key', 'secret')
+    self.mox.stubs.Set(flickr.Flickr, 'profile_urls_cache', source.LRUCache())
 
   def expect_call_api_method(self, method, params, result):
     full_params = {
@@ -664,7 +665,7 @@ class FlickrTest(testutil.TestCase):
       'user_id': '39216764@N00'
     }, json.dumps(PERSON_INFO))
 
-    self.expect_urlopen(
+    self.expect_requests_get(
       'https://www.flickr.com/people/kindofblue115/',
       PROFILE_HTML)
 
@@ -684,13 +685,68 @@ class FlickrTest(testutil.TestCase):
       'flickr.people.getInfo', {'user_id': '39216764@N00'},
       json.dumps(PERSON_INFO))
 
-    self.expect_urlopen(
+    self.expect_requests_get(
       'https://www.flickr.com/people/kindofblue115/',
       PROFILE_HTML)
 
     self.mox.ReplayAll()
     self.assert_equals(ACTOR, self.flickr.get_actor())
 
+  def test_user_id_cached_across_instances(self):
+    self.expect_call_api_method(
+      'flickr.people.getLimits', {},
+      json.dumps({'person': {'nsid': '39216764@N00'}, 'stat': 'ok'}))
+    self.expect_call_api_method(
+      'flickr.people.getInfo', {'user_id': '39216764@N00'},
+      json.dumps(PERSON_INFO))
+    # different access token
+    self.expect_call_api_method(
+      'flickr.people.getLimits', {},
+      json.dumps({'person': {'nsid': '123'}, 'stat': 'ok'}))
+    self.mox.ReplayAll()
+
+    for _ in range(2):
+      fl = flickr.Flickr('key', 'secret')
+      self.assertEquals('39216764@N00', fl.user_id())
+      self.assertEquals('kindofblue115', fl.path_alias())
+
+    self.assertEquals('123', flickr.Flickr('other', 'secret').user_id())
+
+  def test_user_to_actor_caches_profile_urls(self):
+    self.expect_requests_get('https://www.flickr.com/people/kindofblue115/',
+                             PROFILE_HTML)
+    self.mox.ReplayAll()
+
+    # second time should use the cache, not fetch the profile page again
+    for _ in range(2):
+      self.assert_equals(ACTOR, self.flickr.user_to_actor(PERSON_INFO))
+
+  def test_user_to_actor_profile_fetch_fails(self):
+    self.expect_requests_get('https://www.flickr.com/people/kindofblue115/',
+                             status_code=404)
+    self.expect_requests_get('https://www.flickr.com/people/kindofblue115/',
+                             PROFILE_HTML)
+    self.mox.ReplayAll()
+
+    actor = self.flickr.user_to_actor(PERSON_INFO)
+    self.assertNotIn('urls', actor)
+    # failures aren't cached
+    self.assert_equals(ACTOR, self.flickr.user_to_actor(PERSON_INFO))
+
+  def test_rel_me_urls(self):
+    self.assert_equals([
+      'http://a/b',
+      'http://x/y?z&w',
+      'http://a/rel',
+    ], flickr.rel_me_urls('''
+<link rel="me" href="http://a/b">
+<a href="http://c/" rel="nofollow">c</a>
+<a class='x' rel='nofollow me' href='http://x/y?z&amp;w'>xyz</a>
+<A HREF=/rel REL=me>relative</A>
+<a rel="me" href="http://a/b">dupe</a>
+<a rel="me">no href</a>
+''', 'http://a/'))
+
   def test_get_activities_defaults(self):
     self.expect_call_api_method(
       'flickr.photos.getContactsPhotos', {
@@ -701,6 +757,19 @@ class FlickrTest(testutil.TestCase):
     self.mox.ReplayAll()
     self.assert_equals(CONTACTS_PHOTOS_ACTIVITIES, self.flickr.get_activities())
 
+  def test_iter_activities(self):
+    for page, photos in (1, CONTACTS_PHOTOS), (2, {'photos': {'photo': []}}):
+      self.expect_call_api_method(
+        'flickr.photos.getRecent', {
+          'extras': flickr.Flickr.API_EXTRAS,
+          'per_page': 2,
+          'page': page,
+        }, json.dumps(photos))
+
+    self.mox.ReplayAll()
+    self.assert_equals(CONTACTS_PHOTOS_ACTIVITIES, list(
+      self.flickr.iter_activities(page_size=2, group_id=source.ALL)))
+
   def test_get_activities_specific(self):
     self.expect_call_api_method(
       'flickr.photos.getInfo', {
@@ -727,6 +796,192 @@ class FlickrTest(testutil.TestCase):
       [ACTIVITY_WITH_COMMENTS], self.flickr.get_activities(
         activity_id='5227922370', fetch_replies=True))
 
+  def test_get_activities_skips_unchanged_responses(self):
+    photos = copy.deepcopy(CONTACTS_PHOTOS)
+    for photo in photos['photos']['photo']:
+      photo.update({'count_comments': '1', 'count_faves': '2'})
+    self.expect_call_api_method(
+      'flickr.photos.getContactsPhotos', {
+        'extras': flickr.Flickr.API_EXTRAS,
+        'per_page': 50,
+      }, json.dumps(photos))
+
+    # first photo's counts are cached, second photo's have changed
+    self.expect_call_api_method('flickr.photos.comments.getList', {
+        'photo_id': '2345',
+    }, json.dumps({'comments': {}}))
+    self.expect_call_api_method('flickr.photos.getFavorites', {
+        'photo_id': '2345',
+    }, json.dumps({'photo': {}}))
+    self.mox.ReplayAll()
+
+    cache = source.LRUCache()
+    cache.set_multi({'AKC 1234': '1', 'AKL 1234': '2', 'AKC 2345': '0'})
+    self.flickr.get_activities(fetch_replies=True, fetch_likes=True,
+                               cache=cache)
+    self.assert_equals({'AKC 2345': '1', 'AKL 2345': '2'},
+                       cache.get_multi(['AKC 2345', 'AKL 2345']))
+
+  def photos_with_counts(self, *counts):
+    """Returns CONTACTS_PHOTOS with (comments, faves) counts for each photo."""
+    photos = copy.deepcopy(CONTACTS_PHOTOS)
+    for photo, (comments, faves) in zip(photos['photos']['photo'], counts):
+      photo.update({'count_comments': str(comments), 'count_faves': str(faves)})
+    return photos
+
+  def test_get_activities_self_uses_user_photos_activity(self):
+    self.expect_call_api_method(
+      'flickr.people.getPhotos', {
+        'extras': flickr.Flickr.API_EXTRAS,
+        'per_page': 50,
+        'user_id': 'me',
+      }, json.dumps(self.photos_with_counts((1, 1), (0, 0))))
+    self.expect_call_api_method(
+      'flickr.activity.userPhotos', {
+        'timeframe': flickr.Flickr.USER_PHOTOS_TIMEFRAME,
+        'per_page': 50,
+      }, json.dumps({'items': {'item': [{
+        'type': 'photo',
+        'id': '1234',
+        'owner': '5555',
+        'activity': {'event': [{
+          'type': 'comment',
+          'commentid': '5555-1234-999',
+          'user': '777',
+          'username': 'alice',
+          'dateadded': '1370799700',
+          '_content': 'nice pic',
+        }, {
+          'type': 'fave',
+          'user': '888',
+          'username': 'bob',
+          'dateadded': '1370799800',
+        }]},
+      }]}}))
+    self.mox.ReplayAll()
+
+    activities = self.flickr.get_activities(
+      group_id=source.SELF, fetch_replies=True, fetch_likes=True)
+
+    replies = activities[0]['object']['replies']
+    self.assertEquals(1, replies['totalItems'])
+    self.assertEquals('nice pic', replies['items'][0]['content'])
+    self.assertEquals(tag_uri('5555-1234-999'), replies['items'][0]['id'])
+    self.assertEquals(
+      'https://www.flickr.com/photos/5555/1234/#comment5555-1234-999',
+      replies['items'][0]['url'])
+    self.assertEquals(['bob'], [tag['author']['username'] for tag in
+                                activities[0]['object']['tags']
+                                if tag.get('verb') == 'like'])
+
+    self.assertEquals(0, activities[1]['object']['replies']['totalItems'])
+    self.assertFalse([tag for tag in activities[1]['object'].get('tags', [])
+                      if tag.get('verb') == 'like'])
+
+  def test_get_activities_self_user_photos_one_page_and_falls_back(self):
+    self.expect_call_api_method(
+      'flickr.people.getPhotos', {
+        'extras': flickr.Flickr.API_EXTRAS,
+        'per_page': 50,
+        'user_id': 'me',
+      }, json.dumps(self.photos_with_counts((2, 1), (1, 0))))
+
+    def comment(id, content):
+      return {'type': 'comment', 'commentid': id, 'user': '777',
+              'username': 'alice', 'dateadded': '1370799700',
+              '_content': content}
+
+    self.expect_call_api_method(
+      'flickr.activity.userPhotos', {
+        'timeframe': flickr.Flickr.USER_PHOTOS_TIMEFRAME,
+        'per_page': 50,
+      }, json.dumps({'items': {'page': 1, 'pages': 2, 'item': [{
+        'type': 'photo', 'id': '1234', 'owner': '5555',
+        'activity': {'event': [
+          comment('5555-1234-998', 'first'),
+          {'type': 'fave', 'user': '888', 'username': 'bob',
+           'dateadded': '1370799800'},
+        ]},
+      }]}}))
+
+    # 1234's other comment is on the next page, which we don't fetch, and
+    # 2345's comment is older than the timeframe, so they're fetched directly
+    comments = copy.deepcopy(PHOTO_COMMENTS)
+    comments['comments']['comment'] = [
+      {'id': '5555-1234-998', 'author': '777', '_content': 'first'},
+      {'id': '5555-1234-999', 'author': '777', '_content': 'second'},
+    ]
+    self.expect_call_api_method('flickr.photos.comments.getList', {
+        'photo_id': '1234',
+    }, json.dumps(comments))
+    self.expect_call_api_method('flickr.photos.comments.getList', {
+        'photo_id': '2345',
+    }, json.dumps(PHOTO_COMMENTS))
+    self.mox.ReplayAll()
+
+    cache = source.LRUCache()
+    activities = self.flickr.get_activities(
+      group_id=source.SELF, fetch_replies=True, fetch_likes=True, cache=cache)
+
+    self.assertEquals(['first', 'second'], [
+      r['content'] for r in activities[0]['object']['replies']['items']])
+    self.assertEquals(['Love this!'], [
+      r['content'] for r in activities[1]['object']['replies']['items']])
+    self.assertEquals('2', cache.get('AKC 1234'))
+    self.assertEquals('1', cache.get('AKC 2345'))
+
+  def test_get_activities_self_user_photos_saves_calls(self):
+    calls = []
+    call_api_method = self.flickr.call_api_method
+    def count_calls(method, params={}):
+      calls.append(method)
+      return call_api_method(method, params)
+    self.mox.stubs.Set(self.flickr, 'call_api_method', count_calls)
+
+    cache = source.LRUCache()
+    cache.set_multi({'AKC 1234': '0', 'AKL 1234': '0'})
+
+    # two response lists to fetch, so userPhotos replaces both calls
+    self.expect_call_api_method(
+      'flickr.people.getPhotos', {
+        'extras': flickr.Flickr.API_EXTRAS,
+        'per_page': 50,
+        'user_id': 'me',
+      }, json.dumps(self.photos_with_counts((0, 0), (1, 1))))
+    self.expect_call_api_method(
+      'flickr.activity.userPhotos', {
+        'timeframe': flickr.Flickr.USER_PHOTOS_TIMEFRAME,
+        'per_page': 50,
+      }, json.dumps({'items': {'item': [{
+        'type': 'photo', 'id': '2345', 'owner': '5555',
+        'activity': {'event': [
+          {'type': 'comment', 'commentid': '5555-2345-999', 'user': '777',
+           'username': 'alice', 'dateadded': '1370799700', '_content': 'hi'},
+          {'type': 'fave', 'user': '888', 'username': 'bob',
+           'dateadded': '1370799800'},
+        ]},
+      }]}}))
+
+    # only one response list to fetch, so userPhotos wouldn't save anything
+    self.expect_call_api_method(
+      'flickr.people.getPhotos', {
+        'extras': flickr.Flickr.API_EXTRAS,
+        'per_page': 50,
+        'user_id': 'me',
+      }, json.dumps(self.photos_with_counts((0, 0), (2, 1))))
+    self.expect_call_api_method('flickr.photos.comments.getList', {
+        'photo_id': '2345',
+    }, json.dumps(PHOTO_COMMENTS))
+    self.mox.ReplayAll()
+
+    for _ in range(2):
+      self.flickr.get_activities(group_id=source.SELF, fetch_replies=True,
+                                 fetch_likes=True, cache=cache)
+
+    self.assertEquals(['flickr.people.getPhotos', 'flickr.activity.userPhotos',
+                       'flickr.people.getPhotos',
+                       'flickr.photos.comments.getList'], calls)
+
   def test_get_activities_with_faves(self):
     self.expect_call_api_method(
       'flickr.photos.getInfo', {
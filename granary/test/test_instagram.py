@@ -424,36 +424,133 @@ this picture -&gt; is #abc #xyz
 """
 
 
-class InstagramTest(testutil.HandlerTest):
+class InstagramTest(testutil.TestCase):
 
   def setUp(self):
     super(InstagramTest, self).setUp()
     self.instagram = instagram.Instagram()
 
   def test_get_actor(self):
-    self.expect_urlopen('https://api.instagram.com/v1/users/foo',
+    self.expect_source_urlopen('https://api.instagram.com/v1/users/foo',
                         json.dumps({'data': USER}))
     self.mox.ReplayAll()
     self.assert_equals(ACTOR, self.instagram.get_actor('foo'))
 
   def test_get_actor_default(self):
-    self.expect_urlopen('https://api.instagram.com/v1/users/self',
+    self.expect_source_urlopen('https://api.instagram.com/v1/users/self',
                         json.dumps({'data': USER}))
     self.mox.ReplayAll()
     self.assert_equals(ACTOR, self.instagram.get_actor())
 
+  def test_get_actor_default_not_cached(self):
+    for _ in range(2):
+      self.expect_source_urlopen(
+        'https://api.instagram.com/v1/users/self?access_token=asdf',
+        json.dumps({'data': USER}))
+    self.mox.ReplayAll()
+    for _ in range(2):
+      self.assert_equals(
+        ACTOR, instagram.Instagram(access_token='asdf').get_actor())
+
+  def test_get_activities_self_fetch_likes_caches_user(self):
+    for i in range(2):
+      self.expect_source_urlopen(
+        'https://api.instagram.com/v1/users/self/media/recent?access_token=asdf',
+        json.dumps({'data': [MEDIA]}))
+      self.expect_source_urlopen(
+        'https://api.instagram.com/v1/users/self/media/liked?access_token=asdf',
+        json.dumps({'data': [MEDIA_WITH_LIKES]}))
+      if i == 0:  # the second time uses the cached user
+        self.expect_source_urlopen(
+          'https://api.instagram.com/v1/users/self?access_token=asdf',
+          json.dumps({'data': LIKES[0]}))
+    self.mox.ReplayAll()
+
+    for _ in range(2):
+      activities = instagram.Instagram(access_token='asdf').get_activities(
+        group_id=source.SELF, fetch_likes=True)
+      self.assert_equals([ACTIVITY] + [LIKE_OBJS[0]], activities)
+      # modifying the returned objects doesn't change the cached user
+      activities[1]['author']['displayName'] = 'changed'
+
   def test_get_activities_self(self):
-    self.expect_urlopen('https://api.instagram.com/v1/users/self/media/recent',
+    self.expect_source_urlopen('https://api.instagram.com/v1/users/self/media/recent',
                         json.dumps({'data': []}))
     self.mox.ReplayAll()
     self.assert_equals([], self.instagram.get_activities(group_id=source.SELF))
 
+  def test_iter_activities(self):
+    self.expect_source_urlopen(
+      'https://api.instagram.com/v1/users/self/media/recent?count=1',
+      json.dumps({'data': [MEDIA]}))
+    self.expect_source_urlopen(
+      'https://api.instagram.com/v1/users/self/media/recent?count=1&max_id=123_456',
+      json.dumps({'data': []}))
+    self.mox.ReplayAll()
+    self.assert_equals([ACTIVITY], list(
+      self.instagram.iter_activities(page_size=1, group_id=source.SELF)))
+
+  def test_get_activities_follows_pagination(self):
+    other = copy.deepcopy(MEDIA)
+    other['id'] = '789_456'
+    self.expect_source_urlopen(
+      'https://api.instagram.com/v1/users/self/media/recent?count=3',
+      json.dumps({'data': [MEDIA], 'pagination': {'next_max_id': '123_456'}}))
+    self.expect_source_urlopen(
+      'https://api.instagram.com/v1/users/self/media/recent?count=2&max_id=123_456',
+      json.dumps({'data': [other, MEDIA], 'pagination': {'next_max_id': 'x'}}))
+    self.mox.ReplayAll()
+
+    activities = self.instagram.get_activities(group_id=source.SELF,
+                                               start_index=1, count=2)
+    self.assert_equals([tag_uri('789_456'), tag_uri('123_456')],
+                       [a['id'] for a in activities])
+
+  def test_get_activities_pagination_stops_at_last_page(self):
+    self.expect_source_urlopen('https://api.instagram.com/v1/users/self/feed?count=5',
+                        json.dumps({'data': [MEDIA], 'pagination': {}}))
+    self.mox.ReplayAll()
+    self.assert_equals([ACTIVITY], self.instagram.get_activities(count=5))
+
+  def test_get_activities_fetch_replies_expands_truncated_comments(self):
+    truncated = copy.deepcopy(MEDIA)
+    truncated['comments'] = {'data': [], 'count': len(COMMENTS)}
+    self.expect_source_urlopen('https://api.instagram.com/v1/users/self/feed',
+                        json.dumps({'data': [truncated, MEDIA]}))
+    self.expect_source_urlopen('https://api.instagram.com/v1/media/123_456/comments',
+                        json.dumps({'data': COMMENTS}))
+    # second time, the comment count is unchanged, so it's not refetched
+    self.expect_source_urlopen('https://api.instagram.com/v1/users/self/feed',
+                        json.dumps({'data': [truncated]}))
+    self.mox.ReplayAll()
+
+    cache = source.LRUCache()
+    self.assert_equals([ACTIVITY, ACTIVITY], self.instagram.get_activities(
+      fetch_replies=True, cache=cache))
+    self.assert_equals(len(COMMENTS), cache.get('AIC 123_456'))
+
+    activities = self.instagram.get_activities(fetch_replies=True, cache=cache)
+    self.assertNotIn('items', activities[0]['object']['replies'])
+
+  def test_get_activities_fetch_replies_ignores_4xx(self):
+    truncated = copy.deepcopy(MEDIA)
+    truncated['comments'] = {'data': [], 'count': len(COMMENTS)}
+    self.expect_source_urlopen('https://api.instagram.com/v1/users/self/feed',
+                        json.dumps({'data': [truncated]}))
+    self.expect_source_urlopen('https://api.instagram.com/v1/media/123_456/comments',
+                        '{"meta":{"error_type":"APINotFoundError"}}',
+                        status=400)
+    self.mox.ReplayAll()
+
+    activities = self.instagram.get_activities(fetch_replies=True)
+    self.assertNotIn('items', activities[0]['object']['replies'])
+
   def test_get_activities_self_fetch_likes(self):
-    self.expect_urlopen('https://api.instagram.com/v1/users/self/media/recent',
+    self.expect_source_urlopen('https://api.instagram.com/v1/users/self/media/recent',
                         json.dumps({'data': [MEDIA]}))
-    self.expect_urlopen('https://api.instagram.com/v1/users/self/media/liked',
+    self.expect_source_urlopen('https://api.instagram.com/v1/users/self/media/liked',
                         json.dumps({'data': [MEDIA_WITH_LIKES]}))
-    self.expect_urlopen('https://api.instagram.com/v1/users/self',
+    self.expect_source_urlopen('https://api.instagram.com/v1/users/self',
                         json.dumps({'data': LIKES[0]}))
     self.mox.ReplayAll()
     self.assert_equals(
@@ -461,7 +558,7 @@ class InstagramTest(testutil.HandlerTest):
       self.instagram.get_activities(group_id=source.SELF, fetch_likes=True))
 
   def test_get_activities_passes_through_access_token(self):
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.instagram.com/v1/users/self/feed?access_token=asdf',
       json.dumps({'meta': {'code': 200}, 'data': []}))
     self.mox.ReplayAll()
@@ -470,7 +567,7 @@ class InstagramTest(testutil.HandlerTest):
     self.instagram.get_activities()
 
   def test_get_activities_activity_id(self):
-    self.expect_urlopen('https://api.instagram.com/v1/media/000',
+    self.expect_source_urlopen('https://api.instagram.com/v1/media/000',
                         json.dumps({'data': MEDIA}))
     self.mox.ReplayAll()
 
@@ -480,34 +577,34 @@ class InstagramTest(testutil.HandlerTest):
         start_index=3, count=6))
 
   def test_get_activities_activity_id_not_found(self):
-    self.expect_urlopen('https://api.instagram.com/v1/media/000',
+    self.expect_source_urlopen('https://api.instagram.com/v1/media/000',
                         '{"meta":{"error_type":"APINotFoundError"}}',
                         status=400)
     self.mox.ReplayAll()
     self.assert_equals([], self.instagram.get_activities(activity_id='000'))
 
   def test_get_activities_with_likes(self):
-    self.expect_urlopen('https://api.instagram.com/v1/users/self/feed',
+    self.expect_source_urlopen('https://api.instagram.com/v1/users/self/feed',
                         json.dumps({'data': [MEDIA_WITH_LIKES]}))
     self.mox.ReplayAll()
     self.assert_equals([ACTIVITY_WITH_LIKES], self.instagram.get_activities())
 
   def test_get_activities_other_400_error(self):
-    self.expect_urlopen('https://api.instagram.com/v1/media/000',
+    self.expect_source_urlopen('https://api.instagram.com/v1/media/000',
                         'BAD REQUEST', status=400)
     self.mox.ReplayAll()
     self.assertRaises(urllib2.HTTPError, self.instagram.get_activities,
                       activity_id='000')
 
   def test_get_activities_min_id(self):
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.instagram.com/v1/users/self/media/recent?min_id=135',
       json.dumps({'data': []}))
     self.mox.ReplayAll()
     self.instagram.get_activities(group_id=source.SELF, min_id='135')
 
   def test_get_activities_search(self):
-    self.expect_urlopen('https://api.instagram.com/v1/tags/indieweb/media/recent',
+    self.expect_source_urlopen('https://api.instagram.com/v1/tags/indieweb/media/recent',
                         json.dumps({'data': [MEDIA]}))
     self.mox.ReplayAll()
     self.assert_equals([ACTIVITY], self.instagram.get_activities(
@@ -518,39 +615,39 @@ class InstagramTest(testutil.HandlerTest):
       self.instagram.get_activities(search_query='foo')
 
   def test_get_video(self):
-    self.expect_urlopen('https://api.instagram.com/v1/media/5678',
+    self.expect_source_urlopen('https://api.instagram.com/v1/media/5678',
                         json.dumps({'data': VIDEO}))
     self.mox.ReplayAll()
     self.assert_equals([VIDEO_ACTIVITY], self.instagram.get_activities(activity_id='5678'))
 
 
   def test_get_comment(self):
-    self.expect_urlopen('https://api.instagram.com/v1/media/123_456',
+    self.expect_source_urlopen('https://api.instagram.com/v1/media/123_456',
                         json.dumps({'data': MEDIA}))
     self.mox.ReplayAll()
     self.assert_equals(COMMENT_OBJS[0],
                        self.instagram.get_comment('789', activity_id='123_456'))
 
   def test_get_comment_not_found(self):
-    self.expect_urlopen('https://api.instagram.com/v1/media/123_456',
+    self.expect_source_urlopen('https://api.instagram.com/v1/media/123_456',
                         json.dumps({'data': MEDIA}))
     self.mox.ReplayAll()
     self.assert_equals(None, self.instagram.get_comment('111', activity_id='123_456'))
 
   def test_get_like(self):
-    self.expect_urlopen('https://api.instagram.com/v1/media/000',
+    self.expect_source_urlopen('https://api.instagram.com/v1/media/000',
                         json.dumps({'data': MEDIA_WITH_LIKES}))
     self.mox.ReplayAll()
     self.assert_equals(LIKE_OBJS[1], self.instagram.get_like('123', '000', '9'))
 
   def test_get_like_not_found(self):
-    self.expect_urlopen('https://api.instagram.com/v1/media/000',
+    self.expect_source_urlopen('https://api.instagram.com/v1/media/000',
                         json.dumps({'data': MEDIA}))
     self.mox.ReplayAll()
     self.assert_equals(None, self.instagram.get_like('123', '000', 'xyz'))
 
   def test_get_like_no_activity(self):
-    self.expect_urlopen('https://api.instagram.com/v1/media/000',
+    self.expect_source_urlopen('https://api.instagram.com/v1/media/000',
                         '{"meta":{"error_type":"APINotFoundError"}}',
                         status=400)
     self.mox.ReplayAll()
@@ -619,15 +716,15 @@ class InstagramTest(testutil.HandlerTest):
     self.assertIn('this post', preview.description)
 
   def test_create_like(self):
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.instagram.com/v1/media/shortcode/ABC123',
       json.dumps({'data': MEDIA}))
 
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.instagram.com/v1/media/123_456/likes',
       '{"meta":{"status":200}}', data='access_token=None')
 
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.instagram.com/v1/users/self',
       json.dumps({'data': {
         'id': '8',
@@ -659,7 +756,7 @@ class InstagramTest(testutil.HandlerTest):
     self.assertIn('very cute', preview.content)
 
   def test_create_comment(self):
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.instagram.com/v1/media/123_456/comments',
       '{"meta":{"status":200}}',
       data=urllib.urlencode({'access_token': self.instagram.access_token,
@@ -680,7 +777,7 @@ class InstagramTest(testutil.HandlerTest):
   def test_create_comment_unauthorized(self):
     # a more realistic test. this is what happens when you try to
     # create comments with the API, with an unapproved app
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.instagram.com/v1/media/123_456/comments',
       data=urllib.urlencode({'access_token': self.instagram.access_token,
                              'text': COMMENTS[0]['text']}),
@@ -5,8 +5,18 @@
 __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
 import copy
+import os
+import shutil
+import tempfile
+import threading
+import time
+import urllib2
+
+import appengine_config
+import requests
 
 from granary import facebook
+from granary import flickr
 from granary import googleplus
 from granary import instagram
 from granary import source
@@ -204,6 +214,45 @@ class SourceTest(testutil.TestCase):
     check(obj, ['http://or.ig/post/redirected', 'http://other/link/redirected'],
           include_redirect_sources=False)
 
+  def test_original_post_discovery_multi(self):
+    # each URL should only be resolved once
+    self.expect_requests_head('http://sho.rt/post',
+                              redirected_url='http://or.ig/post')
+    self.expect_requests_head('http://x/y')
+    self.mox.ReplayAll()
+
+    self.assert_equals([
+      ({'http://sho.rt/post', 'http://or.ig/post'}, set()),
+      ({'http://or.ig/post', 'http://sho.rt/post'}, {'http://x/y'}),
+    ], Source.original_post_discovery_multi([
+      {'object': {'content': 'foo http://sho.rt/post'}},
+      {'content': 'http://x/y bar', 'upstreamDuplicates': ['http://sho.rt/post']},
+    ], domains=['or.ig']))
+
+  def test_follow_redirects_multi_per_domain_limit(self):
+    self.mox.stubs.Set(source, 'MAX_CONCURRENT_REQUESTS', 10)
+    self.mox.stubs.Set(source, 'MAX_CONCURRENT_REQUESTS_PER_DOMAIN', 2)
+    self.mox.stubs.Set(source, '_domain_semaphores', {})
+
+    running = []
+    lock = threading.Lock()
+    def follow_redirects(url, **kwargs):
+      domain = url.split('/')[2]
+      with lock:
+        running.append(domain)
+        assert running.count(domain) <= 2, running
+      threading.Event().wait(.01)
+      with lock:
+        running.remove(domain)
+      return url
+    self.mox.stubs.Set(source, 'follow_redirects', follow_redirects)
+
+    urls = ['http://%s/%d' % (domain, i) for domain in 'a', 'b' for i in range(4)]
+    self.assertEquals({url: url for url in urls},
+                      source.follow_redirects_multi(urls + urls[:3]))
+    # semaphores are dropped once they're not in use
+    self.assertEquals({}, source._domain_semaphores)
+
   def test_get_like(self):
     self.source.get_activities(user_id='author', activity_id='activity',
                                fetch_likes=True).AndReturn([ACTIVITY])
@@ -338,6 +387,17 @@ class SourceTest(testutil.TestCase):
     self.assertEquals(instagram.Instagram, source.sources['instagram'])
     self.assertEquals(twitter.Twitter, source.sources['twitter'])
 
+  def test_source_registry_imports_silos_on_lookup(self):
+    registry = source.SourceRegistry()
+    self.assertEquals(flickr.Flickr, registry['flickr'])
+    self.assertEquals(googleplus.GooglePlus, registry.get('google+'))
+    self.assertEquals({'flickr': flickr.Flickr, 'google+': googleplus.GooglePlus},
+                      registry)
+
+    self.assertIsNone(registry.get('nope'))
+    with self.assertRaises(KeyError):
+      registry['nope']
+
   def test_follow_redirects(self):
     for i in range(2):
       self.expect_requests_head('http://will/redirect',
@@ -361,6 +421,46 @@ class SourceTest(testutil.TestCase):
       'http://final/url',
       source.follow_redirects('http://will/redirect', cache=cache).url)
 
+  def test_follow_redirects_cache_tiers(self):
+    self.expect_requests_head('http://will/redirect',
+                              redirected_url='http://final/url',
+                              content_type='text/plain')
+    self.mox.ReplayAll()
+
+    cache = util.CacheDict()
+    source.follow_redirects('http://will/redirect', cache=cache)
+    record = source.ResolvedURL('http://final/url', 200, 'text/plain')
+    self.assertEquals(record, cache['R http://will/redirect'])
+    self.assertEquals(record, cache['R http://final/url'])
+    self.assertEquals(record, source.redirect_cache.get('R http://will/redirect'))
+
+    # should use the in memory cache, not the external cache
+    cache.clear()
+    resolved = source.follow_redirects('http://will/redirect', cache=cache)
+    self.assertEquals('http://final/url', resolved.url)
+    self.assertEquals(200, resolved.status_code)
+    self.assertEquals('text/plain', resolved.headers['content-type'])
+
+    # should fall back to the external cache and populate the in memory cache
+    source.redirect_cache.clear()
+    cache['R http://x'] = source.ResolvedURL('http://y', 200, 'text/html')
+    self.assertEquals('http://y',
+                      source.follow_redirects('http://x', cache=cache).url)
+    self.assertEquals(cache['R http://x'], source.redirect_cache.get('R http://x'))
+
+  def test_follow_redirects_caches_failures(self):
+    self.expect_requests_head('http://fail', status_code=500)
+    cache = self.mox.CreateMock(util.CacheDict)
+    cache.get('R http://fail').AndReturn(None)
+    record = source.ResolvedURL('http://fail', 499, 'text/html')
+    cache.set_multi({'R http://fail': record},
+                    time=source.FAILED_RESOLVE_URL_CACHE_TIME)
+    self.mox.ReplayAll()
+
+    self.assertEquals(499, source.follow_redirects('http://fail', cache=cache)
+                           .status_code)
+    self.assertEquals(record, source.redirect_cache.get('R http://fail'))
+
   def test_follow_redirects_with_refresh_header(self):
     headers = {'x': 'y'}
     self.expect_requests_head('http://will/redirect', headers=headers,
@@ -379,8 +479,310 @@ class SourceTest(testutil.TestCase):
     self.mox.ReplayAll()
     self.assert_equals('http://final', source.follow_redirects('foo/bar').url)
 
+  def test_parallel_map(self):
+    self.mox.stubs.Set(source, 'MAX_CONCURRENT_REQUESTS', 10)
+    self.assertEquals([], source.parallel_map(lambda x: x, [], max_workers=3))
+    self.assertEquals([2, 4, 6, 8, 10], source.parallel_map(
+      lambda x: x * 2, [1, 2, 3, 4, 5], max_workers=3))
+
+  def test_parallel_map_runs_concurrently(self):
+    self.mox.stubs.Set(source, 'MAX_CONCURRENT_REQUESTS', 10)
+    # each call waits until all three have started
+    started = []
+    def fn(x):
+      started.append(x)
+      for _ in range(100):
+        if len(started) == 3:
+          return x
+        threading.Event().wait(.01)
+      raise AssertionError('calls ran serially')
+
+    self.assertEquals(['a', 'b', 'c'],
+                      source.parallel_map(fn, ['a', 'b', 'c'], max_workers=3))
+
+  def test_parallel_map_raises_first_exception(self):
+    def fn(x):
+      if x % 2:
+        raise ValueError(x)
+      return x
+
+    with self.assertRaises(ValueError) as e:
+      source.parallel_map(fn, [2, 3, 4, 5])
+    self.assertEquals((3,), e.exception.args)
+
+    self.mox.stubs.Set(source, 'MAX_CONCURRENT_REQUESTS', 10)
+    with self.assertRaises(ValueError) as e:
+      source.parallel_map(fn, [2, 3, 4, 5], max_workers=4)
+    self.assertEquals((3,), e.exception.args)
+
+  def test_parallel_map_global_limit(self):
+    self.mox.stubs.Set(source, 'MAX_CONCURRENT_REQUESTS', 2)
+    running = []
+    def fn(x):
+      running.append(x)
+      assert len(running) <= 2
+      threading.Event().wait(.01)
+      running.remove(x)
+      return x
+
+    self.assertEquals(range(6), source.parallel_map(fn, range(6), max_workers=5))
+
+  def test_http_session_shared(self):
+    session = source.http_session()
+    self.assertIs(session, source.http_session())
+    adapter = session.get_adapter('https://foo.com/')
+    self.assertIs(adapter, session.get_adapter('http://bar.com/'))
+    self.assertEquals(source.HTTP_POOL_MAXSIZE, adapter._pool_maxsize)
+
+    # cookies aren't shared across requests
+    cookie = requests.cookies.create_cookie('a', 'b', domain='foo.com')
+    session.cookies.set_cookie_if_ok(cookie, urllib2.Request('http://foo.com/'))
+    self.assertEquals(0, len(session.cookies))
+
+  def test_http_request(self):
+    self.expect_requests_get('http://foo', 'xyz', headers={'X': 'y'})
+    self.expect_requests_post('http://bar', status_code=400, data='abc',
+                              timeout=3)
+    self.mox.ReplayAll()
+
+    self.assertEquals('xyz', source.http_request('GET', 'http://foo',
+                                                 headers={'X': 'y'}).text)
+    self.assertEquals(400, source.http_request('POST', 'http://bar', data='abc',
+                                               timeout=3).status_code)
+
+  def test_urlopen(self):
+    self.expect_source_urlopen('http://foo', 'xyz', headers={'X': 'y'},
+                               response_headers={'ETag': '"abc"'})
+    self.expect_source_urlopen(
+      'http://bar', 'my error', status=404, data='abc',
+      headers={'Content-type': 'application/x-www-form-urlencoded'})
+    self.requests.get('http://baz', headers={},
+                      timeout=appengine_config.HTTP_TIMEOUT
+                      ).AndRaise(requests.ConnectionError('foo'))
+    self.mox.ReplayAll()
+
+    resp = source.urlopen(urllib2.Request('http://foo', headers={'X': 'y'}))
+    self.assertEquals(200, resp.getcode())
+    self.assertEquals('"abc"', resp.info().get('ETag'))
+    self.assertEquals('xyz', resp.read())
+
+    with self.assertRaises(urllib2.HTTPError) as e:
+      source.urlopen(urllib2.Request('http://bar', data='abc'))
+    self.assertEquals(404, e.exception.code)
+    self.assertEquals('my error', e.exception.read())
+
+    self.assertRaises(urllib2.URLError, source.urlopen, 'http://baz')
+
+  def test_lru_cache(self):
+    cache = source.LRUCache(max_size=2)
+    self.assertIsNone(cache.get('a'))
+    cache.set('a', 1)
+    cache.set_multi({'b': 2})
+    self.assertEquals({'a': 1, 'b': 2}, cache.get_multi(['a', 'b', 'c']))
+
+    # a was used more recently than b, so b gets evicted
+    cache.get('a')
+    cache.set('c', 3)
+    self.assertEquals({'a': 1, 'c': 3}, cache.get_multi(['a', 'b', 'c']))
+
+    cache.delete('a')
+    self.assertIsNone(cache.get('a'))
+    self.assertEquals(1, len(cache))
+
+  def test_lru_cache_expiration(self):
+    now = [1000]
+    cache = source.LRUCache()
+    self.mox.stubs.Set(cache, '_now', lambda: now[0])
+    cache.set('a', 1, time=10)
+    cache.set_multi({'b': 2}, time=20)
+    cache.set('c', 3)
+
+    now[0] = 1015
+    self.assertEquals({'b': 2, 'c': 3}, cache.get_multi(['a', 'b', 'c']))
+    now[0] = 1000000
+    self.assertIsNone(cache.get('b'))
+    self.assertEquals(3, cache.get('c'))
+
+  def test_lru_cache_max_bytes(self):
+    cache = source.LRUCache(max_bytes=10)
+    cache.set('a', 'xxxx')
+    cache.set('b', 'yyyy')
+    self.assertEquals('xxxx', cache.get('a'))  # now b is least recently used
+
+    cache.set('c', 'zzzz')
+    self.assertIsNone(cache.get('b'))
+    self.assertEquals({'a': 'xxxx', 'c': 'zzzz'},
+                      cache.get_multi(['a', 'b', 'c']))
+
+    # replacing and deleting free up their space
+    cache.set('a', 'x')
+    cache.delete('c')
+    cache.set('d', 'wwwwwwww')
+    self.assertEquals({'a': 'x', 'd': 'wwwwwwww'},
+                      cache.get_multi(['a', 'c', 'd']))
+
+    # values bigger than max_bytes aren't kept
+    cache.set('e', 'v' * 11)
+    self.assertEquals(0, len(cache))
+
   def test_post_id(self):
     self.assertEquals('1', self.source.post_id('http://x/y/1'))
     self.assertEquals('1', self.source.post_id('http://x/y/1/'))
     self.assertIsNone(self.source.post_id('http://x/'))
     self.assertIsNone(self.source.post_id(''))
+
+  def test_iter_activities(self):
+    self.source.get_activities(start_index=0, count=2, group_id='@self'
+                               ).AndReturn([{'id': 'a'}, {'id': 'b'}])
+    self.source.get_activities(start_index=2, count=2, group_id='@self'
+                               ).AndReturn([{'id': 'c'}])
+    self.mox.ReplayAll()
+
+    self.assert_equals([{'id': 'a'}, {'id': 'b'}, {'id': 'c'}], list(
+      self.source.iter_activities(page_size=2, group_id='@self')))
+
+  def test_iter_activities_fetches_lazily(self):
+    self.source.get_activities(start_index=0, count=2
+                               ).AndReturn([{'id': 'a'}, {'id': 'b'}])
+    self.mox.ReplayAll()
+
+    activities = self.source.iter_activities(page_size=2)
+    self.assert_equals({'id': 'a'}, activities.next())
+    self.assert_equals({'id': 'b'}, activities.next())
+
+  def test_iter_activities_max_empty_pages(self):
+    self.mox.stubs.Set(source, 'ITER_ACTIVITIES_MAX_EMPTY_PAGES', 2)
+    pages = [([], 1), ([{'id': 'a'}], 2), ([], 3), ([], 4), ([{'id': 'b'}], 5)]
+    self.mox.stubs.Set(self.source, '_get_activities_page',
+                       lambda cursor, count, **kwargs: pages[cursor or 0])
+    self.assert_equals([{'id': 'a'}], list(self.source.iter_activities()))
+
+  def test_iter_activities_activity_id(self):
+    self.source.get_activities(activity_id='x').AndReturn([{'id': 'x'}])
+    self.mox.ReplayAll()
+    self.assert_equals([{'id': 'x'}],
+                       list(self.source.iter_activities(activity_id='x')))
+
+  def make_temp_dir(self):
+    dir = tempfile.mkdtemp()
+    self.addCleanup(shutil.rmtree, dir)
+    return dir
+
+  def test_file_cache(self):
+    filename = os.path.join(self.make_temp_dir(), 'cache.json')
+    cache = source.FileCache(filename)
+    cache.set_multi({'a': 1, 'b': {'c': 'd'}})
+    cache.set('x', 2, time=10)
+    cache.delete('a')
+
+    # should be persisted
+    cache = source.FileCache(filename)
+    self.assertEquals(2, len(cache))
+    self.assertEquals({'b': {'c': 'd'}, 'x': 2},
+                      cache.get_multi(['a', 'b', 'x']))
+
+    cache = source.FileCache(filename)
+    self.mox.stubs.Set(cache, '_now', lambda: time.time() + 11)
+    self.assertIsNone(cache.get('x'))
+
+  def test_file_cache_failed_write_keeps_old_file(self):
+    dir = self.make_temp_dir()
+    filename = os.path.join(dir, 'cache.json')
+    cache = source.FileCache(filename)
+    cache.set('a', 1)
+
+    # sets aren't JSON serializable, so this fails partway through writing
+    self.assertRaises(TypeError, cache.set, 'b', set([2]))
+    self.assertEquals(['cache.json'], os.listdir(dir))
+    self.assertEquals({'a': 1}, source.FileCache(filename).get_multi(['a', 'b']))
+
+  def test_sync_activities_response(self):
+    self.mox.StubOutWithMock(self.source, 'get_activities_response')
+    state = source.LRUCache()
+
+    self.source.get_activities_response(
+      user_id='me', group_id=None, min_id=None, etag=None, cache=state,
+      fetch_replies=True).AndReturn({
+        'items': [{'id': 'tag:fake.com:9_1'}, {'id': '12_1'},
+                  {'id': '99_1', 'verb': 'like'}],
+        'etag': '"x"'})
+    self.source.get_activities_response(
+      user_id='me', group_id=None, min_id='12_1', etag='"x"', cache=state,
+      fetch_replies=True).AndReturn({'items': [{'id': '11_1'}]})
+    self.source.get_activities_response(
+      user_id='me', group_id=None, min_id='5', etag='"x"', cache=state
+      ).AndReturn({'items': []})
+    self.mox.ReplayAll()
+
+    for _ in range(2):
+      self.source.sync_activities_response(state, user_id='me',
+                                           fetch_replies=True)
+    self.assertEquals({'min_id': '12_1', 'etag': '"x"'},
+                      state.get('SYNC fake.com me None'))
+
+    # explicit kwargs override the stored marks
+    self.source.sync_activities_response(state, user_id='me', min_id='5')
+
+  def test_response_counts(self):
+    cache = source.LRUCache()
+    cache.set_multi({'AXC 1': 3, 'AXL 1': 'x', 'AXS 2': 5})
+    counts = source.ResponseCounts(cache, 'AX', ['1', '2'])
+
+    self.assertFalse(counts.changed(counts.REPLIES, '1', 3))
+    self.assertTrue(counts.changed(counts.REPLIES, '1', 4))
+    self.assertFalse(counts.changed(counts.LIKES, '1', 'x'))
+    self.assertTrue(counts.changed(counts.SHARES, '1', 5))
+    self.assertTrue(counts.changed(counts.SHARES, '2', None))
+
+    counts.update(counts.REPLIES, '1', 4)
+    counts.update(counts.SHARES, '2', None)  # ignored
+    self.assertEquals(3, cache.get('AXC 1'))  # not written until save()
+    counts.save()
+    self.assertEquals(4, cache.get('AXC 1'))
+    self.assertEquals(5, cache.get('AXS 2'))
+
+    # no cache
+    counts = source.ResponseCounts(None, 'AX', ['1'])
+    self.assertTrue(counts.changed(counts.REPLIES, '1', 3))
+    counts.update(counts.REPLIES, '1', 3)
+    counts.save()
+
+  def test_cached_identity(self):
+    fetches = []
+    def fetch():
+      fetches.append(None)
+      return 'me'
+
+    for _ in range(2):
+      self.assertEquals('me', FakeSource().cached_identity(
+        'user_id', ('key', 'secret'), fetch))
+    self.assertEquals(1, len(fetches))
+
+    # tokens are hashed, not stored
+    key = source.identity_cache._entries.keys()[0]
+    self.assertTrue(key.startswith('ID fake.com user_id '))
+    self.assertNotIn('key', key[len('ID fake.com user_id '):])
+    self.assertNotIn('secret', key)
+
+    # without a token, don't cache
+    for _ in range(2):
+      self.source.cached_identity('user_id', ('key', None), fetch)
+    self.assertEquals(3, len(fetches))
+
+  def test_cached_identity_returns_copies_and_expires(self):
+    now = [1000]
+    self.mox.stubs.Set(source.identity_cache, '_now', lambda: now[0])
+    fetches = []
+    def fetch():
+      fetches.append(None)
+      return {'name': 'me'}
+
+    user = self.source.cached_identity('user', ('key',), fetch, time=10)
+    user['name'] = 'changed'
+    self.assertEquals({'name': 'me'}, self.source.cached_identity(
+      'user', ('key',), fetch, time=10))
+    self.assertEquals(1, len(fetches))
+
+    now[0] = 1011
+    self.source.cached_identity('user', ('key',), fetch, time=10)
+    self.assertEquals(2, len(fetches))
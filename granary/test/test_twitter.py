@@ -560,32 +560,35 @@ class TwitterTest(testutil.TestCase):
     self.orig_max_tweet_length = twitter.MAX_TWEET_LENGTH
     self.orig_tco_length = twitter.TCO_LENGTH
     self.twitter = twitter.Twitter('key', 'secret')
+    self.mox.stubs.Set(twitter.Twitter, 'mention_cache', source.LRUCache(
+      max_bytes=twitter.MENTION_CACHE_MAX_BYTES,
+      sizeof=twitter.Twitter.mention_cache.sizeof))
 
   def tearDown(self):
     twitter.MAX_TWEET_LENGTH = self.orig_max_tweet_length
     twitter.TCO_LENGTH = self.orig_tco_length
 
   def test_get_actor(self):
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/users/show.json?screen_name=foo',
       json.dumps(USER))
     self.mox.ReplayAll()
     self.assert_equals(ACTOR, self.twitter.get_actor('foo'))
 
   def test_get_actor_default(self):
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/account/verify_credentials.json',
       json.dumps(USER))
     self.mox.ReplayAll()
     self.assert_equals(ACTOR, self.twitter.get_actor())
 
   def test_get_activities(self):
-    self.expect_urlopen(TIMELINE, json.dumps([TWEET, TWEET]))
+    self.expect_source_urlopen(TIMELINE, json.dumps([TWEET, TWEET]))
     self.mox.ReplayAll()
     self.assert_equals([ACTIVITY, ACTIVITY], self.twitter.get_activities())
 
   def test_get_activities_start_index_count(self):
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/statuses/home_timeline.json?'
       'include_entities=true&count=2',
       json.dumps([TWEET, TWEET_2]))
@@ -595,7 +598,7 @@ class TwitterTest(testutil.TestCase):
                        self.twitter.get_activities(start_index=1, count=1))
 
   def test_get_activities_activity_id(self):
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/statuses/show.json?id=000&include_entities=true',
       json.dumps(TWEET))
     self.mox.ReplayAll()
@@ -606,20 +609,35 @@ class TwitterTest(testutil.TestCase):
         start_index=3, count=6))
 
   def test_get_activities_self(self):
-    self.expect_urlopen('https://api.twitter.com/1.1/statuses/user_timeline.json?'
+    self.expect_source_urlopen('https://api.twitter.com/1.1/statuses/user_timeline.json?'
                          'include_entities=true&count=0',
                          '[]')
     self.mox.ReplayAll()
 
     self.assert_equals([], self.twitter.get_activities(group_id=source.SELF))
 
+  def test_iter_activities(self):
+    tweet_2 = copy.deepcopy(TWEET)
+    tweet_2['id_str'] = '90'
+    self.expect_source_urlopen('https://api.twitter.com/1.1/statuses/user_timeline.json?'
+                         'include_entities=true&count=2',
+                         json.dumps([TWEET, tweet_2]))
+    self.expect_source_urlopen('https://api.twitter.com/1.1/statuses/user_timeline.json?'
+                         'include_entities=true&count=2&max_id=89',
+                         json.dumps([]))
+    self.mox.ReplayAll()
+
+    self.assert_equals([tag_uri('100'), tag_uri('90')], [
+      a['id'] for a in self.twitter.iter_activities(page_size=2,
+                                                    group_id=source.SELF)])
+
   def test_get_activities_self_fetch_likes(self):
-    self.expect_urlopen('https://api.twitter.com/1.1/favorites/list.json?'
+    self.expect_source_urlopen('https://api.twitter.com/1.1/favorites/list.json?'
                          'screen_name=&include_entities=true',
                          json.dumps([TWEET_2]))
-    self.expect_urlopen('https://api.twitter.com/1.1/account/verify_credentials.json',
+    self.expect_source_urlopen('https://api.twitter.com/1.1/account/verify_credentials.json',
                         json.dumps(FAVORITE_EVENT['source']))
-    self.expect_urlopen('https://api.twitter.com/1.1/statuses/user_timeline.json?'
+    self.expect_source_urlopen('https://api.twitter.com/1.1/statuses/user_timeline.json?'
                          'include_entities=true&count=0',
                          json.dumps([TWEET]))
     self.mox.ReplayAll()
@@ -630,7 +648,7 @@ class TwitterTest(testutil.TestCase):
     self.assert_equals([like_obj, ACTIVITY], got)
 
   def test_get_activities_for_screen_name(self):
-    self.expect_urlopen('https://api.twitter.com/1.1/statuses/user_timeline.json?'
+    self.expect_source_urlopen('https://api.twitter.com/1.1/statuses/user_timeline.json?'
                          'include_entities=true&count=0&screen_name=schnarfed',
                          '[]')
     self.mox.ReplayAll()
@@ -639,15 +657,15 @@ class TwitterTest(testutil.TestCase):
                                                        group_id=source.SELF))
 
   def test_get_activities_list_explicit_user(self):
-    self.expect_urlopen('https://api.twitter.com/1.1/lists/statuses.json?include_entities=true&count=0&slug=testlist&owner_screen_name=schnarfed',
+    self.expect_source_urlopen('https://api.twitter.com/1.1/lists/statuses.json?include_entities=true&count=0&slug=testlist&owner_screen_name=schnarfed',
                         '[]')
     self.mox.ReplayAll()
 
     self.assert_equals([], self.twitter.get_activities(group_id='testlist', user_id='schnarfed'))
 
   def test_get_activities_list_implicit_user(self):
-    self.expect_urlopen('https://api.twitter.com/1.1/account/verify_credentials.json', json.dumps({'screen_name': 'schnarfed'}))
-    self.expect_urlopen('https://api.twitter.com/1.1/lists/statuses.json?include_entities=true&count=0&slug=testlist&owner_screen_name=schnarfed',
+    self.expect_source_urlopen('https://api.twitter.com/1.1/account/verify_credentials.json', json.dumps({'screen_name': 'schnarfed'}))
+    self.expect_source_urlopen('https://api.twitter.com/1.1/lists/statuses.json?include_entities=true&count=0&slug=testlist&owner_screen_name=schnarfed',
                         '[]')
     self.mox.ReplayAll()
 
@@ -655,14 +673,14 @@ class TwitterTest(testutil.TestCase):
 
   def test_get_activities_fetch_replies(self):
     tweet = copy.deepcopy(TWEET)
-    self.expect_urlopen(TIMELINE, json.dumps([tweet]))
-    self.expect_urlopen(
+    self.expect_source_urlopen(TIMELINE, json.dumps([tweet]))
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/search/tweets.json?q=%40snarfed_org&include_entities=true&result_type=recent&count=100&since_id=567',
       json.dumps(REPLIES_TO_SNARFED))
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/search/tweets.json?q=%40alice&include_entities=true&result_type=recent&count=100&since_id=567',
       json.dumps(REPLIES_TO_ALICE))
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/search/tweets.json?q=%40bob&include_entities=true&result_type=recent&count=100&since_id=567',
       json.dumps(REPLIES_TO_BOB))
     self.mox.ReplayAll()
@@ -670,11 +688,77 @@ class TwitterTest(testutil.TestCase):
     self.assert_equals([ACTIVITY_WITH_REPLIES],
                        self.twitter.get_activities(fetch_replies=True, min_id='567'))
 
+  def test_get_activities_fetch_replies_cached(self):
+    tweet = copy.deepcopy(TWEET)
+    for url, replies in (('snarfed_org', REPLIES_TO_SNARFED),
+                         ('alice', REPLIES_TO_ALICE),
+                         ('bob', REPLIES_TO_BOB)):
+      self.expect_source_urlopen(
+        'https://api.twitter.com/1.1/search/tweets.json?q=%%40%s&include_entities=true&result_type=recent&count=100&since_id=567' % url,
+        json.dumps(replies))
+    self.mox.ReplayAll()
+
+    # the second instance should use the first one's cached searches
+    for tw in self.twitter, twitter.Twitter('key', 'secret'):
+      activity = tw.tweet_to_activity(copy.deepcopy(tweet))
+      tw.fetch_replies([activity], min_id='567')
+      self.assert_equals(ACTIVITY_WITH_REPLIES['object']['replies'],
+                         activity['object']['replies'])
+
+  def expect_reply_searches(self, min_id):
+    for url, replies in (('snarfed_org', REPLIES_TO_SNARFED),
+                         ('alice', REPLIES_TO_ALICE),
+                         ('bob', REPLIES_TO_BOB)):
+      self.expect_source_urlopen(
+        'https://api.twitter.com/1.1/search/tweets.json?q=%%40%s&include_entities=true&result_type=recent&count=100&since_id=%s' % (url, min_id),
+        json.dumps(replies))
+
+  def check_fetch_replies(self, min_ids):
+    for min_id in min_ids:
+      activity = self.twitter.tweet_to_activity(copy.deepcopy(TWEET))
+      self.twitter.fetch_replies([activity], min_id=min_id)
+      self.assert_equals(ACTIVITY_WITH_REPLIES['object']['replies'],
+                         activity['object']['replies'])
+
+  def test_fetch_replies_cache_varies_by_min_id(self):
+    self.expect_reply_searches('567')
+    self.expect_reply_searches('568')
+    self.mox.ReplayAll()
+    self.check_fetch_replies(('567', '568', '567', '568'))
+
+  def test_fetch_replies_cache_max_bytes(self):
+    # these search results are all bigger than max_bytes, so they're not cached
+    self.mox.stubs.Set(twitter.Twitter, 'mention_cache', source.LRUCache(
+      max_bytes=10, sizeof=twitter.Twitter.mention_cache.sizeof))
+    self.expect_reply_searches('567')
+    self.expect_reply_searches('567')
+    self.mox.ReplayAll()
+    self.check_fetch_replies(('567', '567'))
+
+  def test_fetch_replies_multiple_activities(self):
+    tweets = [copy.deepcopy(TWEET), copy.deepcopy(TWEET)]
+    tweets[1]['id_str'] = '999'
+    activities = [self.twitter.tweet_to_activity(t) for t in tweets]
+
+    for url, replies in (('snarfed_org', REPLIES_TO_SNARFED),
+                         ('alice', REPLIES_TO_ALICE),
+                         ('bob', REPLIES_TO_BOB)):
+      self.expect_source_urlopen(
+        'https://api.twitter.com/1.1/search/tweets.json?q=%%40%s&include_entities=true&result_type=recent&count=100' % url,
+        json.dumps(replies))
+    self.mox.ReplayAll()
+
+    self.twitter.fetch_replies(activities)
+    self.assert_equals(ACTIVITY_WITH_REPLIES['object']['replies'],
+                       activities[0]['object']['replies'])
+    self.assert_equals({'items': [], 'totalItems': 0},
+                       activities[1]['object']['replies'])
+
   def test_get_activities_fetch_shares(self):
     tweet = copy.deepcopy(TWEET)
     tweet['retweet_count'] = 1
-    self.expect_urlopen(TIMELINE, json.dumps([tweet]))
-    self.expect_urlopen(
+    self.expect_source_urlopen(TIMELINE, json.dumps([tweet]))
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/statuses/retweets.json?id=100&since_id=567',
       json.dumps(RETWEETS))
     self.mox.ReplayAll()
@@ -685,8 +769,8 @@ class TwitterTest(testutil.TestCase):
   def test_get_activities_fetch_shares_no_retweets(self):
     tweet = copy.deepcopy(TWEET)
     tweet['retweet_count'] = 1
-    self.expect_urlopen(TIMELINE, json.dumps([tweet]))
-    self.expect_urlopen(
+    self.expect_source_urlopen(TIMELINE, json.dumps([tweet]))
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/statuses/retweets.json?id=100',
       json.dumps(RETWEETS)).AndRaise(urllib2.HTTPError('url', 404, 'msg', {}, None))
     self.mox.ReplayAll()
@@ -694,7 +778,7 @@ class TwitterTest(testutil.TestCase):
     self.assert_equals([ACTIVITY], self.twitter.get_activities(fetch_shares=True))
 
   def test_get_activities_fetch_shares_404s(self):
-    self.expect_urlopen(TIMELINE, json.dumps([TWEET]))
+    self.expect_source_urlopen(TIMELINE, json.dumps([TWEET]))
     self.mox.ReplayAll()
 
     self.assert_equals([ACTIVITY], self.twitter.get_activities(fetch_shares=True))
@@ -713,13 +797,13 @@ class TwitterTest(testutil.TestCase):
     for count in (1, 2):
       for t in tweets:
         t['retweet_count'] = t['favorite_count'] = count
-      self.expect_urlopen(TIMELINE, json.dumps(tweets))
-      self.expect_urlopen(RETWEETS % 'a', '[]')
-      self.expect_urlopen(RETWEETS % 'b', '[]')
-      self.expect_urlopen(FAVORITES % 'a', '{}')
-      self.expect_urlopen(FAVORITES % 'b', '{}')
+      self.expect_source_urlopen(TIMELINE, json.dumps(tweets))
+      self.expect_source_urlopen(RETWEETS % 'a', '[]')
+      self.expect_source_urlopen(RETWEETS % 'b', '[]')
+      self.expect_requests_get(FAVORITES % 'a', '{}')
+      self.expect_requests_get(FAVORITES % 'b', '{}')
       # shouldn't fetch this time because counts haven't changed
-      self.expect_urlopen(TIMELINE, json.dumps(tweets))
+      self.expect_source_urlopen(TIMELINE, json.dumps(tweets))
 
     self.mox.ReplayAll()
     cache = util.CacheDict()
@@ -727,12 +811,22 @@ class TwitterTest(testutil.TestCase):
       self.twitter.get_activities(fetch_shares=True, fetch_likes=True,
                                   cache=cache)
 
+  def test_get_activities_uses_legacy_count_cache_keys(self):
+    tweet = copy.deepcopy(TWEET)
+    tweet['retweet_count'] = tweet['favorite_count'] = 1
+    self.expect_source_urlopen(TIMELINE, json.dumps([tweet]))
+    self.mox.ReplayAll()
+
+    # counts cached under the old retweet and favorite keys still match
+    cache = util.CacheDict({'ATR 100': 1, 'ATF 100': 1})
+    self.twitter.get_activities(fetch_shares=True, fetch_likes=True, cache=cache)
+
   def test_get_activities_fetch_likes(self):
     tweet = copy.deepcopy(TWEET)
     tweet['favorite_count'] = 1
-    self.expect_urlopen(TIMELINE, json.dumps([tweet]))
-    self.expect_urlopen('https://twitter.com/i/activity/favorited_popup?id=100',
-      json.dumps({'htmlUsers': FAVORITES_HTML}))
+    self.expect_source_urlopen(TIMELINE, json.dumps([tweet]))
+    self.expect_requests_get('https://twitter.com/i/activity/favorited_popup?id=100',
+                             json.dumps({'htmlUsers': FAVORITES_HTML}))
     self.mox.ReplayAll()
 
     cache = util.CacheDict()
@@ -743,9 +837,9 @@ class TwitterTest(testutil.TestCase):
   def test_get_activities_favorites_404(self):
     tweet = copy.deepcopy(TWEET)
     tweet['favorite_count'] = 1
-    self.expect_urlopen(TIMELINE, json.dumps([tweet]))
-    self.expect_urlopen('https://twitter.com/i/activity/favorited_popup?id=100'
-                        ).AndRaise(urllib2.HTTPError('url', 404, 'msg', {}, None))
+    self.expect_source_urlopen(TIMELINE, json.dumps([tweet]))
+    self.expect_requests_get('https://twitter.com/i/activity/favorited_popup?id=100',
+                             'not found', status_code=404)
     self.mox.ReplayAll()
 
     cache = util.CacheDict()
@@ -754,7 +848,7 @@ class TwitterTest(testutil.TestCase):
     self.assertNotIn('ATF 100', cache)
 
   def test_get_activities_fetch_likes_no_favorites(self):
-    self.expect_urlopen(TIMELINE, json.dumps([TWEET]))
+    self.expect_source_urlopen(TIMELINE, json.dumps([TWEET]))
     # we should only ask the API for retweets when favorites_count > 0
     self.mox.ReplayAll()
 
@@ -763,10 +857,10 @@ class TwitterTest(testutil.TestCase):
   def test_retweet_limit(self):
     tweet = copy.deepcopy(TWEET)
     tweet['retweet_count'] = 1
-    self.expect_urlopen(TIMELINE, json.dumps([tweet] * (twitter.RETWEET_LIMIT + 2)))
+    self.expect_source_urlopen(TIMELINE, json.dumps([tweet] * (twitter.RETWEET_LIMIT + 2)))
 
     for i in range(twitter.RETWEET_LIMIT):
-      self.expect_urlopen(
+      self.expect_source_urlopen(
         'https://api.twitter.com/1.1/statuses/retweets.json?id=100&since_id=567',
         json.dumps(RETWEETS))
 
@@ -776,34 +870,35 @@ class TwitterTest(testutil.TestCase):
                        self.twitter.get_activities(fetch_shares=True, min_id='567'))
 
   def test_get_activities_request_etag(self):
-    self.expect_urlopen(TIMELINE, '[]', headers={'If-none-match': '"my etag"'})
+    self.expect_source_urlopen(TIMELINE, '[]', headers={'If-none-match': '"my etag"'})
     self.mox.ReplayAll()
     self.twitter.get_activities_response(etag='"my etag"')
 
   def test_get_activities_response_etag(self):
-    self.expect_urlopen(TIMELINE, '[]', response_headers={'ETag': '"my etag"'})
+    self.expect_source_urlopen(TIMELINE, '[]', response_headers={'ETag': '"my etag"'})
     self.mox.ReplayAll()
     self.assert_equals('"my etag"', self.twitter.get_activities_response()['etag'])
 
   def test_get_activities_304_not_modified(self):
     """Requests with matching ETags return 304 Not Modified."""
-    self.expect_urlopen(TIMELINE, '[]', status=304)
+    self.expect_source_urlopen(TIMELINE, '[]', status=304)
     self.mox.ReplayAll()
     self.assert_equals([], self.twitter.get_activities_response()['items'])
 
   def test_get_activities_min_id(self):
     """min_id shouldn't be passed to the initial request, just the derived ones."""
-    self.expect_urlopen(TIMELINE, '[]')
+    self.expect_source_urlopen(TIMELINE, '[]')
     self.mox.ReplayAll()
     self.twitter.get_activities_response(min_id=135)
 
   def test_get_activities_retries(self):
     for exc in (httplib.HTTPException('Deadline exceeded: foo'),
                 socket.error('asdf'),
+                requests.ConnectionError('asdf'),
                 urllib2.HTTPError('url', 501, 'msg', {}, None)):
       for i in range(twitter.RETRIES):
-        self.expect_urlopen(TIMELINE).AndRaise(exc)
-      self.expect_urlopen(TIMELINE, '[]')
+        self.expect_source_urlopen(TIMELINE).AndRaise(exc)
+      self.expect_source_urlopen(TIMELINE, '[]')
       self.mox.ReplayAll()
       self.assertEquals([], self.twitter.get_activities_response()['items'])
       self.mox.ResetAll()
@@ -811,13 +906,13 @@ class TwitterTest(testutil.TestCase):
     # other exceptions shouldn't retry
     for exc in (httplib.HTTPException('not a deadline'),
                 urllib2.HTTPError('url', 403, 'not a 5xx', {}, None)):
-      self.expect_urlopen(TIMELINE).AndRaise(exc)
+      self.expect_source_urlopen(TIMELINE).AndRaise(exc)
       self.mox.ReplayAll()
       self.assertRaises(exc.__class__, self.twitter.get_activities_response)
       self.mox.ResetAll()
 
   def test_get_activities_search(self):
-    self.expect_urlopen(SEARCH_URL % {'q': 'indieweb', 'count': 0}, json.dumps({
+    self.expect_source_urlopen(SEARCH_URL % {'q': 'indieweb', 'count': 0}, json.dumps({
       'statuses': [TWEET, TWEET],
       'search_metadata': {
         'max_id': 250126199840518145,
@@ -829,14 +924,14 @@ class TwitterTest(testutil.TestCase):
         group_id=source.SEARCH, search_query='indieweb'))
 
   def test_get_comment(self):
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/statuses/show.json?id=123&include_entities=true',
       json.dumps(TWEET))
     self.mox.ReplayAll()
     self.assert_equals(OBJECT, self.twitter.get_comment('123'))
 
   def test_get_share(self):
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/statuses/show.json?id=123&include_entities=true',
       json.dumps(RETWEETS[0]))
     self.mox.ReplayAll()
@@ -1078,7 +1173,7 @@ class TwitterTest(testutil.TestCase):
               'oauth_token="key"' in sig and
               'oauth_signature=' in sig)
 
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/users/show.json?screen_name=foo',
       json.dumps(USER),
       headers=mox.Func(check_headers))
@@ -1123,7 +1218,7 @@ class TwitterTest(testutil.TestCase):
     )
 
     for content in created:
-      self.expect_urlopen(
+      self.expect_source_urlopen(
         twitter.API_POST_TWEET_URL + '?status=' + urllib.quote_plus(content.encode('utf-8')),
         json.dumps(TWEET), data='')
     self.mox.ReplayAll()
@@ -1239,7 +1334,7 @@ class TwitterTest(testutil.TestCase):
       u'<a href="http://indiewebcamp.com/2014-review#Indie_Term_Re-use">indiewebcamp.com/2014-review#In...</a>\n'
       '@iainspad @sashtown @thomatronic (ttk.me t4_81)')
 
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       twitter.API_POST_TWEET_URL + '?status=' + urllib.quote_plus(orig.encode('utf-8')),
       json.dumps(TWEET), data='')
     self.mox.ReplayAll()
@@ -1271,7 +1366,7 @@ class TwitterTest(testutil.TestCase):
                u'be far away. Those of us that have input fields to… '
                u'(<a href="https://ben.thatmustbe.me/note/2015/1/31/1/">ben.thatmustbe.me/note/2015/1/31...</a>)')
 
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       twitter.API_POST_TWEET_URL + '?status=' + urllib.quote_plus(content.encode('utf-8')),
       json.dumps(TWEET), data='')
     self.mox.ReplayAll()
@@ -1331,7 +1426,7 @@ class TwitterTest(testutil.TestCase):
     twitter.MAX_TWEET_LENGTH = 20
     twitter.TCO_LENGTH = 5
 
-    self.expect_urlopen(twitter.API_POST_TWEET_URL + '?status=' +
+    self.expect_source_urlopen(twitter.API_POST_TWEET_URL + '?status=' +
                         urllib.quote_plus('too long… (http://obj.ca)'),
                         json.dumps(TWEET), data='')
     self.mox.ReplayAll()
@@ -1406,7 +1501,7 @@ class TwitterTest(testutil.TestCase):
 
     for _, _, status in testdata:
       params = 'status=%s&in_reply_to_status_id=100' % urllib.quote_plus(status)
-      self.expect_urlopen(twitter.API_POST_TWEET_URL + '?' + params,
+      self.expect_source_urlopen(twitter.API_POST_TWEET_URL + '?' + params,
                           json.dumps(TWEET), data='')
     self.mox.ReplayAll()
 
@@ -1427,7 +1522,7 @@ class TwitterTest(testutil.TestCase):
       self.assertIn('<span class="verb">@-reply</span> to <a href="http://twitter.com/you/status/100">this tweet</a>:', preview.description)
 
   def test_create_favorite(self):
-    self.expect_urlopen(twitter.API_POST_FAVORITE_URL + '?id=100',
+    self.expect_source_urlopen(twitter.API_POST_FAVORITE_URL + '?id=100',
                         json.dumps(TWEET), data='')
     self.mox.ReplayAll()
     self.assert_equals({'url': 'https://twitter.com/snarfed_org/status/100',
@@ -1438,7 +1533,7 @@ class TwitterTest(testutil.TestCase):
     self.assertIn('<span class="verb">favorite</span> <a href="https://twitter.com/snarfed_org/status/100">this tweet</a>:', preview.description)
 
   def test_create_retweet(self):
-    self.expect_urlopen(
+    self.expect_source_urlopen(
       'https://api.twitter.com/1.1/statuses/retweet/333.json?id=333',
       json.dumps(TWEET), data='')
     self.mox.ReplayAll()
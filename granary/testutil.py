@@ -9,45 +9,75 @@ import requests
 
 from oauth_dropins.webutil.testutil import *
 
+import source
+
+
+class HandlerTest(HandlerTest):
+  """Base test class. Runs source.parallel_map() calls serially.
+
+  That way, mocked HTTP requests happen in a deterministic order. Also starts
+  each test with empty in memory redirect and identity caches.
+  """
+
+  def setUp(self):
+    super(HandlerTest, self).setUp()
+    self.mox.stubs.Set(source, 'MAX_CONCURRENT_REQUESTS', 1)
+    self.mox.stubs.Set(source, 'redirect_cache', source.LRUCache())
+    self.mox.stubs.Set(source, 'identity_cache', source.LRUCache())
+
 
 class TestCase(HandlerTest):
-  """Base test class. Supports mocking requests calls."""
+  """Base test class. Supports mocking requests calls.
+
+  Stubs out requests.Session.request(), which both the requests module
+  functions, e.g. requests.get(), and source.http_request() go through.
+  """
 
   def setUp(self):
     super(TestCase, self).setUp()
-    for method in 'get', 'post':
-      self.mox.StubOutWithMock(requests, method, use_mock_anything=True)
+    self.requests = self.mox.CreateMockAnything()
+    self.mox.stubs.Set(requests.Session, 'request',
+                       lambda session, *args, **kwargs:
+                         self._fake_request(*args, **kwargs))
     self.stub_requests_head()
 
+  def _fake_request(self, method, url, **kwargs):
+    """Passes requests calls on to self.requests.[method]()."""
+    method = method.lower()
+    kwargs = {k: v for k, v in kwargs.items() if v is not None}
+    if method != 'head' and kwargs.get('allow_redirects') is True:
+      del kwargs['allow_redirects']  # default for everything except HEAD
+    if method == 'head' and not self._is_head_mocked:
+      return self._fake_head(url, **kwargs)
+    return getattr(self.requests, method)(url, **kwargs)
+
   def stub_requests_head(self):
     # don't make actual HTTP requests to follow original post url redirects
-    def fake_head(url, **kwargs):
-      resp = requests.Response()
-      resp.url = url
-      if '.' in url or url.startswith('http'):
-        resp.headers['content-type'] = 'text/html; charset=UTF-8'
-        resp.status_code = 200
-      else:
-        resp.status_code = 404
-      return resp
-    self.mox.stubs.Set(requests, 'head', fake_head)
-
     self._is_head_mocked = False  # expect_requests_head() sets this to True
 
+  @staticmethod
+  def _fake_head(url, **kwargs):
+    resp = requests.Response()
+    resp.url = url
+    if '.' in url or url.startswith('http'):
+      resp.headers['content-type'] = 'text/html; charset=UTF-8'
+      resp.status_code = 200
+    else:
+      resp.status_code = 404
+    return resp
+
   def expect_requests_head(self, *args, **kwargs):
-    if not self._is_head_mocked:
-      self.mox.StubOutWithMock(requests, 'head', use_mock_anything=True)
-      self._is_head_mocked = True
-    return self._expect_requests_call(*args, method=requests.head, **kwargs)
+    self._is_head_mocked = True
+    return self._expect_requests_call(*args, method='head', **kwargs)
 
   def expect_requests_get(self, *args, **kwargs):
-    return self._expect_requests_call(*args, method=requests.get, **kwargs)
+    return self._expect_requests_call(*args, method='get', **kwargs)
 
   def expect_requests_post(self, *args, **kwargs):
-    return self._expect_requests_call(*args, method=requests.post, **kwargs)
+    return self._expect_requests_call(*args, method='post', **kwargs)
 
   def _expect_requests_call(self, url, response='', status_code=200,
-                            content_type='text/html', method=requests.get,
+                            content_type='text/html', method='get',
                             redirected_url=None, response_headers=None,
                             **kwargs):
     """
@@ -77,9 +107,42 @@ class TestCase(HandlerTest):
       resp.headers.update(response_headers)
 
     kwargs.setdefault('timeout', appengine_config.HTTP_TIMEOUT)
-    if method is requests.head:
+    if method == 'head':
       kwargs['allow_redirects'] = True
 
-    call = method(url, **kwargs)
+    call = getattr(self.requests, method)(url, **kwargs)
     call.AndReturn(resp)
     return call
+
+  def expect_source_urlopen(self, url, response=None, status=200, data=None,
+                            headers=None, response_headers={}, **kwargs):
+    """Expects a source.urlopen() call, which goes through requests.
+
+    Takes the same arguments as expect_urlopen(). If data is set, expects a
+    POST, otherwise a GET. If status isn't 2xx, source.urlopen() will raise a
+    urllib2.HTTPError. If response is unset and status is 2xx, returns the
+    expected call.
+    """
+    def check_headers(actual):
+      if isinstance(headers, mox.Comparator):
+        return headers.equals(actual.items())
+      missing = set((headers or {}).items()) - set(actual.items())
+      assert not missing, 'Missing request headers: %s' % missing
+      return True
+
+    kwargs.setdefault('timeout', appengine_config.HTTP_TIMEOUT)
+    if data is not None:
+      kwargs['data'] = data
+
+    call = getattr(self.requests, 'get' if data is None else 'post')(
+      url, headers=mox.Func(check_headers), **kwargs)
+
+    if response is not None or status / 100 != 2:
+      resp = requests.Response()
+      resp._content = response or ''
+      resp.url = url
+      resp.status_code = status
+      resp.headers.update(response_headers)
+      call.AndReturn(resp)
+
+    return call
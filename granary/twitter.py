@@ -24,9 +24,7 @@ import urllib2
 import urlparse
 
 import appengine_config
-from appengine_config import HTTP_TIMEOUT
 
-from bs4 import BeautifulSoup
 import requests
 
 import source
@@ -67,6 +65,23 @@ PROFILE_PICTURE_URL = 'https://twitter.com/%s/profile_image?size=original'
 # TODO: sigh. figure out a better way. dammit twitter, give me a batch API!!!
 RETWEET_LIMIT = 15
 
+# How long to cache @-mention searches in Twitter.mention_cache, in seconds, and
+# the max total size of the cached search results, in bytes of JSON.
+MENTION_CACHE_TIME = 5 * 60
+MENTION_CACHE_MAX_BYTES = 10 * 1000 * 1000
+
+# Max number of favorited_popup HTML pages to fetch from twitter.com at once
+# per get_activities() call. This is scraping, not the API, so be polite.
+MAX_CONCURRENT_HTML_FETCHES = 4
+
+# lxml is much faster than Python's built in HTMLParser, but it's optional. The
+# first of these that's installed is used.
+HTML_PARSERS = ('lxml', 'html.parser')
+
+# Matches the user links in favorited_popup HTML. The class attribute is still
+# a single string while parsing, so SoupStrainer can't match it by class name.
+PROFILE_LINK_CLASS_RE = re.compile(r'(^|\s)js-user-profile-link(\s|$)')
+
 # For read requests only.
 RETRIES = 3
 
@@ -105,6 +120,11 @@ class Twitter(source.Source):
 
   DOMAIN = 'twitter.com'
   NAME = 'Twitter'
+  RESPONSE_COUNTS_PREFIX = 'AT'
+  # keep the keys that retweet and favorite counts were cached under before
+  # ResponseCounts, e.g. 'ATR 123', so they still hit
+  RESPONSE_COUNTS_TYPES = {source.ResponseCounts.SHARES: 'R',
+                           source.ResponseCounts.LIKES: 'F'}
   FRONT_PAGE_TEMPLATE = 'templates/twitter_index.html'
 
   # HTML snippet for embedding a tweet.
@@ -118,6 +138,13 @@ class Twitter(source.Source):
   </blockquote>
   """
 
+  # caches @-mention searches for fetch_replies(). shared across instances.
+  # can be replaced with any object that implements the memcache get_multi()
+  # and set_multi() methods, e.g. App Engine's memcache module. keys include
+  # min_id, so searches with different min_ids are cached separately.
+  mention_cache = source.LRUCache(max_bytes=MENTION_CACHE_MAX_BYTES,
+                                  sizeof=lambda tweets: len(json.dumps(tweets)))
+
   def __init__(self, access_token_key, access_token_secret):
     """Constructor.
 
@@ -148,7 +175,7 @@ class Twitter(source.Source):
                               etag=None, min_id=None, cache=None,
                               fetch_replies=False, fetch_likes=False,
                               fetch_shares=False, fetch_events=False,
-                              search_query=None):
+                              search_query=None, max_id=None):
     """Fetches posts and converts them to ActivityStreams activities.
 
     XXX HACK: this is currently hacked for bridgy to NOT pass min_id to the
@@ -160,6 +187,10 @@ class Twitter(source.Source):
     See method docstring in source.py for details. app_id is ignored.
     min_id is translated to Twitter's since_id.
 
+    Additional args:
+      max_id: only return tweets with ids less than or equal to this. Used by
+        iter_activities() to page back through a timeline.
+
     The code for handling ETags (and 304 Not Changed responses and setting
     If-None-Match) is here, but unused right now since Twitter evidently doesn't
     support ETags. From https://dev.twitter.com/discussions/5800 :
@@ -171,7 +202,8 @@ class Twitter(source.Source):
     Streaming API, though, and convert them with streaming_event_to_object().
     https://dev.twitter.com/docs/streaming-apis/messages#Events_event
 
-    Shares (ie retweets) are fetched with a separate API call per tweet:
+    Shares (ie retweets) are fetched with a separate API call per tweet. The
+    calls are made concurrently, up to source.MAX_CONCURRENT_REQUESTS at a time:
     https://dev.twitter.com/docs/api/1.1/get/statuses/retweets/%3Aid
 
     However, retweets are only fetched for the first 15 tweets that have them,
@@ -203,11 +235,16 @@ class Twitter(source.Source):
             'screen_name': user_id,
           }
 
-        if fetch_likes:
+        # the user's own likes aren't paged, so only include them on the first
+        # page when paging with max_id
+        if fetch_likes and max_id is None:
           liked = self.urlopen(API_FAVORITES_URL % (user_id or ''))
           if liked:
-            user = self.urlopen(API_USER_URL % user_id if user_id
-                                else API_CURRENT_USER_URL)
+            user = (self.urlopen(API_USER_URL % user_id) if user_id
+                    else self.cached_identity(
+                      'user', (self.access_token_key, self.access_token_secret),
+                      lambda: self.urlopen(API_CURRENT_USER_URL),
+                      time=source.PROFILE_CACHE_TIME))
             activities += [self._make_like(tweet, user) for tweet in liked]
       elif group_id == source.SEARCH:
         url = API_SEARCH_URL % {
@@ -220,9 +257,14 @@ class Twitter(source.Source):
         url = API_LIST_TIMELINE_URL % {
           'count': count + start_index,
           'slug': group_id,
-          'owner_screen_name': user_id or self.get_actor().get('username')
+          'owner_screen_name': user_id or self.cached_identity(
+            'username', (self.access_token_key, self.access_token_secret),
+            lambda: self.get_actor().get('username')),
         }
 
+      if max_id is not None:
+        url = util.add_query_params(url, {'max_id': max_id})
+
       headers = {'If-None-Match': etag} if etag else {}
       total_count = None
       try:
@@ -238,51 +280,49 @@ class Twitter(source.Source):
         else:
           raise
 
-    # batch get memcached counts of favorites and retweets for all tweets
-    cached = {}
-    if cache is not None:
-      keys = itertools.product(('ATR', 'ATF'), [t['id_str'] for t in tweets])
-      cached = cache.get_multi('%s %s' % (prefix, id) for prefix, id in keys)
-    # only update the cache at the end, in case we hit an error before then
-    cache_updates = {}
+    # batch get cached counts of favorites and retweets for all tweets
+    counts = self.response_counts(cache, [t['id_str'] for t in tweets])
 
     if fetch_shares:
-      retweet_calls = 0
+      to_fetch = []
       for tweet in tweets:
         if tweet.get('retweeted'):  # this tweet is itself a retweet
           continue
-        elif retweet_calls >= RETWEET_LIMIT:
+        elif len(to_fetch) >= RETWEET_LIMIT:
           logging.warning("Hit Twitter's retweet rate limit (%d) with more to "
                           "fetch! Results will be incomplete!" % RETWEET_LIMIT)
           break
 
-        # store retweets in the 'retweets' field, which is handled by
-        # tweet_to_activity().
-        # TODO: make these HTTP requests asynchronous. not easy since we don't
-        # (yet) require threading support or use a non-blocking HTTP library.
-        #
         # twitter limits this API endpoint to one call per minute per user,
         # which is easy to hit, so we stop before we hit that.
         # https://dev.twitter.com/docs/rate-limiting/1.1/limits
         #
         # can't use the statuses/retweets_of_me endpoint because it only
         # returns the original tweets, not the retweets or their authors.
-        id = tweet['id_str']
-        count = tweet.get('retweet_count')
-        if count and count != cached.get('ATR ' + id):
-          url = API_RETWEETS_URL % id
-          if min_id is not None:
-            url = util.add_query_params(url, {'since_id': min_id})
-
-          try:
-            tweet['retweets'] = self.urlopen(url)
-          except urllib2.URLError, e:
-            code, _ = util.interpret_http_exception(e)
-            if code != '404':  # 404 means the original tweet was deleted
-              raise
-
-          retweet_calls += 1
-          cache_updates['ATR ' + id] = count
+        num_retweets = tweet.get('retweet_count')
+        if num_retweets and counts.changed(counts.SHARES, tweet['id_str'],
+                                           num_retweets):
+          to_fetch.append(tweet)
+
+      def fetch_retweets(tweet):
+        url = API_RETWEETS_URL % tweet['id_str']
+        if min_id is not None:
+          url = util.add_query_params(url, {'since_id': min_id})
+
+        try:
+          return self.urlopen(url)
+        except urllib2.URLError, e:
+          code, _ = util.interpret_http_exception(e)
+          if code != '404':  # 404 means the original tweet was deleted
+            raise
+
+      # store retweets in the 'retweets' field, which is handled by
+      # tweet_to_activity().
+      for tweet, retweets in zip(to_fetch,
+                                 source.parallel_map(fetch_retweets, to_fetch)):
+        if retweets is not None:
+          tweet['retweets'] = retweets
+        counts.update(counts.SHARES, tweet['id_str'], tweet['retweet_count'])
 
     tweet_activities = [self.tweet_to_activity(t) for t in tweets]
 
@@ -290,29 +330,52 @@ class Twitter(source.Source):
       self.fetch_replies(tweet_activities, min_id=min_id)
 
     if fetch_likes:
+      to_fetch = []
       for tweet, activity in zip(tweets, tweet_activities):
-        id = tweet['id_str']
         count = tweet.get('favorite_count')
-        if count and count != cached.get('ATF ' + id):
-          url = HTML_FAVORITES_URL % id
-          logging.debug('Fetching %s', url)
-          try:
-            html = json.loads(urllib2.urlopen(url, timeout=HTTP_TIMEOUT).read()
-                              ).get('htmlUsers', '')
-          except urllib2.URLError, e:
-            util.interpret_http_exception(e)  # just log it
-            continue
-          likes = self.favorites_html_to_likes(tweet, html)
-          activity['object'].setdefault('tags', []).extend(likes)
-          cache_updates['ATF ' + id] = count
+        if count and counts.changed(counts.LIKES, tweet['id_str'], count):
+          to_fetch.append((tweet, activity))
+
+      def fetch_favorites_html(tweet):
+        try:
+          resp = source.http_request('GET', HTML_FAVORITES_URL % tweet['id_str'])
+          resp.raise_for_status()
+          return resp.json().get('htmlUsers', '')
+        except requests.RequestException, e:
+          util.interpret_http_exception(e)  # just log it
+
+      htmls = source.parallel_map(fetch_favorites_html,
+                                  [tweet for tweet, _ in to_fetch],
+                                  max_workers=MAX_CONCURRENT_HTML_FETCHES)
+      for (tweet, activity), html in zip(to_fetch, htmls):
+        if html is None:
+          continue
+        likes = self.favorites_html_to_likes(tweet, html)
+        activity['object'].setdefault('tags', []).extend(likes)
+        counts.update(counts.LIKES, tweet['id_str'], tweet['favorite_count'])
 
     activities += tweet_activities
     response = self.make_activities_base_response(activities)
     response.update({'total_count': total_count, 'etag': etag})
-    if cache_updates and cache is not None:
-      cache.set_multi(cache_updates)
+    counts.save()
     return response
 
+  def _get_activities_page(self, cursor, count, **kwargs):
+    """Pages back through a timeline with Twitter's max_id.
+
+    See Source._get_activities_page() for details. The cursor is the max_id
+    for the next page, ie one less than the lowest tweet id so far.
+    """
+    activities = self.get_activities(count=count, max_id=cursor, **kwargs)
+
+    tweet_ids = []
+    for activity in activities:
+      parsed = util.parse_tag_uri(activity.get('id') or '')
+      if parsed and parsed[1].isdigit():  # skip likes, which have other ids
+        tweet_ids.append(int(parsed[1]))
+
+    return activities, (min(tweet_ids) - 1) if tweet_ids else None
+
   def fetch_replies(self, activities, min_id=None):
     """Fetches and injects Twitter replies into a list of activities, in place.
 
@@ -320,60 +383,98 @@ class Twitter(source.Source):
     for @-mentions, matches them to the original tweets with
     in_reply_to_status_id_str, and recurses until it's walked the entire tree.
 
+    Walks all of the reply trees together, one level at a time, and runs each
+    level's searches concurrently. Search results are cached in mention_cache,
+    which is shared across calls and instances.
+
     Args:
       activities: list of activity dicts
 
     Returns:
       same activities list
     """
-
-    # cache searches for @-mentions for individual users. maps username to dict
-    # mapping tweet id to ActivityStreams reply object dict.
+    # maps username to list of tweet dicts that @-mention them
     mentions = {}
 
-    # find replies
+    # for each activity, list of ActivityStreams reply object dicts and set of
+    # seen tweet ids. seed with the original tweet; we'll filter it out later.
+    trees = []
     for activity in activities:
-      # list of ActivityStreams reply object dict and set of seen activity ids
-      # (tag URIs). seed with the original tweet; we'll filter it out later.
-      replies = [activity]
       _, id = util.parse_tag_uri(activity['id'])
-      seen_ids = set([id])
-
-      for reply in replies:
-        # get mentions of this tweet's author so we can search them for replies to
-        # this tweet. can't use statuses/mentions_timeline because i'd need to
-        # auth as the user being mentioned.
-        # https://dev.twitter.com/docs/api/1.1/get/statuses/mentions_timeline
-        #
-        # note that these HTTP requests are synchronous. you can make async
-        # requests by using urlfetch.fetch() directly, but not with urllib2.
-        # https://developers.google.com/appengine/docs/python/urlfetch/asynchronousrequests
-        author = reply['actor']['username']
-        if author not in mentions:
-          url = API_SEARCH_URL % {
-            'q': urllib.quote_plus('@' + author),
-            'count': 100,
-          }
-          if min_id is not None:
-            url = util.add_query_params(url, {'since_id': min_id})
-          mentions[author] = self.urlopen(url)['statuses']
-
-        # look for replies. add any we find to the end of replies. this makes us
-        # recursively follow reply chains to their end. (python supports
-        # appending to a sequence while you're iterating over it.)
-        for mention in mentions[author]:
-          id = mention['id_str']
-          if (mention.get('in_reply_to_status_id_str') in seen_ids and
-              id not in seen_ids):
-            replies.append(self.tweet_to_activity(mention))
-            seen_ids.add(id)
-
+      trees.append(([activity], set([id])))
+
+    levels = [[activity] for activity in activities]
+    while any(levels):
+      # get mentions of these tweets' authors so we can search them for replies
+      # to these tweets. can't use statuses/mentions_timeline because i'd need
+      # to auth as the user being mentioned.
+      # https://dev.twitter.com/docs/api/1.1/get/statuses/mentions_timeline
+      authors = []
+      for level in levels:
+        for reply in level:
+          author = reply['actor']['username']
+          if author not in mentions and author not in authors:
+            authors.append(author)
+      mentions.update(self._search_mentions(authors, min_id=min_id))
+
+      # look for replies. they become the next level, which makes us
+      # recursively follow reply chains to their end.
+      next_levels = []
+      for (replies, seen_ids), level in zip(trees, levels):
+        next_level = []
+        for reply in level:
+          for mention in mentions[reply['actor']['username']]:
+            id = mention['id_str']
+            if (mention.get('in_reply_to_status_id_str') in seen_ids and
+                id not in seen_ids):
+              next_level.append(self.tweet_to_activity(mention))
+              seen_ids.add(id)
+        replies.extend(next_level)
+        next_levels.append(next_level)
+      levels = next_levels
+
+    for activity, (replies, _) in zip(activities, trees):
       items = [r['object'] for r in replies[1:]]  # filter out seed activity
       activity['object']['replies'] = {
         'items': items,
         'totalItems': len(items),
         }
 
+  def _search_mentions(self, authors, min_id=None):
+    """Searches for tweets that @-mention each of a list of users.
+
+    Uses mention_cache when possible, and runs the searches that miss it
+    concurrently.
+
+    Args:
+      authors: sequence of string usernames
+      min_id: string tweet id, optional. Only return tweets after this one.
+
+    Returns:
+      dict mapping username to list of tweet dicts
+    """
+    keys = {author: 'AMS %s %s' % (author, min_id) for author in authors}
+    cached = self.mention_cache.get_multi(keys.values())
+    found = {author: cached[key] for author, key in keys.items() if key in cached}
+
+    def search(author):
+      url = API_SEARCH_URL % {
+        'q': urllib.quote_plus('@' + author),
+        'count': 100,
+      }
+      if min_id is not None:
+        url = util.add_query_params(url, {'since_id': min_id})
+      return self.urlopen(url)['statuses']
+
+    to_search = [author for author in authors if author not in found]
+    searched = dict(zip(to_search, source.parallel_map(search, to_search)))
+    if searched:
+      self.mention_cache.set_multi({keys[author]: tweets for author, tweets
+                                    in searched.items()},
+                                   time=MENTION_CACHE_TIME)
+    found.update(searched)
+    return found
+
   def get_comment(self, comment_id, activity_id=None, activity_author_id=None):
     """Returns an ActivityStreams comment object.
 
@@ -532,8 +633,8 @@ class Twitter(source.Source):
         files = {'media[]': urllib2.urlopen(image_url)}
         headers = twitter_auth.auth_header(API_POST_MEDIA_URL,
             self.access_token_key, self.access_token_secret, 'POST')
-        resp = requests.post(API_POST_MEDIA_URL, data=data, files=files,
-                             headers=headers, timeout=HTTP_TIMEOUT)
+        resp = source.http_request('POST', API_POST_MEDIA_URL, data=data,
+                                   files=files, headers=headers)
         resp.raise_for_status()
         resp = json.loads(resp.text)
         resp['type'] = 'comment' if is_reply else 'post'
@@ -718,11 +819,26 @@ class Twitter(source.Source):
     return ret.strip() if ret else None
 
   def urlopen(self, url, parse_response=True, **kwargs):
-    """Wraps urllib2.urlopen() and adds an OAuth signature.
+    """Wraps source.urlopen() and adds an OAuth signature.
     """
+    headers = dict(kwargs.pop('headers', None) or {})
+    req_url = url
+    method = 'GET'
+    # if this is a post, move the body params into the URL. OAuth signing
+    # doesn't work if they're in the body; Twitter returns a 401.
+    if kwargs.get('data'):
+      method = 'POST'
+      req_url += ('&' if '?' in url else '?') + kwargs['data']
+      kwargs['data'] = ''
+    headers.update(twitter_auth.auth_header(
+      req_url, self.access_token_key, self.access_token_secret, method=method))
+
     def request():
-      resp = twitter_auth.signed_urlopen(
-        url, self.access_token_key, self.access_token_secret, **kwargs)
+      try:
+        resp = source.urlopen(urllib2.Request(req_url, headers=headers, **kwargs))
+      except BaseException, e:
+        util.interpret_http_exception(e)
+        raise
       return json.loads(resp.read()) if parse_response else resp
 
     if ('data' not in kwargs and not
@@ -740,6 +856,8 @@ class Twitter(source.Source):
           code, body = util.interpret_http_exception(e)
           if code is None or int(code) / 100 != 5:
             raise
+        except urllib2.URLError, e:
+          pass
         logging.warning('Twitter API call failed! Retrying...')
 
     # last try. if it deadlines, let the exception bubble up.
@@ -1050,7 +1168,14 @@ class Twitter(source.Source):
     Returns:
       list of ActivityStreams like object dicts
     """
-    soup = BeautifulSoup(html)
+    # bs4 is slow to import and only needed for scraping, so load it lazily
+    import bs4
+    parser = next(p for p in HTML_PARSERS
+                  if bs4.builder.builder_registry.lookup(p))
+
+    # only parse the user profile links, not the rest of the page
+    soup = bs4.BeautifulSoup(
+      html, parser, parse_only=bs4.SoupStrainer(class_=PROFILE_LINK_CLASS_RE))
     likes = []
 
     for user in soup.find_all(class_='js-user-profile-link'):
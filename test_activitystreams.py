@@ -5,6 +5,7 @@ __author__ = ['Ryan Barrett <granary@ryanb.org>']
 
 import copy
 import json
+import zlib
 
 import oauth_dropins.webutil.test
 from oauth_dropins.webutil import testutil
@@ -36,8 +37,12 @@ class HandlerTest(testutil.HandlerTest):
     self.mox.ResetAll()
     activitystreams.SOURCE = FakeSource
     self.mox.StubOutWithMock(FakeSource, 'get_activities_response')
+    self.mox.stubs.Set(activitystreams, 'response_cache', source.LRUCache(
+      max_bytes=activitystreams.RESPONSE_CACHE_MAX_BYTES,
+      sizeof=activitystreams.response_cache.sizeof))
 
   def get_response(self, url, *args, **kwargs):
+    headers = kwargs.pop('headers', {})
     start_index = kwargs.setdefault('start_index', 0)
     kwargs.setdefault('count', activitystreams.ITEMS_PER_PAGE)
 
@@ -52,7 +57,7 @@ class HandlerTest(testutil.HandlerTest):
         })
     self.mox.ReplayAll()
 
-    return activitystreams.application.get_response(url)
+    return activitystreams.application.get_response(url, headers=headers)
 
   def check_request(self, url, *args, **kwargs):
     resp = self.get_response('/fake' + url, *args, **kwargs)
@@ -137,6 +142,155 @@ class HandlerTest(testutil.HandlerTest):
                             'host_url': 'http://localhost/'},
         resp.body)
 
+  def test_etag_and_not_modified(self):
+    resp = self.get_response('/fake')
+    self.assertEquals(200, resp.status_int)
+    etag = resp.headers['ETag']
+    self.assertTrue(etag)
+
+    # no silo ETag, so the response isn't cached, but it still gets a 304
+    self.reset()
+    resp = self.get_response('/fake', headers={'If-None-Match': etag})
+    self.assertEquals(304, resp.status_int)
+    self.assertEquals('', resp.body)
+    self.assertEquals(etag, resp.headers['ETag'])
+
+  def expect_silo_response(self, silo_etag, items, **kwargs):
+    kwargs.update({'start_index': 0, 'count': activitystreams.ITEMS_PER_PAGE})
+    FakeSource.get_activities_response(**kwargs).AndReturn({
+        'items': items,
+        'etag': silo_etag,
+        })
+
+  def test_silo_etag_caches_rendered_response(self):
+    self.expect_silo_response('"abc"', [{'content': 'bar'}])
+    # silo says nothing changed and returns no activities
+    self.expect_silo_response('"abc"', [], etag='"abc"')
+    self.expect_silo_response('"abc"', [], etag='"abc"')
+    self.mox.ReplayAll()
+
+    url = '/fake?format=html&access_token=x'
+    first = activitystreams.application.get_response(url)
+    self.assertEquals(200, first.status_int)
+    self.assertIn('bar', first.body)
+
+    cached = activitystreams.application.get_response(url)
+    self.assertEquals(200, cached.status_int)
+    self.assertEquals(first.body, cached.body)
+    self.assertEquals(first.headers['Content-Type'],
+                      cached.headers['Content-Type'])
+    self.assertEquals(first.headers['ETag'], cached.headers['ETag'])
+
+    resp = activitystreams.application.get_response(
+      url, headers={'If-None-Match': first.headers['ETag']})
+    self.assertEquals(304, resp.status_int)
+
+  def test_silo_etag_self_not_cached(self):
+    # @self responses can include more than what the silo's ETag covers
+    for content in 'bar', 'baz':
+      FakeSource.get_activities_response(
+        None, source.SELF, start_index=0, count=activitystreams.ITEMS_PER_PAGE
+      ).AndReturn({'items': [{'content': content}], 'etag': '"abc"'})
+    self.mox.ReplayAll()
+
+    url = '/fake/@me/@self?format=html'
+    self.assertIn('bar', activitystreams.application.get_response(url).body)
+    self.assertIn('baz', activitystreams.application.get_response(url).body)
+    self.assertEquals(0, len(activitystreams.response_cache))
+
+  def test_silo_etag_changed_renders_response(self):
+    self.expect_silo_response('"abc"', [{'foo': 'bar'}])
+    self.expect_silo_response('"def"', [{'foo': 'baz'}], etag='"abc"')
+    self.mox.ReplayAll()
+
+    first = activitystreams.application.get_response('/fake')
+    resp = activitystreams.application.get_response(
+      '/fake', headers={'If-None-Match': first.headers['ETag']})
+    self.assertEquals(200, resp.status_int)
+    self.assertEquals([{'foo': 'baz'}], json.loads(resp.body)['items'])
+    self.assertNotEquals(first.headers['ETag'], resp.headers['ETag'])
+
+  def test_response_cache_key_varies_by_params(self):
+    self.expect_silo_response('"abc"', [{'foo': 'bar'}])
+    self.expect_silo_response('"abc"', [{'foo': 'baz'}])
+    self.mox.ReplayAll()
+
+    activitystreams.application.get_response('/fake?access_token=x')
+    resp = activitystreams.application.get_response('/fake?access_token=y')
+    self.assertEquals([{'foo': 'baz'}], json.loads(resp.body)['items'])
+    for key in activitystreams.response_cache._entries:
+      self.assertNotIn('access_token', key)
+
+  def test_json_compact_by_default(self):
+    resp = self.get_response('/fake')
+    self.assertIn('"items":[{"foo":"bar"}]', resp.body)
+    self.assertNotIn('\n', resp.body)
+
+  def test_json_pretty_for_browsers_and_plaintext(self):
+    for url, headers in (('/fake', {'Accept': 'text/html,*/*;q=0.8'}),
+                         ('/fake?plaintext=true', {})):
+      self.reset()
+      resp = self.get_response(url, headers=headers)
+      self.assertIn('"items": [\n', resp.body)
+
+  def test_gzip(self):
+    plain = self.get_response('/fake').body
+    self.reset()
+    resp = self.get_response('/fake', headers={'Accept-Encoding': 'gzip, deflate'})
+    self.assertEquals(200, resp.status_int)
+    self.assertEquals('gzip', resp.headers['Content-Encoding'])
+    self.assertEquals('Accept, Accept-Encoding', resp.headers['Vary'])
+    self.assertTrue(resp.headers['ETag'].endswith('-gzip"'))
+    self.assertEquals(plain, zlib.decompress(resp.body, 16 + zlib.MAX_WBITS))
+
+  def test_deflate(self):
+    plain = self.get_response('/fake').body
+    self.reset()
+    resp = self.get_response('/fake', headers={'Accept-Encoding': 'deflate'})
+    self.assertEquals('deflate', resp.headers['Content-Encoding'])
+    self.assertEquals(plain, zlib.decompress(resp.body))
+
+  def test_no_supported_encoding(self):
+    resp = self.get_response('/fake', headers={'Accept-Encoding': 'br'})
+    self.assertNotIn('Content-Encoding', resp.headers)
+    json.loads(resp.body)
+
+  def test_gzip_not_modified(self):
+    headers = {'Accept-Encoding': 'gzip'}
+    etag = self.get_response('/fake', headers=headers).headers['ETag']
+    self.reset()
+    headers['If-None-Match'] = etag
+    resp = self.get_response('/fake', headers=headers)
+    self.assertEquals(304, resp.status_int)
+    self.assertEquals('', resp.body)
+
+  def test_iter_json(self):
+    obj = {'a': 1, 'b': [1, 2], 'c': {'d': 'e'}}
+    for values in [], [{'x': [1, {'y': 2}]}, 'z', 3]:
+      for kwargs in {}, {'indent': 2}, {'separators': (',', ':')}:
+        self.assertEquals(
+          json.dumps(dict(obj, items=values), **kwargs),
+          ''.join(activitystreams.iter_json(obj, 'items', iter(values),
+                                            **kwargs)))
+
+  def test_iter_json_encodes_values_lazily(self):
+    encoded = []
+    def values():
+      for i in range(3):
+        encoded.append(i)
+        yield i
+
+    chunks = activitystreams.iter_json({}, 'items', values())
+    self.assertEquals('{"items": [', next(chunks))
+    self.assertEquals('0', next(chunks))
+    self.assertEquals([0], encoded)
+    self.assertEquals('{"items": [0, 1, 2]}', '{"items": [0' + ''.join(chunks))
+
+  def test_compress_chunks(self):
+    self.mox.stubs.Set(activitystreams, 'COMPRESS_CHUNK_SIZE', 3)
+    chunks = list(activitystreams.compress(['abcdefg', '', 'hij'], 'deflate'))
+    self.assertEquals('abcdefghij', zlib.decompress(''.join(chunks)))
+
   def test_unknown_format(self):
     resp = self.get_response('/fake?format=bad')
     self.assertEquals(400, resp.status_int)
@@ -2,6 +2,7 @@
 """
 
 import json
+import zlib
 
 import oauth_dropins.webutil.test
 from oauth_dropins.webutil import testutil
@@ -100,6 +101,22 @@ class AppTest(testutil.HandlerTest):
     self.assert_equals(200, resp.status_int)
     self.assert_equals(MF2_JSON, json.loads(resp.body))
 
+  def test_url_etag_and_gzip(self):
+    for _ in range(2):
+      self.expect_urlopen('http://my/posts.json', json.dumps(ACTIVITIES))
+    self.mox.ReplayAll()
+
+    url = '/url?url=http://my/posts.json&input=activitystreams&output=json-mf2'
+    resp = app.application.get_response(url, headers={'Accept-Encoding': 'gzip'})
+    self.assert_equals(200, resp.status_int)
+    self.assert_equals('gzip', resp.headers['Content-Encoding'])
+    self.assert_equals(MF2_JSON, json.loads(
+      zlib.decompress(resp.body, 16 + zlib.MAX_WBITS)))
+
+    resp = app.application.get_response(url, headers={
+      'Accept-Encoding': 'gzip', 'If-None-Match': resp.headers['ETag']})
+    self.assert_equals(304, resp.status_int)
+
   def test_url_json_mf2_to_html(self):
     self.expect_urlopen('http://my/posts.json', json.dumps(MF2_JSON))
     self.mox.ReplayAll()